@@ -1,17 +1,24 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse, RedirectResponse, Response, JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
-from prometheus_client import Counter, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 from minio import Minio
+from minio.commonconfig import CopySource
+from minio.deleteobjects import DeleteObject
+from minio.datatypes import Part
 from minio.error import S3Error
-import urllib.parse, mimetypes
-import os, json, time, re, secrets, traceback
-from typing import Optional, List, Dict
-from datetime import datetime, timedelta
+import urllib.parse, mimetypes, base64, bisect, heapq, math
+import os, json, time, re, secrets, traceback, hashlib, hmac, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional, List, Dict, Tuple
+from datetime import datetime, timedelta, timezone
 
 from jose import JWTError, jwt
 from passlib.context import CryptContext
@@ -72,6 +79,25 @@ minio = Minio(
     secure=MINIO_SECURE,
 )
 
+# Modo de transferencia directa (opcional): en vez de pasar los bytes por la
+# API se entregan URLs prefirmadas de corta vida contra el endpoint público de
+# MinIO. La firma incluye el host, así que se firma con un cliente propio.
+MINIO_PUBLIC_ENDPOINT = os.getenv("MINIO_PUBLIC_ENDPOINT", "").strip()
+MINIO_REGION = os.getenv("MINIO_REGION", "us-east-1")
+DIRECT_TRANSFER = bool(MINIO_PUBLIC_ENDPOINT) and os.getenv("DIRECT_TRANSFER", "off").strip().lower() == "on"
+PRESIGN_TTL = int(os.getenv("PRESIGN_TTL", "300"))
+minio_public = None
+if DIRECT_TRANSFER:
+    _public_host, _public_secure = _norm_endpoint(MINIO_PUBLIC_ENDPOINT)
+    # Con región fija presigned_* no consulta la ubicación del bucket (solo firma, sin red)
+    minio_public = Minio(
+        _public_host,
+        access_key=MINIO_ACCESS_KEY,
+        secret_key=MINIO_SECRET_KEY,
+        secure=_public_secure,
+        region=MINIO_REGION,
+    )
+
 # =========================
 # Redis
 # =========================
@@ -84,13 +110,142 @@ r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=False)
 # Cola de trabajos / workers
 # =========================
 JOBS_QUEUE = "conversion:queue"
+# Backend de cola compartido con los workers: "list" (RPUSH/BLPOP) o "streams" (XADD/consumer groups)
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "list").strip().lower()
+JOBS_STREAM = "conversion:stream"
+STREAM_GROUP = "workers"
+
+# Planificación (SCHEDULING_MODE=direct|fair, por defecto direct; API y
+# workers deben usar el mismo). En "fair" el job no se asigna
+# a un worker al crearlo: entra en la cola de su flujo (<clase>:<dueño>) y
+# los workers sacan siempre el flujo con menor etiqueta virtual (WFQ: cada
+# job avanza la etiqueta de su flujo costo/peso), así los usuarios se
+# intercalan y "interactive" recibe más parte que "bulk" sin matarlo de
+# hambre. "direct" es el planificador por costo hacia colas por worker.
+SCHEDULING_MODE = os.getenv("SCHEDULING_MODE", "direct").strip().lower()
+PRIORITY_WEIGHTS = {"interactive": 4.0, "bulk": 1.0}
+DEFAULT_PRIORITY = "interactive"
+BATCH_DEFAULT_PRIORITY = "bulk"
+FAIR_FLOWS_KEY = "fair:flows"  # ZSET flujo -> etiqueta virtual de su próximo job
+FAIR_QUEUE_PREFIX = "fair:queue:"  # LIST por flujo de "job_id|costo virtual"
+FAIR_FINISH_KEY = "fair:finish"  # HASH flujo -> última etiqueta servida
+FAIR_VCLOCK_KEY = "fair:vclock"  # etiqueta más alta servida (reloj virtual)
+FAIR_SIGNAL_KEY = "fair:signal"  # LIST de avisos para despertar workers en BLPOP
+FAIR_SIGNAL_MAX = 64
+USER_MAX_CONCURRENT = int(os.getenv("USER_MAX_CONCURRENT", "4"))  # jobs a la vez por usuario; 0 = sin límite
+FAIR_PREVIEW_LIMIT = 2000  # jobs simulados como mucho para posiciones y esperas
 JOB_STATUS_PREFIX = "job:status:"
 WORKER_STATUS_PREFIX = "worker:status:"
 MAX_JOB_RESULTS = 200
 
+# Índices secundarios de jobs (ZSET, score = created_at en epoch)
+#   jobs:index:all, jobs:index:status:<s>, jobs:index:owner:<u>, jobs:index:owner:<u>:status:<s>
+JOBS_INDEX_PREFIX = "jobs:index:"
+JOBS_INDEX_VERSION_KEY = "jobs:index:version"
+JOBS_INDEX_VERSION = "1"
+JOB_STATUSES = ("pending", "processing", "completed", "failed")
+
+# Los jobs se guardan como HASH (campo -> valor JSON) para actualizar campos
+# sueltos con un HSET atómico. Los registros antiguos (string JSON) se migran.
+JOBS_STORAGE_VERSION_KEY = "jobs:storage:version"
+JOBS_STORAGE_VERSION = "hash-1"
+
+# Contadores mantenidos de forma incremental (HASH estado -> n, más "total")
+#   jobs:counters:global, jobs:counters:user:<u>
+JOBS_COUNTERS_PREFIX = "jobs:counters:"
+JOBS_COUNTERS_VERSION_KEY = "jobs:counters:version"
+JOBS_COUNTERS_VERSION = "1"
+
+# Registro de workers vivos (ZSET worker_id -> último heartbeat) y totales del cluster
+WORKERS_REGISTRY_KEY = "workers:registry"
+WORKERS_COUNTERS_KEY = "workers:counters"
+WORKER_STATUS_TTL = 15
+
+# Eventos en vivo: el worker publica cambios de jobs y heartbeats; cada
+# proceso de la API mantiene una sola suscripción y la reparte por SSE.
+EVENTS_JOBS_CHANNEL = "events:jobs"
+EVENTS_WORKERS_CHANNEL = "events:workers"
+EVENT_TOPICS = {"jobs": EVENTS_JOBS_CHANNEL, "workers": EVENTS_WORKERS_CHANNEL}
+SSE_KEEPALIVE_SECONDS = 15
+SSE_QUEUE_SIZE = 256
+# EventSource no manda cabeceras: en vez del JWT en la URL (queda en logs de
+# proxies) se usa un ticket de un solo uso y vida corta, canjeado al conectar.
+SSE_TICKET_PREFIX = "sse:ticket:"
+SSE_TICKET_TTL = int(os.getenv("SSE_TICKET_TTL", "30"))
+# Usuarios que ven los eventos de todos los jobs (panel de monitoreo)
+ADMIN_USERS = {u.strip() for u in os.getenv("ADMIN_USERS", "").split(",") if u.strip()}
+
+# Streaming por rangos (HTTP 206)
+STREAM_CHUNK_SIZE = 1024 * 1024
+MAX_RANGES_PER_REQUEST = int(os.getenv("MAX_RANGES_PER_REQUEST", "16"))
+# <video>/<audio> no mandan Authorization pero sí Range: se les da una URL de
+# /media firmada (HMAC) que vale entre MEDIA_URL_TTL y 2*MEDIA_URL_TTL segundos
+MEDIA_URL_TTL = int(os.getenv("MEDIA_URL_TTL", "3600"))
+
+# Validadores y caché HTTP: stat de MinIO memorizado unos segundos para que
+# las revalidaciones (304) no toquen MinIO; políticas Cache-Control por endpoint.
+STAT_CACHE_TTL = float(os.getenv("STAT_CACHE_TTL", "5"))
+STAT_CACHE_MAX_ENTRIES = 5000
+MEDIA_CACHE_CONTROL = "private, no-cache"  # con token: siempre revalidar, barato con 304
+SHARE_MAX_AGE = 300  # nunca más allá de lo que le queda al token
+
+# Listado de /media: caché por usuario en proceso, válida mientras no cambie
+# su generación en Redis (la suben API y worker al escribir/borrar objetos).
+# El TTL cubre lo que no pasa por aquí (subidas directas a MinIO).
+MEDIA_LIST_GEN_PREFIX = "media:gen:"
+MEDIA_LIST_CACHE_TTL = float(os.getenv("MEDIA_LIST_CACHE_TTL", "60"))
+MEDIA_LIST_CACHE_MAX_USERS = 512
+MEDIA_LIST_DEFAULT_LIMIT = 100
+MEDIA_LIST_MAX_LIMIT = 1000
+MEDIA_KINDS = {"video", "audio", "other"}
+
+# Planificador por costo: segundos/MB aprendidos de duration_seconds (EWMA por
+# tipo de entrada y formato de salida) y backlog estimado por worker.
+SCHED_COST_PREFIX = "sched:cost:"
+SCHED_BACKLOG_KEY = "sched:backlog"
+SCHED_PENDING_COST_KEY = "sched:pending_cost"  # segundos estimados en cola; el worker los descuenta al arrancar
+
+# Control de admisión (ADMISSION_CONTROL=on|off): /convert se rechaza con 429
+# si la cola (jobs) o el tiempo estimado de vaciado (costo pendiente / slots)
+# pasan del límite, y con 503 si ningún worker tiene disco de scratch para
+# el archivo. Las subidas se frenan antes (503) por subidas en curso en este
+# proceso y (429) con la cola muy por encima del límite. Retry-After calculado.
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "on").strip().lower() != "off"
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1000"))
+ADMISSION_MAX_DRAIN_SECONDS = float(os.getenv("ADMISSION_MAX_DRAIN_SECONDS", "1800"))
+ADMISSION_MIN_SCRATCH_BYTES = int(os.getenv("ADMISSION_MIN_SCRATCH_BYTES", str(1024**3)))
+ADMISSION_UPLOAD_DRAIN_FACTOR = 2.0  # las subidas se cortan con el doble de espera que las conversiones
+ADMISSION_SNAPSHOT_TTL = 1.0  # s que se reutiliza la foto de cola/workers
+ADMISSION_MAX_RETRY_AFTER = 600
+UPLOAD_MAX_INFLIGHT = int(os.getenv("UPLOAD_MAX_INFLIGHT", "16"))  # subidas por proxy a la vez en este proceso
+DEFAULT_SEC_PER_MB = {"audio": 0.5, "video": 8.0}
+JOB_OVERHEAD_SECONDS = 2.0
+
+# Caché de resultados de conversión direccionada por contenido:
+# (ETag origen, formato, opciones normalizadas, versión de encoder) -> objeto en CACHE_BUCKET
+CONVERSION_CACHE_ENABLED = os.getenv("CONVERSION_CACHE", "on").strip().lower() != "off"
+CACHE_BUCKET = os.getenv("CONVERSION_CACHE_BUCKET", f"{BUCKET}-cache")
+CONV_CACHE_ENTRY_PREFIX = "convcache:entry:"
+CONV_CACHE_LRU_KEY = "convcache:lru"
+CONV_CACHE_ENCODER_KEY = "convcache:encoder"  # lo publica cada worker al arrancar
+
 AUDIO_FORMATS = {"mp3", "flac", "wav", "aac", "ogg", "m4a"}
 VIDEO_FORMATS = {"mp4", "avi", "mkv", "webm", "mov"}
-ALLOWED_FORMATS = AUDIO_FORMATS | VIDEO_FORMATS
+# Salida adaptativa: escalera de renditions + playlists en <stem>_hls/ del usuario
+ADAPTIVE_FORMATS = {"hls"}
+ALLOWED_FORMATS = AUDIO_FORMATS | VIDEO_FORMATS | ADAPTIVE_FORMATS
+MAX_OUTPUTS_PER_JOB = 8
+
+# Lotes de /convert/batch: batch:<id> -> HASH (owner, created_at, job_ids...)
+BATCH_PREFIX = "batch:"
+MAX_BATCH_ITEMS = 500
+HLS_DIR_SUFFIX = "_hls"
+HLS_MASTER = "master.m3u8"
+HLS_MIME = {"m3u8": "application/vnd.apple.mpegurl", "ts": "video/mp2t"}
+# Los segmentos llevan el id de la conversión en el nombre -> inmutables.
+# Las playlists se revalidan siempre (ETag, 304): una reconversión borra los
+# segmentos anteriores y una playlist vieja en caché apuntaría a 404.
+HLS_SEGMENT_MAX_AGE = 365 * 24 * 3600
 
 # =========================
 # Métricas Prometheus
@@ -102,7 +257,17 @@ API_STREAMS       = Counter("api_streams_total", "Total de streams exitosos")
 API_LOGINS        = Counter("api_logins_total", "Logins exitosos")
 API_DELETES       = Counter("api_deletes_total", "Borrados exitosos")
 API_JOBS_ENQUEUED = Counter("api_jobs_enqueued_total", "Jobs de conversión encolados")
+API_CONV_CACHE     = Counter("api_conversion_cache_total", "Consultas a la caché de conversiones", ["result"])
 QUEUE_LEN         = Gauge  ("redis_media_jobs_len", "Items en cola media_jobs")
+API_PRESIGNED     = Counter("api_presigned_urls_total", "URLs prefirmadas entregadas", ["op"])
+MEDIA_LIST_CACHE  = Counter("api_media_list_cache_total", "Consultas a la caché de listados de /media", ["result"])
+ADMISSION_REJECTED = Counter("api_admission_rejected_total", "Peticiones rechazadas por control de admisión",
+                             ["endpoint", "reason"])
+ADMISSION_DRAIN   = Gauge  ("api_admission_drain_seconds", "Tiempo estimado para vaciar la cola")
+SSE_CLIENTS       = Gauge  ("api_sse_clients", "Clientes conectados a /events")
+AUTH_CACHE        = Counter("api_auth_cache_total", "Consultas a la caché de tokens validados", ["result"])
+AUTH_LATENCY      = Histogram("api_auth_seconds", "Latencia de autenticación", ["op"],
+                              buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
 
 # =========================
 # Auth (demo con Redis)
@@ -115,6 +280,16 @@ pwd_context   = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 USERNAME_RE   = re.compile(r"^[a-zA-Z0-9_.-]{3,32}$")
 
+# Caché en proceso de tokens ya validados (firma + usuario existente), con TTL
+# corto. Al borrar un usuario se invalida aquí y, vía pub/sub, en las demás
+# réplicas de la API. pbkdf2 corre en un pool acotado, fuera del event loop.
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_MAX_ENTRIES = 10000
+AUTH_INVALIDATE_CHANNEL = "auth:invalidate"
+AUTH_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("AUTH_HASH_WORKERS", "4")), thread_name_prefix="auth-hash")
+_token_cache: Dict[str, Tuple[str, float]] = {}  # token -> (usuario, vence en epoch)
+_token_cache_lock = threading.Lock()
+
 def user_key(u: str) -> str:
     return f"user:{u}"
 
@@ -126,7 +301,7 @@ def get_user_hash(u: str) -> str | None:
     return h.decode() if h else None
 
 def create_user(u: str, p: str):
-    pwd_hash = pwd_context.hash(p)
+    pwd_hash = AUTH_POOL.submit(pwd_context.hash, p).result()
     r.hset(user_key(u), mapping={
         "password_hash": pwd_hash,
         "created_at": datetime.utcnow().isoformat()
@@ -148,26 +323,125 @@ def verify_user(username: str, password: str) -> bool:
     print(f"{'✅' if result else '❌'} Verificación de contraseña para {username}: {result}")
     return result
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    cred_exc = HTTPException(status_code=401, detail="Invalid credentials",
-                             headers={"WWW-Authenticate": "Bearer"})
+def _cached_token_user(token: str) -> Optional[str]:
+    now = time.time()
+    with _token_cache_lock:
+        entry = _token_cache.get(token)
+        if entry and entry[1] > now:
+            return entry[0]
+        if entry:
+            del _token_cache[token]
+    return None
+
+def _cache_token(token: str, username: str, expires_at: float):
+    now = time.time()
+    with _token_cache_lock:
+        if len(_token_cache) >= AUTH_CACHE_MAX_ENTRIES:
+            for tok in [t for t, (_, exp) in _token_cache.items() if exp <= now]:
+                del _token_cache[tok]
+            while len(_token_cache) >= AUTH_CACHE_MAX_ENTRIES:
+                del _token_cache[next(iter(_token_cache))]  # el más antiguo
+        _token_cache[token] = (username, min(now + AUTH_CACHE_TTL, expires_at))
+
+def invalidate_user(username: str, broadcast: bool = True):
+    """Olvida los tokens cacheados de <username> (y avisa a las otras réplicas)."""
+    with _token_cache_lock:
+        for tok in [t for t, (u, _) in _token_cache.items() if u == username]:
+            del _token_cache[tok]
+    if broadcast:
+        r.publish(AUTH_INVALIDATE_CHANNEL, username)
+
+def _auth_invalidation_listener():
+    """Hilo: aplica las invalidaciones publicadas por otras réplicas."""
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(AUTH_INVALIDATE_CHANNEL)
+            for message in pubsub.listen():
+                invalidate_user(_decode(message["data"]), broadcast=False)
+        except Exception as e:
+            print(f"⚠️  Listener de invalidación de auth: {e}")
+            with _token_cache_lock:
+                _token_cache.clear()  # pudimos perder avisos mientras no había conexión
+            time.sleep(1)
+
+def _authenticate_token(token: str) -> Optional[str]:
+    """Usuario del token si la firma es válida y el usuario existe; None si no."""
+    started = time.perf_counter()
+    username = _cached_token_user(token)
+    if username:
+        AUTH_CACHE.labels(result="hit").inc()
+        AUTH_LATENCY.labels(op="token").observe(time.perf_counter() - started)
+        return username
+    AUTH_CACHE.labels(result="miss").inc()
     try:
-        payload  = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if not username or not user_exists(username):
-            raise cred_exc
-        return {"username": username}
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
-        raise cred_exc
+        return None
+    username = payload.get("sub")
+    if not username or not user_exists(username):
+        return None
+    _cache_token(token, username, float(payload.get("exp") or time.time() + AUTH_CACHE_TTL))
+    AUTH_LATENCY.labels(op="token").observe(time.perf_counter() - started)
+    return username
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    # Acierto de caché en el loop (sin E/S); si no, la validación consulta Redis -> threadpool
+    if _cached_token_user(token):
+        username = _authenticate_token(token)
+    else:
+        username = await run_in_threadpool(_authenticate_token, token)
+    if not username:
+        raise HTTPException(status_code=401, detail="Invalid credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return {"username": username}
+
+def _media_signature(object_name: str, exp: int) -> str:
+    return hmac.new(SECRET_KEY.encode(), f"{object_name}|{exp}".encode(), hashlib.sha256).hexdigest()
+
+def _signed_media_url(username: str, name: str) -> Tuple[str, int]:
+    """
+    Ruta de /media firmada para <name> y su expiración. La expiración se
+    redondea a ventanas de MEDIA_URL_TTL: la URL no cambia en cada pedido y el
+    navegador puede reutilizar lo que ya tiene en caché.
+    """
+    exp = (int(time.time()) // MEDIA_URL_TTL + 2) * MEDIA_URL_TTL
+    query = urllib.parse.urlencode({"u": username, "exp": exp,
+                                    "sig": _media_signature(f"{username}/{name}", exp)})
+    return f"/media/{urllib.parse.quote(name)}?{query}", exp
+
+async def get_media_user(name: str, u: str = "", exp: int = 0, sig: str = "",
+                         authorization: Optional[str] = Header(default=None)):
+    """Dueño de GET /media/<name>: URL firmada (<video>/<audio>) o Authorization: Bearer."""
+    if sig:
+        if exp < time.time() or not hmac.compare_digest(sig, _media_signature(f"{u}/{name}", exp)):
+            raise HTTPException(status_code=401, detail="URL firmada inválida o vencida")
+        return {"username": u}
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Not authenticated",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return await get_current_user(token)
 
 class SignupReq(BaseModel):
     username: str
     password: str
 
+class OutputSpec(BaseModel):
+    format: str
+    options: Optional[Dict] = None
+
 class ConvertRequest(BaseModel):
     input_file: str
-    output_format: str
+    # Una salida (output_format + options) o varias en un solo job (outputs)
+    output_format: Optional[str] = None
     options: Optional[Dict] = None
+    outputs: Optional[List[OutputSpec]] = None
+    priority: Optional[str] = None  # interactive (por defecto) | bulk
+
+class BatchConvertRequest(BaseModel):
+    items: List[ConvertRequest]
+    priority: Optional[str] = None  # para los items sin prioridad propia; por defecto bulk
 
 @app.on_event("startup")
 def wait_for_redis():
@@ -179,6 +453,20 @@ def wait_for_redis():
             time.sleep(1)
     raise RuntimeError("Redis no disponible")
 
+@app.on_event("startup")
+def start_auth_invalidation_listener():
+    threading.Thread(target=_auth_invalidation_listener, name="auth-invalidate", daemon=True).start()
+
+@app.on_event("startup")
+def start_event_relay():
+    threading.Thread(target=_event_relay, name="event-relay", daemon=True).start()
+
+@app.on_event("startup")
+def build_job_indexes():
+    _ensure_job_storage()
+    _ensure_job_indexes()
+    _ensure_job_counters()
+
 @app.post("/auth/signup")
 def signup(req: SignupReq):
     u = req.username.strip(); p = req.password
@@ -191,7 +479,9 @@ def signup(req: SignupReq):
         print(f"⚠️  Usuario '{u}' ya existe")
         raise HTTPException(status_code=409, detail="El usuario ya existe")
 
+    started = time.perf_counter()
     create_user(u, p)
+    AUTH_LATENCY.labels(op="signup").observe(time.perf_counter() - started)
     token = create_access_token({"sub": u})
     API_LOGINS.inc()
     return {"ok": True, "access_token": token, "token_type": "bearer"}
@@ -199,13 +489,26 @@ def signup(req: SignupReq):
 @app.post("/auth/login")
 async def login(form: OAuth2PasswordRequestForm = Depends()):
     print(f"🔑 Intento de login: usuario='{form.username}'")
-    if not verify_user(form.username, form.password):
+    # pbkdf2 tarda decenas de ms: en el pool, para no frenar los streams del event loop
+    started = time.perf_counter()
+    ok = await asyncio.get_running_loop().run_in_executor(AUTH_POOL, verify_user, form.username, form.password)
+    AUTH_LATENCY.labels(op="login").observe(time.perf_counter() - started)
+    if not ok:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     API_LOGINS.inc()
     token = create_access_token({"sub": form.username})
     print(f"✅ Login exitoso: {form.username}")
     return {"access_token": token, "token_type": "bearer"}
 
+@app.delete("/auth/me")
+def delete_account(user: dict = Depends(get_current_user)):
+    """Borra la cuenta; sus tokens dejan de valer de inmediato en todas las réplicas."""
+    username = user["username"]
+    r.delete(user_key(username))
+    invalidate_user(username)
+    print(f"🗑️  Usuario eliminado: {username}")
+    return {"ok": True}
+
 @app.get("/auth/debug/users")
 def debug_users():
     """Debug endpoint para listar usuarios en Redis"""
@@ -229,8 +532,9 @@ def debug_users():
 # =========================
 @app.on_event("startup")
 def ensure_bucket():
-    if not minio.bucket_exists(BUCKET):
-        minio.make_bucket(BUCKET)
+    for bucket in (BUCKET, CACHE_BUCKET):
+        if not minio.bucket_exists(bucket):
+            minio.make_bucket(bucket)
 
 # =========================
 # Health / Metrics
@@ -242,45 +546,442 @@ def health():
 
 @app.get("/metrics")
 def metrics():
+    try:
+        _queue_depth()
+    except redis.RedisError:
+        pass
     return PlainTextResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
+# =========================
+# Streaming con soporte de rangos (RFC 7233)
+# =========================
+_RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+def _parse_range(header: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Interpreta un header Range ("bytes=0-99,200-,-500") contra un objeto de
+    <size> bytes. Devuelve la lista de rangos inclusivos (start, end) ya
+    ordenados y fusionados, o None si el header no aplica (se sirve completo).
+    Lanza 416 si ningún rango es satisfacible.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges: List[Tuple[int, int]] = []
+    for part in spec.split(","):
+        m = _RANGE_SPEC_RE.match(part)
+        if not m:
+            return None  # sintaxis inválida -> se ignora el header
+        first, last = m.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # Sufijo: últimos N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            end = min(end, size - 1)
+        if start >= size:
+            continue
+        ranges.append((start, end))
+
+    if not ranges:
+        raise HTTPException(
+            status_code=416,
+            detail="Rango no satisfacible",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+
+    # Fusionar rangos solapados/contiguos para no pedir dos veces los mismos bytes
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES_PER_REQUEST:
+        return None  # demasiados fragmentos: más barato servir el objeto entero
+    return merged
+
+def _http_date(dt: Optional[datetime]) -> Optional[str]:
+    if not dt:
+        return None
+    return format_datetime(dt, usegmt=True)
+
+def _if_range_matches(value: Optional[str], etag: str, last_modified: Optional[datetime]) -> bool:
+    """If-Range: el rango solo se respeta si el validador coincide con el objeto actual."""
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        # Comparación fuerte: un ETag débil nunca valida un rango
+        return not value.startswith("W/") and value == etag
+    try:
+        since = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return False
+    if not last_modified or since is None:
+        return False
+    return int(since.timestamp()) == int(last_modified.timestamp())
+
+_stat_cache: Dict[str, Tuple[object, float]] = {}
+_stat_cache_lock = threading.Lock()
+
+def _stat_object(object_name: str, fresh: bool = False):
+    """stat_object con caché breve en proceso (los errores no se cachean); <fresh> la salta y la renueva."""
+    now = time.monotonic()
+    with _stat_cache_lock:
+        entry = None if fresh else _stat_cache.get(object_name)
+        if entry and entry[1] > now:
+            return entry[0]
+    st = minio.stat_object(BUCKET, object_name)
+    with _stat_cache_lock:
+        if len(_stat_cache) >= STAT_CACHE_MAX_ENTRIES:
+            _stat_cache.clear()
+        _stat_cache[object_name] = (st, now + STAT_CACHE_TTL)
+    return st
+
+def _forget_stat(object_name: str = "", prefix: str = ""):
+    """Invalida el stat cacheado de un objeto (o de todo un prefijo) tras escribirlo/borrarlo."""
+    with _stat_cache_lock:
+        if object_name:
+            _stat_cache.pop(object_name, None)
+        if prefix:
+            for key in [k for k in _stat_cache if k.startswith(prefix)]:
+                del _stat_cache[key]
+
+def _not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    """
+    If-None-Match (comparación débil, admite lista y "*") tiene prioridad;
+    If-Modified-Since solo se mira si no vino If-None-Match.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        if not etag:
+            return False
+        if inm.strip() == "*":
+            return True
+        bare = etag[2:] if etag.startswith("W/") else etag
+        for candidate in inm.split(","):
+            candidate = candidate.strip()
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate == bare:
+                return True
+        return False
+    ims = request.headers.get("if-modified-since")
+    if not ims or not last_modified:
+        return False
+    try:
+        since = parsedate_to_datetime(ims)
+    except (TypeError, ValueError):
+        return False
+    if since is None:
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return int(last_modified.timestamp()) <= int(since.timestamp())
+
+def _iter_object(object_name: str, offset: int = 0, length: int = 0, resp=None):
+    if resp is None:
+        resp = minio.get_object(BUCKET, object_name, offset=offset, length=length)
+    try:
+        while True:
+            chunk = resp.read(STREAM_CHUNK_SIZE)
+            if not chunk: break
+            yield chunk
+    finally:
+        resp.close(); resp.release_conn()
+
+def _open_object(object_name: str, ranges, expect_etag: str = ""):
+    """
+    Abre el GET de MinIO del objeto completo o del único rango pedido. Con
+    <expect_etag> devuelve None si lo que respondió MinIO es otra versión, para
+    no mandar bytes que no cuadran con el Content-Length/ETag del stat memorizado.
+    """
+    offset, length = (ranges[0][0], ranges[0][1] - ranges[0][0] + 1) if ranges else (0, 0)
+    try:
+        resp = minio.get_object(BUCKET, object_name, offset=offset, length=length)
+    except Exception:
+        raise HTTPException(status_code=404, detail="not_found")
+    if expect_etag and resp.headers.get("ETag", "").replace('"', "") != expect_etag:
+        resp.close(); resp.release_conn()
+        return None
+    return resp
+
+def _validator_headers(st) -> Dict[str, str]:
+    headers = {}
+    if st.etag:
+        headers["ETag"] = f'"{st.etag}"'
+    last_modified = _http_date(st.last_modified)
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
+
+def _serve_object(request: Request, object_name: str, st, mime: str,
+                  headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Sirve <object_name> completo (200) o parcial (206) según el header Range.
+    Los rangos se reenvían a MinIO como offset/length, de modo que un seek
+    solo transfiere los bytes pedidos. Si el cliente ya tiene la versión
+    actual responde 304 sin abrir el objeto (con el stat memorizado <st>).
+    Para mandar cuerpo se abre el GET y se compara su ETag con el de <st>:
+    solo si una conversión reescribió el objeto se vuelve a leer el stat, así
+    Content-Length/ETag nunca son los viejos sin pagar un stat por petición.
+    El multi-rango hace varias lecturas, así que ese usa siempre un stat nuevo.
+    """
+    headers = dict(headers or {})
+    headers.setdefault("Cache-Control", MEDIA_CACHE_CONTROL)
+    headers["Accept-Ranges"] = "bytes"
+    if _not_modified(request, f'"{st.etag}"' if st.etag else "", st.last_modified):
+        return Response(status_code=304, headers={**headers, **_validator_headers(st)})
+
+    def ranges_for(st):
+        etag = f'"{st.etag}"' if st.etag else ""
+        if st.size > 0 and _if_range_matches(request.headers.get("if-range"), etag, st.last_modified):
+            return _parse_range(request.headers.get("range"), st.size)
+        return None
+
+    ranges = ranges_for(st)
+    resp = None
+    if not ranges or len(ranges) == 1:
+        resp = _open_object(object_name, ranges, expect_etag=st.etag or "")
+    if resp is None:
+        try:
+            st = _stat_object(object_name, fresh=True)
+        except Exception:
+            raise HTTPException(status_code=404, detail="not_found")
+        ranges = ranges_for(st)
+        if not ranges or len(ranges) == 1:
+            resp = _open_object(object_name, ranges)
+    size = st.size
+    headers.update(_validator_headers(st))
+
+    if not ranges:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_iter_object(object_name, resp=resp), headers=headers, media_type=mime)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            _iter_object(object_name, resp=resp),
+            status_code=206, headers=headers, media_type=mime,
+        )
+
+    # Multi-rango: multipart/byteranges, una lectura a MinIO por fragmento
+    boundary = secrets.token_hex(16)
+    part_heads = [
+        (f"--{boundary}\r\nContent-Type: {mime}\r\n"
+         f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+        for start, end in ranges
+    ]
+    tail = f"--{boundary}--\r\n".encode()
+    total = sum(len(h) + (end - start + 1) + 2 for h, (start, end) in zip(part_heads, ranges)) + len(tail)
+
+    def it():
+        for head, (start, end) in zip(part_heads, ranges):
+            yield head
+            yield from _iter_object(object_name, offset=start, length=end - start + 1)
+            yield b"\r\n"
+        yield tail
+
+    headers["Content-Length"] = str(total)
+    return StreamingResponse(
+        it(), status_code=206, headers=headers,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+    )
+
+def _media_mime(name: str) -> str:
+    ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    mime = HLS_MIME.get(ext) or mimetypes.guess_type(name)[0]
+    return mime or "application/octet-stream"
+
+def _hls_cache_headers(name: str, public: bool) -> Dict[str, str]:
+    """Cache-Control de HLS: segmentos inmutables, playlists con revalidación; vacío para el resto"""
+    scope = "public" if public else "private"
+    if name.endswith(".ts"):
+        return {"Cache-Control": f"{scope}, max-age={HLS_SEGMENT_MAX_AGE}, immutable"}
+    if name.endswith(".m3u8"):
+        return {"Cache-Control": f"{scope}, no-cache"}
+    return {}
+
+def _hls_dir(name: str) -> Optional[str]:
+    """'<stem>_hls/' si <name> es la playlist maestra de una salida HLS"""
+    directory, _, base = name.rpartition("/")
+    if base == HLS_MASTER and directory.endswith(HLS_DIR_SUFFIX):
+        return f"{directory}/"
+    return None
+
+def _presign(method: str, object_name: str, op: str, expires: int = PRESIGN_TTL, **kwargs) -> str:
+    """URL prefirmada contra el endpoint público de MinIO (solo en modo directo)."""
+    API_PRESIGNED.labels(op=op).inc()
+    return minio_public.get_presigned_url(
+        method, BUCKET, object_name, expires=timedelta(seconds=max(1, expires)), **kwargs,
+    )
+
+def _safe_media_path(name: str) -> str:
+    """Ruta relativa al prefijo del usuario; se admiten subdirectorios (HLS) pero no '..'"""
+    name = (name or "").strip()
+    if not name or name.startswith("/") or ".." in name.split("/"):
+        raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
+    return name
+
+def _is_listed(name: str) -> bool:
+    """De una salida HLS solo se lista la playlist maestra, no renditions ni segmentos"""
+    if f"{HLS_DIR_SUFFIX}/" not in name:
+        return True
+    return _hls_dir(name) is not None
+
+def _listing_kind(name: str) -> str:
+    mime = _media_mime(name)
+    if mime.startswith("video/") or name.endswith(f"/{HLS_MASTER}"):
+        return "video"
+    if mime.startswith("audio/"):
+        return "audio"
+    return "other"
+
+_listing_cache: Dict[str, Tuple[int, float, List[Dict]]] = {}
+_listing_cache_lock = threading.Lock()
+
+def _listing_generation(owner: str) -> int:
+    return int(r.get(f"{MEDIA_LIST_GEN_PREFIX}{owner}") or 0)
+
+def _invalidate_listing(owner: str):
+    """Tras escribir/borrar en el prefijo de <owner>: invalida su listado en todas las réplicas"""
+    r.incr(f"{MEDIA_LIST_GEN_PREFIX}{owner}")
+    with _listing_cache_lock:
+        _listing_cache.pop(owner, None)
+
+def _list_user_media(owner: str, fresh: bool = False) -> List[Dict]:
+    """Listado completo del usuario, ordenado por nombre (el orden de MinIO)"""
+    gen = _listing_generation(owner)
+    now = time.monotonic()
+    if not fresh:
+        with _listing_cache_lock:
+            entry = _listing_cache.get(owner)
+        if entry and entry[0] == gen and entry[1] > now:
+            MEDIA_LIST_CACHE.labels(result="hit").inc()
+            return entry[2]
+    MEDIA_LIST_CACHE.labels(result="miss").inc()
+    prefix = f"{owner}/"
+    items = []
+    for o in minio.list_objects(BUCKET, prefix=prefix, recursive=True):
+        name = o.object_name[len(prefix):]
+        if not _is_listed(name):
+            continue
+        items.append({
+            "name": name,
+            "size": o.size,
+            "last_modified": o.last_modified.isoformat() if o.last_modified else None,
+            "content_type": _media_mime(name),
+            "kind": _listing_kind(name),
+        })
+    with _listing_cache_lock:
+        if len(_listing_cache) >= MEDIA_LIST_CACHE_MAX_USERS:
+            _listing_cache.clear()
+        _listing_cache[owner] = (gen, now + MEDIA_LIST_CACHE_TTL, items)
+    return items
+
+def _encode_cursor(name: str) -> str:
+    return base64.urlsafe_b64encode(name.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
 # =========================
 # Mis archivos
 # =========================
 @app.get("/media")
-def list_media(user: dict = Depends(get_current_user)):
-    prefix = f"{user['username']}/"
+def list_media(cursor: Optional[str] = None, limit: int = MEDIA_LIST_DEFAULT_LIMIT,
+               kind: Optional[str] = None, fresh: bool = False,
+               user: dict = Depends(get_current_user)):
+    """
+    Listado paginado por cursor (opaco, = último nombre devuelto), con tamaño,
+    fecha y tipo. kind=video|audio|other filtra; fresh=1 salta la caché.
+    "direct_transfer" dice si vale la pena pedir ?presign=1; si no, cada item
+    (salvo HLS) trae ya su "stream_url" firmada para reproducir por el proxy.
+    """
+    if kind and kind not in MEDIA_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind debe ser uno de {sorted(MEDIA_KINDS)}")
+    limit = max(1, min(limit, MEDIA_LIST_MAX_LIMIT))
     try:
-        objs = minio.list_objects(BUCKET, prefix=prefix, recursive=True)
-        return {"objects": [o.object_name[len(prefix):] for o in objs]}
+        items = _list_user_media(user["username"], fresh)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if kind:
+        items = [i for i in items if i["kind"] == kind]
+    start = 0
+    if cursor:
+        after = _decode_cursor(cursor)
+        start = bisect.bisect_right([i["name"] for i in items], after)
+    page = items[start:start + limit]
+    more = start + limit < len(items)
+    if not DIRECT_TRANSFER:
+        page = [dict(i) for i in page]  # las de la caché se comparten entre pedidos
+        for item in page:
+            if not _hls_dir(item["name"]):
+                item["stream_url"], item["stream_expires"] = _signed_media_url(user["username"], item["name"])
+    return {
+        "objects": [i["name"] for i in page],  # compatibilidad: solo nombres
+        "items": page,
+        "next_cursor": _encode_cursor(page[-1]["name"]) if more and page else None,
+        "total": len(items),
+        "direct_transfer": DIRECT_TRANSFER,
+    }
 
-@app.get("/media/{name}")
-def stream_media(name: str, user: dict = Depends(get_current_user)):
+@app.get("/media/{name:path}")
+def stream_media(name: str, request: Request, presign: bool = False,
+                 user: dict = Depends(get_media_user)):
+    """
+    Sirve el archivo a través de la API (con token o con URL firmada). Con
+    ?presign=1 devuelve en cambio {"url": ...} prefirmada para leer directo de
+    MinIO, o {"url": null} si el modo directo está apagado o no aplica (HLS:
+    sus URLs relativas necesitan pasar por la API) y el cliente debe usar el
+    proxy; fuera de HLS viene además "stream_url", la ruta firmada del proxy.
+    """
+    name = _safe_media_path(name)
     object_name = f"{user['username']}/{name}"
     try:
-        resp = minio.get_object(BUCKET, object_name)
+        st = _stat_object(object_name)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"No existe: {name}. {e}")
 
-    mime, _ = mimetypes.guess_type(name)
-    if mime is None: mime = "application/octet-stream"
-
-    def it():
-        try:
-            while True:
-                chunk = resp.read(1024 * 1024)
-                if not chunk: break
-                yield chunk
-        finally:
-            resp.close(); resp.release_conn()
-
+    if presign:
+        if _hls_dir(name) or f"{HLS_DIR_SUFFIX}/" in name:
+            return {"url": None}
+        if not DIRECT_TRANSFER:
+            stream_url, expires = _signed_media_url(user["username"], name)
+            return {"url": None, "stream_url": stream_url, "stream_expires": expires}
+        return {"url": _presign("GET", object_name, "download"), "expires_in": PRESIGN_TTL,
+                "size": st.size, "etag": st.etag}
+
+    response = _serve_object(request, object_name, st, _media_mime(name),
+                             _hls_cache_headers(name, public=False))
     API_STREAMS.inc()
-    return StreamingResponse(it(), media_type=mime)
+    return response
 
 @app.post("/upload")
 def upload_media(file: UploadFile = File(...), user: dict = Depends(get_current_user)):
+    # La admisión y el cupo de subidas los aplica _UploadAdmission antes de leer el cuerpo
     object_name = f"{user['username']}/{file.filename}"
     try:
         minio.put_object(
@@ -288,21 +989,297 @@ def upload_media(file: UploadFile = File(...), user: dict = Depends(get_current_
             length=-1, part_size=10*1024*1024,
             content_type=file.content_type or "application/octet-stream",
         )
+        _forget_stat(object_name)
+        _invalidate_listing(user["username"])
         API_UPLOADS.inc()
         return {"ok": True, "name": file.filename}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.delete("/media/{name}")
+class UploadPresignReq(BaseModel):
+    filename: str
+    content_type: Optional[str] = None
+
+@app.post("/upload/presign")
+def upload_presign(req: UploadPresignReq, user: dict = Depends(get_current_user)):
+    """
+    Modo directo: URL prefirmada para un PUT del archivo completo a MinIO
+    bajo el prefijo del usuario. {"url": null} = usar POST /upload.
+    """
+    if not DIRECT_TRANSFER:
+        return {"url": None}
+    _admit("upload", jobs=0, drain_factor=ADMISSION_UPLOAD_DRAIN_FACTOR)
+    filename = _sanitize_filename(req.filename)
+    object_name = f"{user['username']}/{filename}"
+    _forget_stat(object_name)
+    return {
+        "url": _presign("PUT", object_name, "upload"),
+        "method": "PUT",
+        "headers": {"Content-Type": req.content_type or "application/octet-stream"},
+        "expires_in": PRESIGN_TTL,
+        "name": filename,
+    }
+
+@app.delete("/media/{name:path}")
 def delete_media(name: str, user: dict = Depends(get_current_user)):
+    name = _safe_media_path(name)
     object_name = f"{user['username']}/{name}"
+    hls_dir = _hls_dir(name)
     try:
-        minio.remove_object(BUCKET, object_name)
+        if hls_dir:
+            # Borrar la maestra borra toda la salida HLS (renditions y segmentos)
+            prefix = f"{user['username']}/{hls_dir}"
+            objects = minio.list_objects(BUCKET, prefix=prefix, recursive=True)
+            for err in minio.remove_objects(BUCKET, (DeleteObject(o.object_name) for o in objects)):
+                raise HTTPException(status_code=500, detail=str(err))
+            _forget_stat(prefix=prefix)
+        else:
+            minio.remove_object(BUCKET, object_name)
+            _forget_stat(object_name)
+        _invalidate_listing(user["username"])
         API_DELETES.inc()
         return {"ok": True}
     except S3Error as e:
         raise HTTPException(status_code=404, detail=str(e))
 
+# =========================
+# Subida multipart reanudable
+# =========================
+# upload:<id> -> HASH de la sesión (campos JSON), upload:<id>:parts -> HASH nº parte -> ETag.
+# uploads:active (ZSET id -> última actividad) alimenta la limpieza de sesiones abandonadas;
+# uploads:user:<u> (HASH huella -> id) permite retomar tras una reconexión.
+UPLOAD_PREFIX = "upload:"
+UPLOADS_ACTIVE_KEY = "uploads:active"
+UPLOADS_USER_PREFIX = "uploads:user:"
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", str(8 * 1024 * 1024)))  # S3: mínimo 5 MiB
+UPLOAD_MAX_PARTS = 10000
+UPLOAD_STALE_SECONDS = int(os.getenv("UPLOAD_STALE_SECONDS", str(24 * 3600)))
+UPLOAD_SWEEP_INTERVAL = 300
+
+class UploadInitReq(BaseModel):
+    filename: str
+    size: int
+    content_type: Optional[str] = None
+    # Huella del archivo en el cliente (nombre, tamaño, fecha): misma huella = retomar
+    fingerprint: Optional[str] = None
+
+def _upload_key(upload_id: str) -> str:
+    return f"{UPLOAD_PREFIX}{upload_id}"
+
+def _upload_parts(upload_id: str, session: Optional[Dict] = None) -> Dict[int, str]:
+    """Partes subidas -> ETag. En modo directo las partes no pasan por la API: se listan en MinIO."""
+    if session and session.get("direct"):
+        parts: Dict[int, str] = {}
+        marker = 0
+        while True:
+            result = minio._list_parts(BUCKET, session["object"], session["s3_upload_id"],
+                                       part_number_marker=str(marker))
+            parts.update({p.part_number: p.etag for p in result.parts})
+            if not result.is_truncated:
+                return parts
+            marker = result.next_part_number_marker
+    return {int(_decode(k)): _decode(v) for k, v in r.hgetall(f"{_upload_key(upload_id)}:parts").items()}
+
+def _load_upload(upload_id: str, user: dict) -> Dict:
+    session = _decode_job_hash(r.hgetall(_upload_key(upload_id)))
+    if not session or session.get("owner") != user["username"]:
+        raise HTTPException(status_code=404, detail="Subida no encontrada")
+    return session
+
+def _part_length(session: Dict, part_number: int) -> int:
+    part_size, size = session["part_size"], session["size"]
+    return min(part_size, size - (part_number - 1) * part_size)
+
+def _upload_state(upload_id: str, session: Dict) -> Dict:
+    return {
+        "upload_id": upload_id,
+        "name": session["filename"],
+        "size": session["size"],
+        "part_size": session["part_size"],
+        "part_count": session["part_count"],
+        "uploaded_parts": sorted(_upload_parts(upload_id, session)),
+        "direct": bool(session.get("direct")),
+    }
+
+def _drop_upload(upload_id: str, session: Dict):
+    pipe = r.pipeline()
+    pipe.delete(_upload_key(upload_id), f"{_upload_key(upload_id)}:parts")
+    pipe.zrem(UPLOADS_ACTIVE_KEY, upload_id)
+    if session.get("fingerprint"):
+        pipe.hdel(f"{UPLOADS_USER_PREFIX}{session['owner']}", session["fingerprint"])
+    pipe.execute()
+
+@app.post("/uploads")
+def upload_init(req: UploadInitReq, user: dict = Depends(get_current_user)):
+    """
+    Abre (o retoma) una subida multipart de S3. El cliente manda las partes
+    en paralelo con PUT /uploads/<id>/parts/<n> y cierra con /complete.
+    """
+    filename = _sanitize_filename(req.filename)
+    if req.size <= 0:
+        raise HTTPException(status_code=400, detail="Tamaño inválido")
+    # Antes del primer byte: aquí es donde frenar una subida grande sale barato
+    _admit("upload", jobs=0, drain_factor=ADMISSION_UPLOAD_DRAIN_FACTOR)
+    owner = user["username"]
+
+    if req.fingerprint:
+        existing = _decode(r.hget(f"{UPLOADS_USER_PREFIX}{owner}", req.fingerprint))
+        if existing:
+            session = _decode_job_hash(r.hgetall(_upload_key(existing)))
+            if session and session["filename"] == filename and session["size"] == req.size:
+                r.zadd(UPLOADS_ACTIVE_KEY, {existing: time.time()})
+                return {"ok": True, "resumed": True, **_upload_state(existing, session)}
+
+    # Partes de al menos UPLOAD_PART_SIZE y nunca más de 10000 (límite de S3)
+    mib = 1024 * 1024
+    part_size = max(UPLOAD_PART_SIZE, -(-req.size // UPLOAD_MAX_PARTS))
+    part_size = -(-part_size // mib) * mib
+    object_name = f"{owner}/{filename}"
+    content_type = req.content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    try:
+        s3_upload_id = minio._create_multipart_upload(BUCKET, object_name, {"Content-Type": content_type})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    upload_id = secrets.token_urlsafe(16)
+    now = datetime.utcnow().isoformat()
+    session = {
+        "owner": owner,
+        "filename": filename,
+        "object": object_name,
+        "s3_upload_id": s3_upload_id,
+        "size": req.size,
+        "part_size": part_size,
+        "part_count": -(-req.size // part_size),
+        "content_type": content_type,
+        "fingerprint": req.fingerprint or "",
+        "created_at": now,
+        # Modo directo: el cliente pide una URL por parte y sube a MinIO sin pasar por aquí
+        "direct": DIRECT_TRANSFER,
+    }
+    pipe = r.pipeline()
+    pipe.hset(_upload_key(upload_id), mapping=_encode_job_fields(session))
+    pipe.zadd(UPLOADS_ACTIVE_KEY, {upload_id: time.time()})
+    if req.fingerprint:
+        pipe.hset(f"{UPLOADS_USER_PREFIX}{owner}", req.fingerprint, upload_id)
+    pipe.execute()
+    return {"ok": True, "resumed": False, **_upload_state(upload_id, session)}
+
+@app.get("/uploads/{upload_id}")
+def upload_status(upload_id: str, user: dict = Depends(get_current_user)):
+    session = _load_upload(upload_id, user)
+    return _upload_state(upload_id, session)
+
+@app.put("/uploads/{upload_id}/parts/{part_number}")
+async def upload_part(upload_id: str, part_number: int, request: Request,
+                      user: dict = Depends(get_current_user)):
+    """Recibe una parte (cuerpo crudo, tamaño exacto) y la pasa directo a MinIO."""
+    session = _load_upload(upload_id, user)
+    if session.get("direct"):
+        raise HTTPException(status_code=409, detail="Subida directa: usa /parts/<n>/url")
+    if not 1 <= part_number <= session["part_count"]:
+        raise HTTPException(status_code=400, detail="Número de parte fuera de rango")
+    expected = _part_length(session, part_number)
+
+    # Se lee como mucho una parte; nada de spool a disco. El cupo se toma
+    # antes de leer el cuerpo para no acumular partes en memoria.
+    with _UploadSlot("upload_part"):
+        chunks, received = [], 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > expected:
+                raise HTTPException(status_code=400, detail=f"La parte {part_number} debe medir {expected} bytes")
+            chunks.append(chunk)
+        if received != expected:
+            raise HTTPException(status_code=400, detail=f"La parte {part_number} debe medir {expected} bytes")
+
+        try:
+            etag = await run_in_threadpool(
+                minio._upload_part, BUCKET, session["object"], b"".join(chunks), None,
+                session["s3_upload_id"], part_number,
+            )
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=str(e))
+
+    pipe = r.pipeline()
+    pipe.hset(f"{_upload_key(upload_id)}:parts", part_number, etag)
+    pipe.zadd(UPLOADS_ACTIVE_KEY, {upload_id: time.time()})
+    pipe.execute()
+    return {"ok": True, "part_number": part_number, "etag": etag}
+
+@app.get("/uploads/{upload_id}/parts/{part_number}/url")
+def upload_part_url(upload_id: str, part_number: int, user: dict = Depends(get_current_user)):
+    """Modo directo: URL prefirmada para subir la parte <part_number> a MinIO."""
+    session = _load_upload(upload_id, user)
+    if not session.get("direct"):
+        raise HTTPException(status_code=409, detail="Esta subida no es directa")
+    if not 1 <= part_number <= session["part_count"]:
+        raise HTTPException(status_code=400, detail="Número de parte fuera de rango")
+    r.zadd(UPLOADS_ACTIVE_KEY, {upload_id: time.time()})
+    url = _presign("PUT", session["object"], "upload_part", extra_query_params={
+        "uploadId": session["s3_upload_id"], "partNumber": str(part_number),
+    })
+    return {"url": url, "method": "PUT", "expires_in": PRESIGN_TTL,
+            "length": _part_length(session, part_number)}
+
+@app.post("/uploads/{upload_id}/complete")
+def upload_complete(upload_id: str, user: dict = Depends(get_current_user)):
+    session = _load_upload(upload_id, user)
+    parts = _upload_parts(upload_id, session)
+    missing = [n for n in range(1, session["part_count"] + 1) if n not in parts]
+    if missing:
+        raise HTTPException(status_code=409, detail={"message": "Faltan partes", "missing_parts": missing[:100]})
+    try:
+        minio._complete_multipart_upload(
+            BUCKET, session["object"], session["s3_upload_id"],
+            [Part(n, parts[n]) for n in sorted(parts)],
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    _drop_upload(upload_id, session)
+    _forget_stat(session["object"])
+    _invalidate_listing(session["owner"])
+    API_UPLOADS.inc()
+    return {"ok": True, "name": session["filename"]}
+
+@app.delete("/uploads/{upload_id}")
+def upload_abort(upload_id: str, user: dict = Depends(get_current_user)):
+    session = _load_upload(upload_id, user)
+    _abort_upload(upload_id, session)
+    return {"ok": True}
+
+def _abort_upload(upload_id: str, session: Dict):
+    try:
+        minio._abort_multipart_upload(BUCKET, session["object"], session["s3_upload_id"])
+    except S3Error as e:
+        if e.code != "NoSuchUpload":
+            raise
+    _drop_upload(upload_id, session)
+
+def _sweep_stale_uploads():
+    """Hilo: aborta en MinIO las subidas sin actividad en UPLOAD_STALE_SECONDS."""
+    while True:
+        time.sleep(UPLOAD_SWEEP_INTERVAL)
+        try:
+            # Un solo barrido por intervalo entre todas las réplicas
+            if not r.set("uploads:sweep:lock", "1", nx=True, ex=UPLOAD_SWEEP_INTERVAL):
+                continue
+            stale = r.zrangebyscore(UPLOADS_ACTIVE_KEY, "-inf", time.time() - UPLOAD_STALE_SECONDS, start=0, num=100)
+            for upload_id in stale:
+                upload_id = _decode(upload_id)
+                session = _decode_job_hash(r.hgetall(_upload_key(upload_id)))
+                if not session:
+                    r.zrem(UPLOADS_ACTIVE_KEY, upload_id)
+                    continue
+                _abort_upload(upload_id, session)
+                print(f"🧹 Subida abandonada abortada: {session['object']} ({upload_id})")
+        except Exception as e:
+            print(f"⚠️  Limpieza de subidas: {e}")
+
+@app.on_event("startup")
+def start_upload_sweeper():
+    threading.Thread(target=_sweep_stale_uploads, name="upload-sweeper", daemon=True).start()
+
 # =========================
 # Compartir por token (Opción 3)
 # =========================
@@ -326,42 +1303,403 @@ def _load_json(value) -> Optional[dict]:
     except Exception:
         return None
 
-def _save_job(job: Dict):
-    r.set(_job_key(job["job_id"]), json.dumps(job).encode())
+# Convierte un job legado (string JSON) a HASH de campos JSON, de forma atómica
+MIGRATE_JOB_SCRIPT = r.register_script("""
+local key = KEYS[1]
+if redis.call('TYPE', key).ok ~= 'string' then return 0 end
+local ok, job = pcall(cjson.decode, redis.call('GET', key))
+if not ok or type(job) ~= 'table' then return -1 end
+redis.call('DEL', key)
+for k, v in pairs(job) do redis.call('HSET', key, k, cjson.encode(v)) end
+return 1
+""")
+
+def _encode_job_fields(fields: Dict) -> Dict[str, bytes]:
+    return {k: json.dumps(v).encode() for k, v in fields.items()}
+
+def _decode_job_hash(raw: Dict) -> Optional[Dict]:
+    if not raw:
+        return None
+    job = {}
+    for k, v in raw.items():
+        try:
+            job[_decode(k)] = json.loads(_decode(v))
+        except ValueError:
+            job[_decode(k)] = _decode(v)
+    return job
 
-def _list_jobs(owner: Optional[str] = None) -> List[Dict]:
-    jobs: List[Dict] = []
-    for key in r.scan_iter(f"{JOB_STATUS_PREFIX}*"):
-        raw_job = r.get(key)
-        job = _load_json(raw_job)
+def _load_job(job_id: str) -> Optional[Dict]:
+    key = _job_key(job_id)
+    try:
+        raw = r.hgetall(key)
+    except redis.ResponseError:
+        # WRONGTYPE: registro legado todavía en JSON
+        MIGRATE_JOB_SCRIPT(keys=[key])
+        raw = r.hgetall(key)
+    job = _decode_job_hash(raw)
+    if job:
+        job.setdefault("job_id", job_id)
+    return job
+
+def _ensure_job_storage():
+    """Migración única de los jobs guardados como string JSON a HASH."""
+    if _decode(r.get(JOBS_STORAGE_VERSION_KEY)) == JOBS_STORAGE_VERSION:
+        return
+    count = 0
+    for key in r.scan_iter(f"{JOB_STATUS_PREFIX}*", count=1000, _type="string"):
+        if MIGRATE_JOB_SCRIPT(keys=[key]) == 1:
+            count += 1
+    r.set(JOBS_STORAGE_VERSION_KEY, JOBS_STORAGE_VERSION)
+    print(f"🗂️  Jobs migrados a HASH: {count}")
+
+def _job_index_key(owner: Optional[str] = None, status: Optional[str] = None) -> str:
+    if owner and status:
+        return f"{JOBS_INDEX_PREFIX}owner:{owner}:status:{status}"
+    if owner:
+        return f"{JOBS_INDEX_PREFIX}owner:{owner}"
+    if status:
+        return f"{JOBS_INDEX_PREFIX}status:{status}"
+    return f"{JOBS_INDEX_PREFIX}all"
+
+def _job_score(job: Dict) -> float:
+    """created_at (ISO, UTC naive) -> epoch, usado como score en los índices."""
+    try:
+        dt = datetime.fromisoformat(job.get("created_at", ""))
+    except (TypeError, ValueError):
+        return 0.0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def _index_job(pipe, job: Dict):
+    """Registra el job en todos sus índices (dentro de un pipeline)."""
+    job_id = job["job_id"]
+    owner = job.get("owner")
+    status = job.get("status", "pending")
+    score = _job_score(job)
+    pipe.zadd(_job_index_key(), {job_id: score})
+    pipe.zadd(_job_index_key(status=status), {job_id: score})
+    if owner:
+        pipe.zadd(_job_index_key(owner=owner), {job_id: score})
+        pipe.zadd(_job_index_key(owner=owner, status=status), {job_id: score})
+
+def _job_counters_key(owner: Optional[str] = None) -> str:
+    return f"{JOBS_COUNTERS_PREFIX}user:{owner}" if owner else f"{JOBS_COUNTERS_PREFIX}global"
+
+def _count_new_job(pipe, job: Dict):
+    status = job.get("status", "pending")
+    keys = [_job_counters_key()]
+    if job.get("owner"):
+        keys.append(_job_counters_key(job["owner"]))
+    for key in keys:
+        pipe.hincrby(key, status, 1)
+        pipe.hincrby(key, "total", 1)
+
+def _save_job(job: Dict, pipe=None):
+    """Guarda un job nuevo con sus índices y contadores (MULTI/EXEC)."""
+    own_pipe = pipe is None
+    if own_pipe:
+        pipe = r.pipeline()
+    pipe.hset(_job_key(job["job_id"]), mapping=_encode_job_fields(job))
+    _index_job(pipe, job)
+    _count_new_job(pipe, job)
+    pipe.publish(EVENTS_JOBS_CHANNEL, json.dumps({
+        "job_id": job["job_id"], "owner": job.get("owner"), "status": job.get("status"), "fields": job,
+    }))
+    if own_pipe:
+        pipe.execute()
+
+def _read_counters(owner: Optional[str] = None) -> Dict[str, int]:
+    raw = r.hgetall(_job_counters_key(owner))
+    counters = {_decode(k): max(0, int(v)) for k, v in raw.items()}
+    return {s: counters.get(s, 0) for s in (*JOB_STATUSES, "total")}
+
+def _ensure_job_counters():
+    """
+    Migración única: siembra los contadores a partir de los índices (ZCARD),
+    para instalaciones que ya tenían jobs antes de los contadores.
+    """
+    if _decode(r.get(JOBS_COUNTERS_VERSION_KEY)) == JOBS_COUNTERS_VERSION:
+        return
+    pipe = r.pipeline()
+    global_key = _job_counters_key()
+    pipe.delete(global_key)
+    status_counts = {status: r.zcard(_job_index_key(status=status)) for status in JOB_STATUSES}
+    for status, count in status_counts.items():
+        pipe.hset(global_key, status, count)
+    pipe.hset(global_key, "total", r.zcard(_job_index_key()))
+    pipe.hsetnx(WORKERS_COUNTERS_KEY, "conversions_success", status_counts["completed"])
+    pipe.hsetnx(WORKERS_COUNTERS_KEY, "conversions_failed", status_counts["failed"])
+
+    owner_re = re.compile(rf"^{re.escape(JOBS_INDEX_PREFIX)}owner:([^:]+)(?::status:(\w+))?$")
+    seen = set()
+    for key in r.scan_iter(f"{JOBS_INDEX_PREFIX}owner:*", count=1000):
+        m = owner_re.match(_decode(key))
+        if not m:
+            continue
+        owner, status = m.groups()
+        if owner not in seen:
+            pipe.delete(_job_counters_key(owner))
+            seen.add(owner)
+        pipe.hset(_job_counters_key(owner), status or "total", r.zcard(key))
+    pipe.set(JOBS_COUNTERS_VERSION_KEY, JOBS_COUNTERS_VERSION)
+    pipe.execute()
+
+def _ensure_job_indexes():
+    """
+    Migración única: indexa los jobs que existían antes de los índices.
+    Solo recorre job:status:* si la marca de versión no está presente.
+    """
+    if _decode(r.get(JOBS_INDEX_VERSION_KEY)) == JOBS_INDEX_VERSION:
+        return
+    pipe = r.pipeline(transaction=False)
+    count = 0
+    for key in r.scan_iter(f"{JOB_STATUS_PREFIX}*", count=1000):
+        job = _load_job(_decode(key)[len(JOB_STATUS_PREFIX):])
         if not job:
             continue
-        job.setdefault("job_id", _decode(key).split(":")[-1])
-        if owner and job.get("owner") != owner:
+        _index_job(pipe, job)
+        count += 1
+        if count % 1000 == 0:
+            pipe.execute()
+    pipe.set(JOBS_INDEX_VERSION_KEY, JOBS_INDEX_VERSION)
+    pipe.execute()
+    print(f"🗂️  Índices de jobs reconstruidos: {count} jobs")
+
+def _list_jobs(owner: Optional[str] = None, status: Optional[str] = None,
+               limit: int = MAX_JOB_RESULTS, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Devuelve hasta <limit> jobs (más recientes primero) usando el índice
+    adecuado y un pipeline de HGETALL. <cursor> es el job_id del último elemento de la
+    página anterior; devuelve también el cursor de la página siguiente.
+    """
+    index_key = _job_index_key(owner=owner, status=status or None)
+
+    start = 0
+    if cursor:
+        rank = r.zrevrank(index_key, cursor)
+        if rank is not None:
+            start = rank + 1
+        else:
+            # El job del cursor cambió de índice (p. ej. de estado): seguimos por score
+            score = r.zscore(_job_index_key(), cursor)
+            if score is None:
+                return [], None
+            ids = r.zrevrangebyscore(index_key, f"({score}", "-inf", start=0, num=limit + 1)
+            return _fetch_jobs(index_key, ids, limit)
+
+    ids = r.zrevrange(index_key, start, start + limit)
+    return _fetch_jobs(index_key, ids, limit)
+
+def _fetch_jobs(index_key: str, ids: List[bytes], limit: int) -> Tuple[List[Dict], Optional[str]]:
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    if not ids:
+        return [], None
+
+    pipe = r.pipeline(transaction=False)
+    for job_id in ids:
+        pipe.hgetall(_job_key(_decode(job_id)))
+    raws = pipe.execute(raise_on_error=False)
+
+    jobs: List[Dict] = []
+    stale: List[bytes] = []
+    for job_id, raw_job in zip(ids, raws):
+        if isinstance(raw_job, redis.ResponseError):
+            job = _load_job(_decode(job_id))  # legado: se migra al vuelo
+        else:
+            job = _decode_job_hash(raw_job)
+        if not job:
+            stale.append(job_id)
             continue
+        job.setdefault("job_id", _decode(job_id))
         jobs.append(job)
-    return jobs
+
+    if stale:
+        # Jobs borrados o expirados: se limpian del índice de forma perezosa
+        r.zrem(index_key, *stale)
+
+    next_cursor = _decode(ids[-1]) if has_more else None
+    return jobs, next_cursor
 
 def _list_workers() -> List[Dict]:
+    """Workers con heartbeat reciente: ZRANGEBYSCORE sobre el registro + un MGET."""
+    now = time.time()
+    ids = r.zrangebyscore(WORKERS_REGISTRY_KEY, now - WORKER_STATUS_TTL, "+inf")
+    if not ids:
+        return []
     workers: List[Dict] = []
-    for key in r.scan_iter(f"{WORKER_STATUS_PREFIX}*"):
-        data = _load_json(r.get(key))
+    for worker_id, raw in zip(ids, r.mget([f"{WORKER_STATUS_PREFIX}{_decode(i)}" for i in ids])):
+        data = _load_json(raw)
         if not data:
             continue
-        data.setdefault("worker_id", _decode(key).split(":")[-1])
+        data.setdefault("worker_id", _decode(worker_id))
         workers.append(data)
     return workers
 
-def _select_worker() -> Optional[str]:
+def _queue_depth() -> int:
+    """Jobs esperando en la cola general más las colas privadas de los workers."""
+    worker_ids = r.zrange(WORKERS_REGISTRY_KEY, 0, -1)
+    if QUEUE_BACKEND == "streams":
+        # Las entradas confirmadas se borran: XLEN - pendientes (en curso) = sin entregar
+        streams = [JOBS_STREAM] + [f"{JOBS_STREAM}:{_decode(w)}" for w in worker_ids]
+        pipe = r.pipeline(transaction=False)
+        for stream in streams:
+            pipe.xlen(stream)
+            pipe.xpending(stream, STREAM_GROUP)
+        results = pipe.execute(raise_on_error=False)
+        depth = 0
+        for length, pending in zip(results[::2], results[1::2]):
+            if isinstance(length, int):
+                in_flight = pending.get("pending", 0) if isinstance(pending, dict) else 0
+                depth += max(0, length - in_flight)
+        QUEUE_LEN.set(depth)
+        return depth
+    pipe = r.pipeline(transaction=False)
+    pipe.llen(JOBS_QUEUE)
+    for worker_id in worker_ids:
+        pipe.llen(f"{JOBS_QUEUE}:{_decode(worker_id)}")
+    depth = sum(pipe.execute())
+    if SCHEDULING_MODE == "fair":
+        depth += _fair_depth()
+    QUEUE_LEN.set(depth)
+    return depth
+
+def _input_kind(filename: str) -> str:
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return "video" if ext in VIDEO_FORMATS or ext == "flv" else "audio"
+
+def _estimate_cost(input_kind: str, output_format: str, size_bytes: int,
+                   rates: Optional[Dict] = None) -> float:
+    """
+    Segundos estimados de conversión según el historial de jobs parecidos.
+    <rates> memoriza las tasas leídas (un lote no relee la misma clave).
+    """
+    key = f"{SCHED_COST_PREFIX}{input_kind}:{output_format}"
+    if rates is not None and key in rates:
+        rate = rates[key]
+    else:
+        rate = r.hget(key, "sec_per_mb")
+        if rates is not None:
+            rates[key] = rate
+    sec_per_mb = float(rate) if rate else DEFAULT_SEC_PER_MB[input_kind]
+    return round(JOB_OVERHEAD_SECONDS + sec_per_mb * size_bytes / (1024 * 1024), 2)
+
+def _select_worker(cost: float = 0.0) -> Optional[str]:
+    """
+    Elige el worker con menor tiempo estimado de finalización:
+    backlog pendiente (segundos) repartido entre sus slots + costo del job.
+    El backlog se actualiza al asignar, así que una ráfaga se reparte sola.
+    """
+    return _pick_worker(_worker_loads(), cost)
+
+def _worker_loads() -> List[Dict]:
+    """Workers vivos con su backlog actual (segundos) en "backlog"."""
     workers = _list_workers()
+    if not workers:
+        return []
+    backlogs = r.hmget(SCHED_BACKLOG_KEY, [w["worker_id"] for w in workers])
+    for w, backlog in zip(workers, backlogs):
+        w["backlog"] = max(0.0, float(backlog or 0))
+    return workers
+
+def _pick_worker(workers: List[Dict], cost: float) -> Optional[str]:
+    """
+    Elige sobre una foto de _worker_loads() y le suma el costo al elegido,
+    así varias elecciones seguidas (un lote) se reparten sin releer Redis.
+    """
     if not workers:
         return None
-    workers.sort(key=lambda w: (w.get("jobs_in_progress", 0), w.get("cpu_load", 1.0)))
-    return workers[0].get("worker_id")
 
-def _enqueue_job(job_id: str, worker_id: Optional[str]):
+    def completion_time(w):
+        slots = max(1, w.get("slots_total", 1))
+        return (w["backlog"] / slots + cost, w.get("cpu_load", 1.0))
+
+    best = min(workers, key=completion_time)
+    best["backlog"] += cost
+    return best.get("worker_id")
+
+# Encola al final del flujo; si el flujo estaba vacío entra con etiqueta
+# max(reloj virtual, última servida) + costo. Un aviso por job despierta workers.
+FAIR_PUSH = r.register_script("""
+local len = redis.call('RPUSH', KEYS[2], ARGV[2] .. '|' .. ARGV[3])
+if len == 1 then
+  local v = tonumber(redis.call('GET', KEYS[4]) or '0')
+  local last = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+  redis.call('ZADD', KEYS[1], math.max(v, last) + tonumber(ARGV[3]), ARGV[1])
+end
+redis.call('RPUSH', KEYS[5], '1')
+redis.call('LTRIM', KEYS[5], -tonumber(ARGV[4]), -1)
+return len
+""")
+
+def _priority(value: Optional[str], default: str = DEFAULT_PRIORITY) -> str:
+    priority = (value or default).strip().lower()
+    if priority not in PRIORITY_WEIGHTS:
+        raise HTTPException(status_code=400, detail=f"priority debe ser una de {sorted(PRIORITY_WEIGHTS)}")
+    return priority
+
+def _fair_enqueue(job: Dict, pipe=None):
+    flow = f"{job['priority']}:{job['owner']}"
+    vcost = max(1.0, float(job.get("estimated_cost_seconds") or 0)) / PRIORITY_WEIGHTS[job["priority"]]
+    FAIR_PUSH(keys=[FAIR_FLOWS_KEY, f"{FAIR_QUEUE_PREFIX}{flow}", FAIR_FINISH_KEY, FAIR_VCLOCK_KEY, FAIR_SIGNAL_KEY],
+              args=[flow, job["job_id"], round(vcost, 4), FAIR_SIGNAL_MAX], client=pipe if pipe is not None else r)
+
+def _fair_depth() -> int:
+    flows = r.zrange(FAIR_FLOWS_KEY, 0, -1)
+    if not flows:
+        return 0
+    pipe = r.pipeline(transaction=False)
+    for flow in flows:
+        pipe.llen(f"{FAIR_QUEUE_PREFIX}{_decode(flow)}")
+    return sum(pipe.execute())
+
+def _fair_preview(owner: str, capacity: int, max_jobs: int = 20) -> Tuple[List[Dict], int]:
+    """
+    Simula el orden WFQ de lo pendiente y devuelve los próximos jobs de
+    <owner> con su posición y espera estimada (trabajo por delante / slots),
+    más el total pendiente en las colas justas. Aproximado: no cuenta lo que ya está en curso ni
+    el límite de concurrencia por usuario.
+    """
+    flows = r.zrange(FAIR_FLOWS_KEY, 0, -1, withscores=True)
+    if not flows:
+        return [], 0
+    pipe = r.pipeline(transaction=False)
+    for flow, _ in flows:
+        pipe.lrange(f"{FAIR_QUEUE_PREFIX}{_decode(flow)}", 0, FAIR_PREVIEW_LIMIT - 1)
+    queues = []
+    for (flow, tag), entries in zip(flows, pipe.execute()):
+        flow = _decode(flow)
+        priority, _, flow_owner = flow.partition(":")
+        parsed = []
+        for entry in entries:
+            job_id, _, vcost = _decode(entry).partition("|")
+            parsed.append((job_id, float(vcost or 0)))
+        queues.append((priority, flow_owner, parsed))
+    heap = [(tag, i, 0) for i, (_, tag) in enumerate(flows) if queues[i][2]]
+    heapq.heapify(heap)
+    ahead, position, mine = 0.0, 0, []
+    while heap and position < FAIR_PREVIEW_LIMIT and len(mine) < max_jobs:
+        tag, i, k = heapq.heappop(heap)
+        priority, flow_owner, entries = queues[i]
+        job_id, vcost = entries[k]
+        position += 1
+        if flow_owner == owner:
+            mine.append({"job_id": job_id, "priority": priority, "position": position,
+                         "expected_wait_seconds": round(ahead / max(1, capacity), 1)})
+        ahead += vcost * PRIORITY_WEIGHTS.get(priority, 1.0)
+        if k + 1 < len(entries):
+            heapq.heappush(heap, (tag + entries[k + 1][1], i, k + 1))
+    return mine, sum(len(entries) for _, _, entries in queues)
+
+def _enqueue_job(job_id: str, worker_id: Optional[str], pipe=None):
+    client = pipe if pipe is not None else r
+    if QUEUE_BACKEND == "streams":
+        stream = JOBS_STREAM if not worker_id else f"{JOBS_STREAM}:{worker_id}"
+        client.xadd(stream, {"job_id": job_id})
+        return
     queue_key = JOBS_QUEUE if not worker_id else f"{JOBS_QUEUE}:{worker_id}"
-    r.rpush(queue_key, job_id)
+    client.rpush(queue_key, job_id)
 
 def get_optional_user(authorization: Optional[str] = Header(default=None)) -> Optional[dict]:
     if not authorization:
@@ -369,16 +1707,10 @@ def get_optional_user(authorization: Optional[str] = Header(default=None)) -> Op
     scheme, _, token = authorization.partition(" ")
     if scheme.lower() != "bearer" or not token:
         return None
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if not username or not user_exists(username):
-            return None
-        return {"username": username}
-    except JWTError:
-        return None
+    username = _authenticate_token(token)
+    return {"username": username} if username else None
 
-@app.post("/share/{name}")
+@app.post("/share/{name:path}")
 def share_create(
     name: str,
     minutes: int = 60,
@@ -390,6 +1722,7 @@ def share_create(
     Devuelve una URL pública en esta API: /s/<token>
     """
     REQUESTS.inc()
+    name = _safe_media_path(name)
     object_name = f"{user['username']}/{name}"
 
     # 1) Verifica que exista
@@ -402,21 +1735,30 @@ def share_create(
     ttl = max(60, min(60 * minutes, 60 * 60 * 24 * 7))  # entre 1 min y 7 días
     token = secrets.token_urlsafe(24)
 
-    mime, _ = mimetypes.guess_type(name)
-    if mime is None:
-        mime = "application/octet-stream"
-
-    payload = {"object": object_name, "filename": name, "mime": mime}
+    payload = {"object": object_name, "filename": name, "mime": _media_mime(name)}
+    hls_dir = _hls_dir(name)
+    if hls_dir:
+        # HLS: el token da acceso a todo el directorio (renditions y segmentos)
+        payload["prefix"] = f"{user['username']}/{hls_dir}"
     r.setex(_share_key(token), ttl, json.dumps(payload).encode())
 
     # 3) Link absoluto usando SIEMPRE PUBLIC_BASE_URL
     base = PUBLIC_BASE_URL.rstrip("/")
     url = f"{base}/s/{token}"
+    if hls_dir:
+        # Las URLs relativas de las playlists se resuelven contra /s/<token>/
+        url = f"{url}/{HLS_MASTER}"
 
     return {"url": url, "expires_in_min": ttl // 60}
 
+def _share_cache_control(token: str) -> str:
+    """Público (sirve a la CDN) pero sin sobrevivir al vencimiento del token."""
+    remaining = r.ttl(_share_key(token))
+    max_age = max(0, min(SHARE_MAX_AGE, remaining if remaining and remaining > 0 else 0))
+    return f"public, max-age={max_age}"
+
 @app.get("/s/{token}")
-def share_resolve(token: str):
+def share_resolve(token: str, request: Request):
     """
     Público. No requiere auth.
     Lee token en Redis y **sirve** el archivo desde MinIO (proxy).
@@ -434,28 +1776,55 @@ def share_resolve(token: str):
     except Exception:
         raise HTTPException(status_code=500, detail="bad_token_payload")
 
+    if meta.get("prefix"):
+        return RedirectResponse(f"/s/{token}/{HLS_MASTER}", status_code=307)
+
     try:
-        resp = minio.get_object(BUCKET, object_name)
-    except Exception as e:
+        st = _stat_object(object_name)
+    except Exception:
         raise HTTPException(status_code=404, detail=f"not_found: {object_name}")
 
+    if DIRECT_TRANSFER:
+        # Redirige a MinIO; la URL no sobrevive al token
+        remaining = r.ttl(_share_key(token))
+        url = _presign("GET", object_name, "share", expires=min(PRESIGN_TTL, remaining if remaining > 0 else 1),
+                       response_headers={
+                           "response-content-type": mime,
+                           "response-content-disposition": f'inline; filename="{filename}"',
+                       })
+        return RedirectResponse(url, status_code=307, headers={"Cache-Control": "no-store"})
+
     headers = {
-        "Content-Type": mime,
         "Content-Disposition": f'inline; filename="{filename}"',
         # Permitir que <audio>/<video> en otros orígenes lo consuman sin lío
         "Access-Control-Allow-Origin": "*",
+        "Cache-Control": _share_cache_control(token),
     }
+    return _serve_object(request, object_name, st, mime, headers)
 
-    def it():
-        try:
-            while True:
-                chunk = resp.read(1024 * 1024)
-                if not chunk: break
-                yield chunk
-        finally:
-            resp.close(); resp.release_conn()
+@app.get("/s/{token}/{path:path}")
+def share_resolve_hls(token: str, path: str, request: Request):
+    """
+    Público. Playlists y segmentos de una salida HLS compartida; <path> es
+    relativo al directorio HLS (master.m3u8, 720p/index.m3u8, 720p/<seg>.ts).
+    """
+    data = r.get(_share_key(token))
+    if not data:
+        raise HTTPException(status_code=404, detail="invalid_or_expired_token")
+    try:
+        prefix = json.loads(data.decode())["prefix"]
+    except Exception:
+        raise HTTPException(status_code=404, detail="not_found")
+
+    path = _safe_media_path(path)
+    object_name = f"{prefix}{path}"
+    try:
+        st = _stat_object(object_name)
+    except Exception:
+        raise HTTPException(status_code=404, detail=f"not_found: {path}")
 
-    return StreamingResponse(it(), headers=headers, media_type=mime)
+    headers = {"Access-Control-Allow-Origin": "*", **_hls_cache_headers(path, public=True)}
+    return _serve_object(request, object_name, st, _media_mime(path), headers)
 
 # =========================
 # Conversión y monitoreo
@@ -467,40 +1836,409 @@ def _sanitize_filename(name: str) -> str:
         raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
     return name
 
-@app.post("/convert")
-def request_conversion(req: ConvertRequest, user: dict = Depends(get_current_user)):
-    filename = _sanitize_filename(req.input_file)
-    output_format = (req.output_format or "").lower()
-    if output_format not in ALLOWED_FORMATS:
-        raise HTTPException(status_code=400, detail="Formato de salida no soportado")
+def _output_name(filename: str, output_format: str) -> str:
+    """Mismo nombre de salida que usa el worker: <stem>_converted.<fmt> o <stem>_hls/master.m3u8"""
+    stem = Path(filename).stem or "output"
+    if output_format in ADAPTIVE_FORMATS:
+        return f"{stem}{HLS_DIR_SUFFIX}/{HLS_MASTER}"
+    return f"{stem}_converted.{output_format}"
+
+def _conversion_cache_key(etag: Optional[str], output_format: str, options: Optional[Dict],
+                          encoder: Optional[str] = None) -> Optional[str]:
+    """Clave de caché; None si no hay ETag o ningún worker publicó su versión de encoder."""
+    if output_format in ADAPTIVE_FORMATS:
+        return None  # salida de muchos objetos: no cabe en una entrada de caché
+    if encoder is None:
+        encoder = _decode(r.get(CONV_CACHE_ENCODER_KEY))
+    if not CONVERSION_CACHE_ENABLED or not etag or not encoder:
+        return None
+    normalized = json.dumps(
+        {str(k).lower(): str(v).strip().lower() for k, v in (options or {}).items() if v is not None},
+        sort_keys=True,
+    )
+    return hashlib.sha256(f"{etag}|{output_format}|{normalized}|{encoder}".encode()).hexdigest()
 
-    object_name = f"{user['username']}/{filename}"
+def _conversion_cache_fetch(cache_key: str, target_object: str) -> Optional[int]:
+    """
+    Si hay resultado cacheado lo copia (server-side) a <target_object> y
+    devuelve su tamaño; None si no hay entrada o la copia falla.
+    """
+    cached = _decode(r.hget(f"{CONV_CACHE_ENTRY_PREFIX}{cache_key}", "object"))
+    if not cached:
+        return None
     try:
-        minio.stat_object(BUCKET, object_name)
+        result = minio.copy_object(BUCKET, target_object, CopySource(CACHE_BUCKET, cached))
+        _forget_stat(target_object)
+        _invalidate_listing(target_object.split("/", 1)[0])
+        size = minio.stat_object(BUCKET, result.object_name).size
     except Exception:
-        raise HTTPException(status_code=404, detail="El archivo no existe")
-
-    job_id = secrets.token_hex(12)
+        return None  # desalojada entre la consulta y la copia
+    r.zadd(CONV_CACHE_LRU_KEY, {cache_key: time.time()})
+    return size
+
+def _output_specs(req: ConvertRequest) -> List[Dict]:
+    """Salidas pedidas como [{"format", "options"}], validadas"""
+    if req.outputs:
+        specs = [{"format": (o.format or "").lower(), "options": o.options or {}} for o in req.outputs]
+    elif req.output_format:
+        specs = [{"format": req.output_format.lower(), "options": req.options or {}}]
+    else:
+        raise HTTPException(status_code=400, detail="Falta output_format u outputs")
+
+    formats = [spec["format"] for spec in specs]
+    if any(fmt not in ALLOWED_FORMATS for fmt in formats):
+        raise HTTPException(status_code=400, detail="Formato de salida no soportado")
+    if len(specs) > 1:
+        if len(specs) > MAX_OUTPUTS_PER_JOB:
+            raise HTTPException(status_code=400, detail=f"Máximo {MAX_OUTPUTS_PER_JOB} salidas por job")
+        if len(set(formats)) != len(formats):
+            raise HTTPException(status_code=400, detail="Formatos de salida repetidos")
+        if ADAPTIVE_FORMATS & set(formats):
+            raise HTTPException(status_code=400, detail="HLS no se puede combinar con otras salidas")
+    return specs
+
+def _new_job(owner: str, filename: str, specs: List[Dict], size: int, etag: Optional[str],
+             encoder: Optional[str] = None, rates: Optional[Dict] = None) -> Dict:
+    """Registro de un job pendiente, con costo estimado y clave de caché."""
+    output_format = specs[0]["format"]
+    input_kind = _input_kind(filename)
+    if output_format in ADAPTIVE_FORMATS and input_kind != "video":
+        raise HTTPException(status_code=400, detail="HLS requiere un archivo de video")
+    multi = len(specs) > 1
     job = {
-        "job_id": job_id,
-        "owner": user["username"],
+        "job_id": secrets.token_hex(12),
+        "owner": owner,
         "input_file": filename,
-        "input_object": object_name,
+        "input_object": f"{owner}/{filename}",
         "output_format": output_format,
-        "options": req.options or {},
+        "options": specs[0]["options"],
         "status": "pending",
         "progress": 0,
         "created_at": datetime.utcnow().isoformat(),
+        "input_kind": input_kind,
+        "input_size_bytes": size,
+        "estimated_cost_seconds": round(sum(
+            _estimate_cost(input_kind, spec["format"], size, rates) for spec in specs
+        ), 2),
+        "source_etag": etag,
     }
-
-    worker_id = _select_worker()
+    if multi:
+        # Multi-salida: la caché se consulta en el worker, salida por salida
+        job["outputs"] = [{**spec, "status": "pending"} for spec in specs]
+    else:
+        cache_key = _conversion_cache_key(etag, output_format, specs[0]["options"], encoder)
+        if cache_key:
+            job["cache_key"] = cache_key
+    return job
+
+def _complete_from_cache(job: Dict) -> bool:
+    """Si el resultado ya está en la caché lo copia y deja el job completado, sin worker."""
+    cache_key = job.get("cache_key")
+    if not cache_key:
+        return False
+    output_file = _output_name(job["input_file"], job["output_format"])
+    target_object = f"{job['owner']}/{output_file}"
+    output_size = _conversion_cache_fetch(cache_key, target_object)
+    API_CONV_CACHE.labels(result="hit" if output_size is not None else "miss").inc()
+    if output_size is None:
+        return False
+    size = job["input_size_bytes"]
+    now = datetime.utcnow().isoformat()
+    job.update({
+        "status": "completed",
+        "progress": 100,
+        "cache_hit": True,
+        "output_file": output_file,
+        "output_object": target_object,
+        "started_at": now,
+        "completed_at": now,
+        "duration_seconds": 0,
+        "output_size_bytes": output_size,
+        "size_reduction_percent": round((size - output_size) / size * 100, 2) if size else 0,
+    })
+    return True
+
+def _assign_and_enqueue(job: Dict, worker_id: Optional[str], pipe):
+    """Encola el job (en <pipe>) hacia <worker_id>; el backlog lo suma quien llama."""
+    pipe.incrbyfloat(SCHED_PENDING_COST_KEY, job.get("estimated_cost_seconds") or 0)
+    if SCHEDULING_MODE == "fair":
+        _save_job(job, pipe)
+        _fair_enqueue(job, pipe)
+        return
     if worker_id:
         job["assigned_worker"] = worker_id
+        job["backlog_worker"] = worker_id
+    _save_job(job, pipe)
+    _enqueue_job(job["job_id"], worker_id, pipe)
+
+_admission_cache: Dict[str, object] = {}
+_admission_lock = threading.Lock()
+
+def _admission_snapshot() -> Dict:
+    """Cola, trabajo pendiente y workers vivos; memorizado ADMISSION_SNAPSHOT_TTL s."""
+    now = time.monotonic()
+    with _admission_lock:
+        if _admission_cache.get("expires", 0) > now:
+            return _admission_cache["snapshot"]
+    workers = [w for w in _list_workers() if w.get("status") != "offline"]
+    snapshot = {
+        "depth": _queue_depth(),
+        "pending_cost": max(0.0, float(r.get(SCHED_PENDING_COST_KEY) or 0)),
+        "capacity": sum(max(1, int(w.get("slots_total", 1))) for w in workers),
+        "scratch": [int(w["scratch_free_bytes"]) for w in workers if "scratch_free_bytes" in w],
+    }
+    if snapshot["capacity"]:
+        ADMISSION_DRAIN.set(snapshot["pending_cost"] / snapshot["capacity"])
+    with _admission_lock:
+        _admission_cache.update(snapshot=snapshot, expires=now + ADMISSION_SNAPSHOT_TTL)
+    return snapshot
+
+def _reject(endpoint: str, reason: str, status_code: int, retry_after: float, detail: str):
+    ADMISSION_REJECTED.labels(endpoint=endpoint, reason=reason).inc()
+    retry_after = int(min(ADMISSION_MAX_RETRY_AFTER, max(1, math.ceil(retry_after))))
+    raise HTTPException(status_code=status_code, detail={"message": detail, "reason": reason,
+                                                          "retry_after": retry_after},
+                        headers={"Retry-After": str(retry_after)})
+
+def _admit(endpoint: str, jobs: int = 1, cost: float = 0.0, size: int = 0, drain_factor: float = 1.0):
+    """
+    Lanza 429/503 (con Retry-After) si aceptar <jobs> más, con <cost>
+    segundos estimados y una entrada de <size> bytes, sobrepasa los límites.
+    Sin workers vivos solo se mira la profundidad: encolar mientras
+    reinician es legítimo.
+    """
+    if not ADMISSION_CONTROL:
+        return
+    snap = _admission_snapshot()
+    depth, pending, capacity = snap["depth"], snap["pending_cost"], snap["capacity"]
+    avg_cost = pending / depth if depth else max(cost / max(1, jobs), 1.0)
+    max_queue = ADMISSION_MAX_QUEUE * drain_factor
+    if depth + jobs > max_queue:
+        excess = depth + jobs - max_queue
+        _reject(endpoint, "queue_full", 429, excess * avg_cost / max(1, capacity),
+                f"Cola llena ({depth} jobs en espera)")
+    if capacity:
+        drain = (pending + cost) / capacity
+        max_drain = ADMISSION_MAX_DRAIN_SECONDS * drain_factor
+        if drain > max_drain:
+            _reject(endpoint, "drain_time", 429, drain - max_drain,
+                    f"La cola tardaría ~{int(drain)}s en vaciarse")
+    if size and snap["scratch"]:
+        needed = max(ADMISSION_MIN_SCRATCH_BYTES, 2 * size)  # entrada + salida en temporales
+        if max(snap["scratch"]) < needed:
+            _reject(endpoint, "scratch_disk", 503, 60, "Ningún worker tiene disco temporal suficiente")
+
+_uploads_inflight = 0
+_uploads_inflight_lock = threading.Lock()
+
+class _UploadSlot:
+    """Cupo de subida por proxy en este proceso; sin cupo -> 503."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        global _uploads_inflight
+        with _uploads_inflight_lock:
+            full = ADMISSION_CONTROL and _uploads_inflight >= UPLOAD_MAX_INFLIGHT
+            if not full:
+                _uploads_inflight += 1
+        if full:
+            _reject(self.endpoint, "uploads_inflight", 503, 5, "Demasiadas subidas en curso")
+        return self
+
+    def __exit__(self, *exc):
+        global _uploads_inflight
+        with _uploads_inflight_lock:
+            _uploads_inflight -= 1
+        return False
+
+class _UploadAdmission:
+    """
+    ASGI: POST /upload es multipart y FastAPI lo parsea (a disco) antes de
+    llamar al handler y a sus dependencias, así que la admisión y el cupo de
+    subidas se aplican aquí, antes de leer un byte del cuerpo.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != "/upload":
+            await self.app(scope, receive, send)
+            return
+        slot = _UploadSlot("upload")
+        try:
+            await run_in_threadpool(_admit, "upload", jobs=0, drain_factor=ADMISSION_UPLOAD_DRAIN_FACTOR)
+            slot.__enter__()
+        except HTTPException as e:
+            # Queda por fuera de CORSMiddleware: sus cabeceras van a mano (allow_origins=["*"])
+            headers = {**(e.headers or {}), "Access-Control-Allow-Origin": "*",
+                       "Access-Control-Expose-Headers": "Retry-After"}
+            await JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=headers)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            slot.__exit__()
+
+app.add_middleware(_UploadAdmission)
+
+@app.post("/convert")
+def request_conversion(req: ConvertRequest, user: dict = Depends(get_current_user)):
+    filename = _sanitize_filename(req.input_file)
+    specs = _output_specs(req)
 
-    _save_job(job)
-    _enqueue_job(job_id, worker_id)
+    object_name = f"{user['username']}/{filename}"
+    try:
+        st = minio.stat_object(BUCKET, object_name)
+    except Exception:
+        raise HTTPException(status_code=404, detail="El archivo no existe")
+
+    job = _new_job(user["username"], filename, specs, st.size, st.etag)
+    job["priority"] = _priority(req.priority)
+    job_id = job["job_id"]
+    if _complete_from_cache(job):
+        # Mismo origen, formato y opciones ya convertidos
+        _save_job(job)
+        return {"ok": True, "job_id": job_id, "assigned_worker": None, "cache_hit": True}
+
+    cost = job["estimated_cost_seconds"]
+    _admit("convert", cost=cost, size=st.size)
+    worker_id = _select_worker(cost) if SCHEDULING_MODE == "direct" else None
+    pipe = r.pipeline()
+    if worker_id:
+        pipe.hincrbyfloat(SCHED_BACKLOG_KEY, worker_id, cost)
+    _assign_and_enqueue(job, worker_id, pipe)
+    pipe.execute()
     API_JOBS_ENQUEUED.inc()
-    return {"ok": True, "job_id": job_id, "assigned_worker": worker_id}
+    return {"ok": True, "job_id": job_id, "assigned_worker": worker_id,
+            "estimated_cost_seconds": cost, "priority": job["priority"]}
+
+def _batch_key(batch_id: str) -> str:
+    return f"{BATCH_PREFIX}{batch_id}"
+
+@app.post("/convert/batch")
+def request_batch_conversion(req: BatchConvertRequest, user: dict = Depends(get_current_user)):
+    """
+    Convierte muchos archivos de una vez: una sola lista del prefijo del
+    usuario valida todas las entradas, los workers se eligen sobre una única
+    foto de carga y todos los registros y entradas de cola van en un pipeline.
+    Las entradas inválidas se devuelven en "rejected" sin frenar al resto.
+    """
+    if not req.items:
+        raise HTTPException(status_code=400, detail="El lote está vacío")
+    if len(req.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_BATCH_ITEMS} elementos por lote")
+    batch_priority = _priority(req.priority, BATCH_DEFAULT_PRIORITY)
+
+    owner = user["username"]
+    prefix = f"{owner}/"
+    try:
+        objects = {o.object_name: o for o in minio.list_objects(BUCKET, prefix=prefix, recursive=True)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    encoder = _decode(r.get(CONV_CACHE_ENCODER_KEY)) or ""
+    rates: Dict = {}
+
+    batch_id = secrets.token_hex(8)
+    jobs, rejected = [], []
+    for index, item in enumerate(req.items):
+        try:
+            filename = _sanitize_filename(item.input_file)
+            specs = _output_specs(item)
+            obj = objects.get(f"{prefix}{filename}")
+            if obj is None:
+                raise HTTPException(status_code=404, detail="El archivo no existe")
+            job = _new_job(owner, filename, specs, obj.size, obj.etag, encoder, rates)
+            job["priority"] = _priority(item.priority, batch_priority)
+        except HTTPException as e:
+            rejected.append({"index": index, "input_file": item.input_file, "detail": e.detail})
+            continue
+        job["batch_id"] = batch_id
+        jobs.append(job)
+
+    if not jobs:
+        raise HTTPException(status_code=400, detail={"message": "Ningún elemento válido", "rejected": rejected})
+    # El lote entra entero o no entra (antes de copiar nada de la caché)
+    _admit("convert_batch", jobs=len(jobs), cost=sum(j["estimated_cost_seconds"] for j in jobs),
+           size=max(j["input_size_bytes"] for j in jobs))
+
+    workers = _worker_loads() if SCHEDULING_MODE == "direct" else []
+    backlog: Dict[str, float] = {}
+    results = []
+    pipe = r.pipeline()
+    for job in jobs:
+        if _complete_from_cache(job):
+            _save_job(job, pipe)
+            results.append({"job_id": job["job_id"], "input_file": job["input_file"],
+                            "assigned_worker": None, "cache_hit": True})
+            continue
+        cost = job["estimated_cost_seconds"]
+        worker_id = _pick_worker(workers, cost)
+        if worker_id:
+            backlog[worker_id] = backlog.get(worker_id, 0.0) + cost
+        _assign_and_enqueue(job, worker_id, pipe)
+        results.append({"job_id": job["job_id"], "input_file": job["input_file"],
+                        "assigned_worker": worker_id, "estimated_cost_seconds": cost})
+    for worker_id, cost in backlog.items():
+        pipe.hincrbyfloat(SCHED_BACKLOG_KEY, worker_id, cost)
+    pipe.hset(_batch_key(batch_id), mapping=_encode_job_fields({
+        "batch_id": batch_id,
+        "owner": owner,
+        "created_at": datetime.utcnow().isoformat(),
+        "job_ids": [job["job_id"] for job in jobs],
+        "rejected": len(rejected),
+    }))
+    pipe.execute()
+
+    enqueued = sum(1 for res in results if not res.get("cache_hit"))
+    API_JOBS_ENQUEUED.inc(enqueued)
+    return {"ok": True, "batch_id": batch_id, "accepted": len(jobs), "enqueued": enqueued,
+            "jobs": results, "rejected": rejected}
+
+@app.get("/batches/{batch_id}")
+def batch_status(batch_id: str, user: dict = Depends(get_current_user)):
+    """Estado agregado de un lote: conteo por estado, progreso medio y estado de cada job."""
+    batch = _decode_job_hash(r.hgetall(_batch_key(batch_id)))
+    if not batch or batch.get("owner") != user["username"]:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+
+    job_ids = batch.get("job_ids", [])
+    pipe = r.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hmget(_job_key(job_id), "status", "progress", "input_file", "output_format")
+    counts = {status: 0 for status in JOB_STATUSES}
+    jobs, progress_sum = [], 0
+    for job_id, values in zip(job_ids, pipe.execute()):
+        status, progress, input_file, output_format = (
+            json.loads(_decode(v)) if v is not None else None for v in values
+        )
+        status = status or "pending"
+        counts[status] = counts.get(status, 0) + 1
+        progress = 100 if status in ("completed", "failed") else int(progress or 0)
+        progress_sum += progress
+        jobs.append({"job_id": job_id, "input_file": input_file, "output_format": output_format,
+                     "status": status, "progress": progress})
+
+    total = len(job_ids)
+    finished = counts["completed"] + counts["failed"]
+    if finished == total:
+        overall = "completed" if counts["failed"] == 0 else ("failed" if counts["completed"] == 0 else "partial")
+    elif counts["processing"] or finished:
+        overall = "processing"
+    else:
+        overall = "pending"
+    return {
+        "batch_id": batch_id,
+        "created_at": batch.get("created_at"),
+        "status": overall,
+        "total": total,
+        "rejected": batch.get("rejected", 0),
+        "counts": counts,
+        "progress": round(progress_sum / total, 1) if total else 100.0,
+        "jobs": jobs,
+    }
 
 def _scrub_job(job: Dict, include_owner: bool) -> Dict:
     data = job.copy()
@@ -510,26 +2248,19 @@ def _scrub_job(job: Dict, include_owner: bool) -> Dict:
     return data
 
 @app.get("/jobs")
-def list_jobs(status: str = "", limit: int = 50, user: Optional[dict] = Depends(get_optional_user)):
+def list_jobs(status: str = "", limit: int = 50, cursor: str = "",
+              user: Optional[dict] = Depends(get_optional_user)):
     limit = max(1, min(limit, MAX_JOB_RESULTS))
     owner = user["username"] if user else None
-    jobs = _list_jobs(owner=owner)
-    if status:
-        jobs = [j for j in jobs if j.get("status") == status]
-    jobs.sort(key=lambda j: j.get("created_at", ""), reverse=True)
+    jobs, next_cursor = _list_jobs(owner=owner, status=status, limit=limit, cursor=cursor or None)
     include_owner = owner is None
-    return {"jobs": [_scrub_job(j, include_owner) for j in jobs[:limit]]}
+    return {"jobs": [_scrub_job(j, include_owner) for j in jobs], "next_cursor": next_cursor}
 
 @app.get("/queue/stats")
 def queue_stats(user: dict = Depends(get_current_user)):
-    jobs = _list_jobs(owner=user["username"])
-    stats = {"pending": 0, "processing": 0, "completed": 0, "failed": 0}
-    for job in jobs:
-        status = job.get("status", "pending")
-        if status in stats:
-            stats[status] += 1
+    stats = _read_counters(user["username"])
     queue_length = stats["pending"] + stats["processing"]
-    return {
+    result = {
         "queue_length": queue_length,
         "stats": {
             "pending": stats["pending"],
@@ -537,26 +2268,183 @@ def queue_stats(user: dict = Depends(get_current_user)):
             "completed": stats["completed"],
             "failed": stats["failed"],
         },
-        "total_jobs": len(jobs),
+        "total_jobs": stats["total"],
+        "scheduling": SCHEDULING_MODE,
     }
+    if SCHEDULING_MODE == "fair":
+        # Posición de los próximos jobs del usuario en el orden justo y espera estimada
+        capacity = sum(max(1, int(w.get("slots_total", 1))) for w in _list_workers()
+                       if w.get("status") != "offline")
+        upcoming, pending = _fair_preview(user["username"], capacity)
+        result.update({
+            "position": upcoming[0]["position"] if upcoming else None,
+            "expected_wait_seconds": upcoming[0]["expected_wait_seconds"] if upcoming else 0,
+            "upcoming": upcoming,
+            "cluster_pending": pending,
+            "running": stats["processing"],
+            "max_concurrent": USER_MAX_CONCURRENT or None,
+        })
+    return result
 
 @app.get("/workers/stats")
 def workers_stats():
     workers = _list_workers()
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(WORKERS_COUNTERS_KEY)
+    pipe.hget(_job_counters_key(), "processing")
+    totals, processing = pipe.execute()
+    totals = {_decode(k): int(v) for k, v in totals.items()}
+
     total_workers = len(workers)
     active_workers = sum(1 for w in workers if w.get("status") != "offline")
-    total_jobs_processing = sum(w.get("jobs_in_progress", 0) for w in workers)
-    total_success = sum(w.get("conversions_success", 0) for w in workers)
-    total_failed = sum(w.get("conversions_failed", 0) for w in workers)
     avg_cpu = (sum(w.get("cpu_load", 0) for w in workers) / total_workers) if total_workers else 0
 
     summary = {
         "active_workers": active_workers,
         "total_workers": total_workers,
-        "total_jobs_processing": total_jobs_processing,
+        "total_jobs_processing": max(0, int(processing or 0)),
         "average_cpu_load": avg_cpu,
-        "total_conversions_success": total_success,
-        "total_conversions_failed": total_failed,
+        "total_conversions_success": totals.get("conversions_success", 0),
+        "total_conversions_failed": totals.get("conversions_failed", 0),
+        "queue_depth": _queue_depth(),
     }
 
     return {"summary": summary, "workers": workers}
+
+# =========================
+# Eventos en vivo (SSE)
+# =========================
+class _EventSubscriber:
+    """Un cliente de /events: su cola vive en el event loop de la petición."""
+
+    def __init__(self, loop, owner: Optional[str], topics: set):
+        self.loop = loop
+        self.owner = owner  # None = administrador (ADMIN_USERS): todos los jobs
+        self.topics = topics
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.lagged = False
+
+    def offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True  # cliente lento: se le pide resincronizar en vez de bloquear
+
+    def mark_lagged(self):
+        self.lagged = True
+
+_event_subscribers: set = set()
+_event_subscribers_lock = threading.Lock()
+
+def _event_for(sub: _EventSubscriber, topic: str, payload: Dict) -> Optional[Tuple[str, Dict]]:
+    """Filtra y limpia un evento para un suscriptor; None = no le corresponde"""
+    if topic == "workers":
+        return ("worker", payload) if "workers" in sub.topics else None
+    if "jobs" not in sub.topics:
+        return None
+    owner = payload.get("owner")
+    if sub.owner is not None and owner != sub.owner:
+        return None
+    fields = dict(payload.get("fields") or {})
+    fields.pop("input_object", None)
+    event = {"job_id": payload.get("job_id"), "status": payload.get("status"), "fields": fields}
+    if sub.owner is None:
+        event["owner"] = owner
+    else:
+        fields.pop("owner", None)
+    return ("job", event)
+
+def _event_relay():
+    """Hilo: reparte los mensajes de pub/sub a los clientes SSE de este proceso."""
+    topic_by_channel = {channel: topic for topic, channel in EVENT_TOPICS.items()}
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*EVENT_TOPICS.values())
+            for message in pubsub.listen():
+                topic = topic_by_channel.get(_decode(message["channel"]))
+                try:
+                    payload = json.loads(_decode(message["data"]))
+                except ValueError:
+                    continue
+                with _event_subscribers_lock:
+                    subscribers = list(_event_subscribers)
+                for sub in subscribers:
+                    event = _event_for(sub, topic, payload)
+                    if event:
+                        sub.loop.call_soon_threadsafe(sub.offer, event)
+        except Exception as e:
+            print(f"⚠️  Relay de eventos: {e}")
+            with _event_subscribers_lock:
+                subscribers = list(_event_subscribers)
+            for sub in subscribers:
+                sub.loop.call_soon_threadsafe(sub.mark_lagged)  # pudieron perderse eventos
+            time.sleep(1)
+
+def _redeem_sse_ticket(ticket: str) -> Optional[str]:
+    """Canjea un ticket de /events (una sola vez); devuelve el usuario o None"""
+    pipe = r.pipeline()
+    pipe.get(f"{SSE_TICKET_PREFIX}{ticket}")
+    pipe.delete(f"{SSE_TICKET_PREFIX}{ticket}")
+    username, _ = pipe.execute()
+    return _decode(username) if username else None
+
+@app.post("/events/ticket")
+def events_ticket(user: dict = Depends(get_current_user)):
+    """Ticket de un solo uso para abrir /events desde EventSource (que no envía cabeceras)."""
+    ticket = secrets.token_urlsafe(24)
+    r.set(f"{SSE_TICKET_PREFIX}{ticket}", user["username"], ex=SSE_TICKET_TTL)
+    return {"ticket": ticket, "expires_in": SSE_TICKET_TTL, "admin": user["username"] in ADMIN_USERS}
+
+@app.get("/events")
+async def events(request: Request, ticket: Optional[str] = None, topics: str = "jobs,workers",
+                 authorization: Optional[str] = Header(default=None)):
+    """
+    Server-Sent Events: "job" (campos cambiados de un job), "worker"
+    (heartbeat) y "resync" (se perdieron eventos: recargar por REST).
+    Requiere ?ticket= (de POST /events/ticket) o Authorization: Bearer.
+    Solo llegan los jobs del usuario, salvo para los de ADMIN_USERS.
+    """
+    wanted = {t.strip() for t in topics.split(",") if t.strip()}
+    if not wanted or not wanted <= set(EVENT_TOPICS):
+        raise HTTPException(status_code=400, detail=f"topics debe ser subconjunto de {sorted(EVENT_TOPICS)}")
+    username = None
+    if ticket:
+        username = await run_in_threadpool(_redeem_sse_ticket, ticket)
+    elif authorization:
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() == "bearer" and token:
+            username = await run_in_threadpool(_authenticate_token, token)
+    if not username:
+        raise HTTPException(status_code=401, detail="Ticket o token inválido")
+    owner = None if username in ADMIN_USERS else username
+
+    sub = _EventSubscriber(asyncio.get_running_loop(), owner, wanted)
+
+    async def stream():
+        with _event_subscribers_lock:
+            _event_subscribers.add(sub)
+        SSE_CLIENTS.inc()
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    kind, data = await asyncio.wait_for(sub.queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    kind, data = None, None
+                if sub.lagged:
+                    sub.lagged = False
+                    yield "event: resync\ndata: {}\n\n"
+                if kind is None:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            with _event_subscribers_lock:
+                _event_subscribers.discard(sub)
+            SSE_CLIENTS.dec()
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # sin buffering en proxies (nginx)
+    })
@@ -1,8 +1,12 @@
-import os, time, json, subprocess, tempfile, socket
+import os, time, json, subprocess, tempfile, socket, threading, hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 from prometheus_client import Gauge, Counter, Histogram, start_http_server
 from minio import Minio
+from minio.commonconfig import CopySource, ComposeSource
+from minio.deleteobjects import DeleteObject
 import redis
 import urllib.parse
 import psutil
@@ -11,9 +15,25 @@ import psutil
 CPU_LOAD = Gauge("worker_cpu_load", "Carga CPU del worker")
 MEMORY_USAGE = Gauge("worker_memory_usage_mb", "Uso de memoria en MB")
 JOBS_IN_PROGRESS = Gauge("worker_jobs_in_progress", "Jobs en progreso")
+JOBS_RECLAIMED = Counter("worker_jobs_reclaimed_total", "Jobs reclamados de workers caídos")
+CONV_CACHE = Counter("worker_conversion_cache_total", "Consultas a la caché de conversiones", ["result"])
+CONV_CACHE_EVICTED_BYTES = Counter("worker_conversion_cache_evicted_bytes_total", "Bytes desalojados de la caché de conversiones")
+JOBS_STOLEN = Counter("worker_jobs_stolen_total", "Jobs robados de colas privadas de otros workers")
+JOBS_DEAD_LETTERED = Counter("worker_jobs_dead_lettered_total", "Jobs enviados a la cola de muertos")
+SLOTS_TOTAL = Gauge("worker_slots_total", "Slots de ejecución concurrente")
+THREADS_IN_USE = Gauge("worker_ffmpeg_threads_in_use", "Hilos de FFmpeg reservados por jobs activos")
 CONV_DONE = Counter("worker_conversions_done_total", "Conversiones completadas", ["status"])
 CONV_DURATION = Histogram("worker_conversion_duration_seconds", "Duración de conversión")
+SOURCE_CACHE_LOOKUPS = Counter("worker_source_cache_total", "Consultas a la caché local de fuentes", ["result"])
+SOURCE_CACHE_EVICTED_BYTES = Counter("worker_source_cache_evicted_bytes_total", "Bytes desalojados de la caché local de fuentes")
+SOURCE_CACHE_BYTES = Gauge("worker_source_cache_bytes", "Bytes ocupados por la caché local de fuentes")
 FILE_SIZE_REDUCTION = Histogram("worker_file_size_reduction_percent", "Porcentaje de reducción de tamaño")
+ENCODE_SPEED = Gauge("worker_encode_speed_realtime", "Velocidad de codificación (x tiempo real) del último reporte")
+PROGRESS_WRITES = Counter("worker_progress_writes_total", "Escrituras de progreso enviadas a Redis")
+SEGMENTS_DONE = Counter("worker_segments_done_total", "Segmentos de video procesados", ["status"])
+ENCODER_PROFILE_JOBS = Counter("worker_encoder_profile_jobs_total", "Jobs lanzados por perfil de codificación", ["profile"])
+ENCODER_PROFILE_LEVEL = Gauge("worker_encoder_profile_level", "Perfil según la presión actual (0 calidad, 1 equilibrado, 2 rendimiento)")
+ENCODER_PRESSURE = Gauge("worker_encoder_pressure", "Jobs pendientes del cluster por slot de video")
 
 # Configuración
 WORKER_ID = os.getenv("WORKER_ID", socket.gethostname())
@@ -38,150 +58,1743 @@ JOBS_QUEUE = "conversion:queue"
 JOBS_STATUS_PREFIX = "job:status:"
 WORKER_QUEUE = f"conversion:queue:{WORKER_ID}"  # Cola específica del worker
 WORKER_STATUS_KEY = f"worker:status:{WORKER_ID}"
+JOBS_INDEX_PREFIX = "jobs:index:"  # Índices ZSET mantenidos junto con la API
+JOBS_COUNTERS_PREFIX = "jobs:counters:"  # Contadores por estado (global y por usuario)
+WORKERS_REGISTRY_KEY = "workers:registry"  # ZSET worker_id -> último heartbeat
+WORKERS_COUNTERS_KEY = "workers:counters"  # Totales de conversiones del cluster
+MEDIA_LIST_GEN_PREFIX = "media:gen:"  # Generación del listado /media por usuario (caché de la API)
+EVENTS_JOBS_CHANNEL = "events:jobs"  # Pub/sub: cambios de jobs (la API los reenvía por SSE)
+EVENTS_WORKERS_CHANNEL = "events:workers"  # Pub/sub: heartbeats de workers
+WORKER_STATUS_TTL = 15
+
+# Backend de cola: "list" (BLPOP, at-most-once) o "streams" (consumer groups, at-least-once)
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "list").strip().lower()
+JOBS_STREAM = "conversion:stream"
+WORKER_STREAM = f"conversion:stream:{WORKER_ID}"
+DEAD_LETTER_STREAM = "conversion:stream:dead"
+STREAM_GROUP = "workers"
+VISIBILITY_TIMEOUT = int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", "60"))  # s sin heartbeat -> reclamable
+MAX_DELIVERIES = int(os.getenv("QUEUE_MAX_DELIVERIES", "3"))
+RECLAIM_INTERVAL = int(os.getenv("QUEUE_RECLAIM_INTERVAL", "15"))
+
+# Planificador (compartido con la API): modelo de costo y backlog estimado por worker
+SCHED_COST_PREFIX = "sched:cost:"
+SCHED_BACKLOG_KEY = "sched:backlog"
+SCHED_PENDING_COST_KEY = "sched:pending_cost"  # segundos estimados de trabajo en cola (admisión de la API)
+COST_EWMA_ALPHA = float(os.getenv("COST_EWMA_ALPHA", "0.2"))
+JOB_OVERHEAD_SECONDS = 2.0
+# Work stealing: solo si la víctima tiene al menos este backlog (s) más que nosotros
+STEAL_MIN_GAP_SECONDS = float(os.getenv("STEAL_MIN_GAP_SECONDS", "30"))
+
+# Colas justas (SCHEDULING_MODE=fair, opcional y compartido con la API): un flujo por
+# <clase>:<dueño>; se saca el de menor etiqueta virtual respetando el límite
+# de jobs a la vez por usuario. Las colas directas (segmentos) van antes.
+FAIR_SCHEDULING = os.getenv("SCHEDULING_MODE", "direct").strip().lower() == "fair"
+FAIR_FLOWS_KEY = "fair:flows"
+FAIR_QUEUE_PREFIX = "fair:queue:"
+FAIR_FINISH_KEY = "fair:finish"
+FAIR_VCLOCK_KEY = "fair:vclock"
+FAIR_SIGNAL_KEY = "fair:signal"
+FAIR_SIGNAL_MAX = 64
+FAIR_DISPATCH_PREFIX = "fair:dispatching:"  # ZSET por dueño: sacados que aún no están en "processing"
+FAIR_DISPATCH_STALE = 60  # s: un sacado que nunca arrancó deja de contar para el límite
+FAIR_SCAN_FLOWS = 64  # flujos revisados por intento (los de etiqueta más baja)
+ORPHAN_AFTER_SECONDS = 4 * WORKER_STATUS_TTL  # listas: sin heartbeat tanto tiempo, sus jobs en curso se dan por perdidos
+USER_MAX_CONCURRENT = int(os.getenv("USER_MAX_CONCURRENT", "4"))  # 0 = sin límite
+
+# Caché de resultados de conversión (compartida con la API). Subir
+# CONVERSION_CACHE_VERSION cuando cambien los argumentos de códec.
+CONVERSION_CACHE_ENABLED = os.getenv("CONVERSION_CACHE", "on").strip().lower() != "off"
+CONVERSION_CACHE_VERSION = "1"
+CONVERSION_CACHE_MAX_BYTES = int(os.getenv("CONVERSION_CACHE_MAX_BYTES", str(10 * 1024**3)))
+CACHE_BUCKET = os.getenv("CONVERSION_CACHE_BUCKET", f"{BUCKET}-cache")
+CONV_CACHE_ENTRY_PREFIX = "convcache:entry:"
+CONV_CACHE_LRU_KEY = "convcache:lru"
+CONV_CACHE_BYTES_KEY = "convcache:bytes"
+CONV_CACHE_ENCODER_KEY = "convcache:encoder"
+
+# Transcodificación por segmentos (SEGMENTED_MODE=auto|off): un video largo se
+# corta en keyframes, cada trozo es un sub-job de la cola general (lo toma
+# cualquier worker) y el último en terminar encola la concatenación del padre.
+SEGMENTED_MODE = os.getenv("SEGMENTED_MODE", "auto").strip().lower()
+SEGMENT_MIN_DURATION = float(os.getenv("SEGMENT_MIN_DURATION", "300"))  # s de medio para partir
+SEGMENT_MIN_SECONDS = float(os.getenv("SEGMENT_MIN_SECONDS", "60"))  # duración mínima de un trozo
+SEGMENT_MAX_COUNT = int(os.getenv("SEGMENT_MAX_COUNT", "32"))
+SCRATCH_BUCKET = os.getenv("SCRATCH_BUCKET", f"{BUCKET}-scratch")
+SEGMENTS_PREFIX = "segments/"
+
+# Caché local (disco) de archivos de entrada por objeto + ETag; 0 bytes = desactivada
+SOURCE_CACHE_DIR = os.getenv("SOURCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "source-cache"))
+SOURCE_CACHE_MAX_BYTES = int(os.getenv("SOURCE_CACHE_MAX_BYTES", str(2 * 1024**3)))
+
+# El heartbeat corre en su propio hilo; el loop principal solo bloquea en la cola
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "5"))
+FETCH_BLOCK_SECONDS = 5  # solo acota cuánto tarda el loop en notar un cierre
+
+AUDIO_FORMATS = {"mp3", "flac", "wav", "aac", "ogg", "m4a"}
+VIDEO_FORMATS = {"mp4", "avi", "mkv", "webm", "mov", "flv"}
+
+# Salida HLS: escalera de renditions (alto, bitrate video, bitrate audio);
+# solo se generan las que no superan la resolución de la fuente.
+ADAPTIVE_FORMATS = {"hls"}
+HLS_LADDER = [(1080, "5000k", "192k"), (720, "2800k", "128k"), (480, "1400k", "128k"), (360, "800k", "96k")]
+HLS_SEGMENT_SECONDS = int(os.getenv("HLS_SEGMENT_SECONDS", "6"))
+HLS_DIR_SUFFIX = "_hls"
+HLS_MASTER = "master.m3u8"
+HLS_MIME = {"m3u8": "application/vnd.apple.mpegurl", "ts": "video/mp2t"}
+
+# Perfil de codificación adaptativo (ADAPTIVE_PROFILE=auto|off): con la cola
+# cargada se cambia algo de compresión por rendimiento (preset más rápido,
+# menos hilos por job para que quepan más, audio un escalón abajo); sin
+# presión se vuelve a "quality", que son los valores por defecto de siempre.
+# Lo que el usuario fija en options manda, y options.max_profile acota hasta
+# qué perfil puede bajar el worker.
+ADAPTIVE_PROFILE = os.getenv("ADAPTIVE_PROFILE", "auto").strip().lower()
+ENCODER_PROFILES = ["quality", "balanced", "throughput"]
+PROFILE_BALANCED_RATIO = float(os.getenv("PROFILE_BALANCED_RATIO", "1"))  # pendientes por slot de video
+PROFILE_THROUGHPUT_RATIO = float(os.getenv("PROFILE_THROUGHPUT_RATIO", "3"))
+PROFILE_CPU_HIGH = float(os.getenv("PROFILE_CPU_HIGH", "90"))  # % de CPU que sube un escalón si hay cola
+PROFILE_OPTIONS = {
+    "quality": {},
+    "balanced": {"preset": "fast", "cpu_used": "2", "bitrate": "160k", "quality": "4", "compression": "3"},
+    "throughput": {"preset": "veryfast", "cpu_used": "5", "bitrate": "128k", "audio_bitrate": "96k",
+                   "quality": "3", "compression": "0"},
+}
+PROFILE_THREAD_DIVISOR = {"quality": 1, "balanced": 1, "throughput": 2}
+
+# Concurrencia: WORKER_SLOTS=1 (un job a la vez) o "auto"/N slots.
+# Cada job reserva hilos de FFmpeg según su tipo dentro de un presupuesto de CPU.
+CPU_CORES = os.cpu_count() or 1
+THREAD_BUDGET = max(1, int(os.getenv("WORKER_THREAD_BUDGET", str(CPU_CORES))))
+AUDIO_JOB_THREADS = max(1, int(os.getenv("AUDIO_JOB_THREADS", "1")))
+VIDEO_JOB_THREADS = max(1, int(os.getenv("VIDEO_JOB_THREADS", str(max(2, CPU_CORES // 2)))))
+
+def resolve_worker_slots():
+    """Número de slots: fijo por env o derivado de núcleos (caben N jobs de audio)"""
+    raw = os.getenv("WORKER_SLOTS", "1").strip().lower()
+    if raw == "auto":
+        return max(1, THREAD_BUDGET // AUDIO_JOB_THREADS)
+    return max(1, int(raw))
+
+WORKER_SLOTS = resolve_worker_slots()
 
 CURRENT_JOBS = 0
 SUCCESS_COUNT = 0
 FAILED_COUNT = 0
+STATE_LOCK = threading.Lock()
 
-def update_job_status(job_id, updates):
-    """Actualizar estado del job en Redis"""
+class SlotPool:
+    """Slots de ejecución con presupuesto de hilos de CPU compartido"""
+
+    def __init__(self, slots, thread_budget):
+        self.slots = slots
+        self.thread_budget = thread_budget
+        self.busy = 0
+        self.threads_used = 0
+        self.cond = threading.Condition()
+
+    def wait_free_slot(self, timeout):
+        """Esperar hasta que haya al menos un slot libre (antes de sacar de la cola)"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.busy < self.slots, timeout=timeout)
+
+    def acquire(self, threads, timeout):
+        """Reservar un slot y <threads> hilos; un job solo siempre cabe aunque exceda el presupuesto"""
+        def fits():
+            if self.busy >= self.slots:
+                return False
+            return self.busy == 0 or self.threads_used + threads <= self.thread_budget
+
+        with self.cond:
+            if not self.cond.wait_for(fits, timeout=timeout):
+                return False
+            self.busy += 1
+            self.threads_used += threads
+            THREADS_IN_USE.set(self.threads_used)
+            return True
+
+    def release(self, threads):
+        with self.cond:
+            self.busy = max(0, self.busy - 1)
+            self.threads_used = max(0, self.threads_used - threads)
+            THREADS_IN_USE.set(self.threads_used)
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                "slots_total": self.slots,
+                "slots_busy": self.busy,
+                "slots_free": self.slots - self.busy,
+                "threads_budget": self.thread_budget,
+                "threads_in_use": self.threads_used,
+            }
+
+SLOTS = SlotPool(WORKER_SLOTS, THREAD_BUDGET)
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_SLOTS, thread_name_prefix="job-slot")
+
+# Pipeline de streaming MinIO -> FFmpeg -> MinIO (STREAMING_MODE=auto|off).
+# Entradas que FFmpeg puede leer sin seek, y salidas cuyo muxer no necesita
+# volver atrás (mp4/mov/m4a/avi/wav/flac reescriben cabeceras -> archivo;
+# mkv/webm sin Cues ni duración no permiten seek en <video> -> archivo).
+STREAMING_MODE = os.getenv("STREAMING_MODE", "auto").strip().lower()
+STREAMABLE_INPUTS = {"mp3", "aac", "ogg", "opus", "flac", "wav", "mkv", "webm", "ts"}
+STREAMABLE_OUTPUTS = {"mp3": "mp3", "aac": "adts", "ogg": "ogg"}
+FFMPEG_PROGRESS_KEYS = {
+    "frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time",
+    "dup_frames", "drop_frames", "speed", "progress",
+}
+STREAM_CHUNK_SIZE = 1024 * 1024
+UPLOAD_PART_SIZE = 10 * 1024 * 1024
+# Las salidas por pipe se suben aquí y se copian al destino solo si FFmpeg
+# terminó bien ("~" no es válido en un usuario: nunca aparece en un listado)
+STAGING_PREFIX = "~staging/"
+MAX_COPY_SIZE = 5 * 1024**3  # límite de CopyObject; por encima, compose (copia por partes)
+
+class SourceCache:
+    """
+    Caché LRU en disco de archivos de entrada, por (objeto, ETag): si el
+    objeto se reemplaza cambia la clave y nunca se sirve una copia vieja.
+    Las entradas en uso por algún job quedan fijadas y no se desalojan, y
+    dos jobs que piden la misma fuente a la vez comparten una descarga.
+    Una fuente que se lee por pipe se guarda con lo que pasa por el pipe (fill).
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # clave -> bytes, de menos a más reciente
+        self.refs = {}
+        self.loading = {}  # clave -> Event de la descarga en curso
+        self.filling = set()  # claves que se llenan desde un pipe (al ritmo de FFmpeg)
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def setup(self):
+        """Crear el directorio y retomar lo que quedó de una ejecución anterior"""
+        if not self.enabled:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            for path in sorted(self.directory.iterdir(), key=lambda p: p.stat().st_mtime):
+                if path.name.endswith(".minio") or not path.is_file():
+                    path.unlink(missing_ok=True)  # descarga a medias
+                    continue
+                self.entries[path.name] = path.stat().st_size
+                self.bytes += path.stat().st_size
+            self.evict_locked()
+
+    def path(self, key):
+        return str(self.directory / key)
+
+    def acquire(self, bucket, object_name, ext, fetch=True, fill=None):
+        """
+        Fijar la fuente en la caché y devolver su clave (ruta con path()),
+        descargándola si falta y <fetch>. None si la caché está desactivada,
+        el objeto no cabe en el presupuesto o no está y no se pidió descarga.
+        Cada clave devuelta debe liberarse con release().
+        Sin <fetch> pero con <fill> (dict), un miss reserva la clave: <fill>
+        recibe el archivo a llenar y se cierra con finish_fill(). Mientras
+        tanto los demás jobs no esperan el fill: devuelve None y cada uno
+        descarga o lee por pipe por su cuenta.
+        """
+        if not self.enabled:
+            return None
+        st = minio.stat_object(bucket, object_name)
+        if st.size > self.max_bytes:
+            return None
+        key = hashlib.sha256(f"{bucket}/{object_name}|{st.etag}".encode()).hexdigest()
+        key = f"{key}.{ext}" if ext else key
+        
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.refs[key] = self.refs.get(key, 0) + 1
+                    SOURCE_CACHE_LOOKUPS.labels(result="hit").inc()
+                    return key
+                if key in self.filling:
+                    SOURCE_CACHE_LOOKUPS.labels(result="miss").inc()
+                    return None
+                waiter = self.loading.get(key)
+                if waiter is None:
+                    SOURCE_CACHE_LOOKUPS.labels(result="miss").inc()
+                    if not fetch and fill is None:
+                        return None
+                    waiter = self.loading[key] = threading.Event()
+                    if not fetch:
+                        self.filling.add(key)
+                    break
+            waiter.wait()  # otro job la está descargando; si falló, se reintenta aquí
+        
+        if not fetch:
+            # ".minio": si el worker muere a medias, setup() lo descarta
+            fill.update(key=key, path=f"{self.path(key)}.fill.minio", size=st.size, done=False)
+            return None
+        
+        try:
+            print(f"[{WORKER_ID}] Descargando {object_name} a la caché local")
+            minio.fget_object(bucket, object_name, self.path(key))
+            with self.lock:
+                self.entries[key] = st.size
+                self.bytes += st.size
+                self.refs[key] = self.refs.get(key, 0) + 1
+                self.evict_locked()
+            return key
+        except Exception:
+            Path(self.path(key)).unlink(missing_ok=True)
+            raise
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def finish_fill(self, fill, complete):
+        """Cerrar un fill: con el objeto entero pasa a la caché; si no, se descarta"""
+        with self.lock:
+            if fill.get("done", True):
+                return
+            fill["done"] = True
+        key = fill["key"]
+        try:
+            if complete and os.path.getsize(fill["path"]) == fill["size"]:
+                os.replace(fill["path"], self.path(key))
+                with self.lock:
+                    self.entries[key] = fill["size"]
+                    self.bytes += fill["size"]
+                    self.evict_locked()
+            else:
+                Path(fill["path"]).unlink(missing_ok=True)
+        except OSError as e:
+            print(f"[{WORKER_ID}] No se pudo guardar la fuente en caché: {e}")
+            Path(fill["path"]).unlink(missing_ok=True)
+        finally:
+            with self.lock:
+                self.filling.discard(key)
+                self.loading.pop(key).set()
+
+    def release(self, key):
+        with self.lock:
+            refs = self.refs.get(key, 0) - 1
+            if refs > 0:
+                self.refs[key] = refs
+            else:
+                self.refs.pop(key, None)
+            self.evict_locked()
+
+    def evict_locked(self):
+        """Desalojar las menos recientes no fijadas hasta volver al presupuesto"""
+        for key in list(self.entries):
+            if self.bytes <= self.max_bytes:
+                break
+            if self.refs.get(key):
+                continue
+            size = self.entries.pop(key)
+            self.bytes -= size
+            Path(self.path(key)).unlink(missing_ok=True)
+            SOURCE_CACHE_EVICTED_BYTES.inc(size)
+        SOURCE_CACHE_BYTES.set(self.bytes)
+
+SOURCE_CACHE = SourceCache(SOURCE_CACHE_DIR, SOURCE_CACHE_MAX_BYTES)
+
+ENCODER_PRESSURE_STATE = {"ratio": 0.0, "cpu": 0.0}
+
+def update_encoder_pressure(cpu_percent):
+    """Heartbeat: jobs pendientes del cluster por slot de video, y CPU local"""
+    pending = int(redis_client.hget(f"{JOBS_COUNTERS_PREFIX}global", "pending") or 0)
+    ratio = max(0, pending) / cluster_video_slots()
+    ENCODER_PRESSURE_STATE.update(ratio=ratio, cpu=cpu_percent)
+    ENCODER_PRESSURE.set(ratio)
+    ENCODER_PROFILE_LEVEL.set(ENCODER_PROFILES.index(pressure_profile()))
+
+def pressure_profile():
+    """Perfil que pide la carga actual, sin los límites del usuario"""
+    if ADAPTIVE_PROFILE == "off":
+        return "quality"
+    ratio, cpu = ENCODER_PRESSURE_STATE["ratio"], ENCODER_PRESSURE_STATE["cpu"]
+    level = 2 if ratio >= PROFILE_THROUGHPUT_RATIO else 1 if ratio >= PROFILE_BALANCED_RATIO else 0
+    if cpu >= PROFILE_CPU_HIGH and ratio >= PROFILE_BALANCED_RATIO:
+        level = min(2, level + 1)
+    return ENCODER_PROFILES[level]
+
+def choose_profile(job):
+    """Perfil para un job: el de la presión actual, acotado por options.max_profile"""
+    if job.get("encoder_profile") in ENCODER_PROFILES:
+        return job["encoder_profile"]  # segmentos (el de su padre) y reintentos
+    level = ENCODER_PROFILES.index(pressure_profile())
+    all_options = [job.get("options") or {}] + [o.get("options") or {} for o in job.get("outputs") or []]
+    for options in all_options:
+        limit = options.get("max_profile")
+        if limit in ENCODER_PROFILES:
+            level = min(level, ENCODER_PROFILES.index(limit))
+    return ENCODER_PROFILES[level]
+
+def profile_options(profile, options):
+    """Opciones efectivas de FFmpeg: las del usuario mandan, el perfil rellena el resto"""
+    return {**PROFILE_OPTIONS.get(profile, {}), **(options or {})}
+
+def profile_threads(profile, threads):
+    if not threads:
+        return 0
+    return max(1, threads // PROFILE_THREAD_DIVISOR.get(profile, 1))
+
+def job_threads(output_format):
+    """Hilos de FFmpeg para un job; 0 = automático (modo de un solo slot)"""
+    if WORKER_SLOTS == 1:
+        return 0
+    threads = VIDEO_JOB_THREADS if output_format in VIDEO_FORMATS | ADAPTIVE_FORMATS else AUDIO_JOB_THREADS
+    return min(threads, THREAD_BUDGET)
+
+# Progreso real de FFmpeg: como mucho una escritura por job cada PROGRESS_INTERVAL s
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "1.0"))
+
+# Migración del formato legado (string JSON) a HASH de campos JSON
+LUA_MIGRATE_JOB = """
+if redis.call('TYPE', KEYS[1]).ok == 'string' then
+  local ok, legacy = pcall(cjson.decode, redis.call('GET', KEYS[1]))
+  if not ok or type(legacy) ~= 'table' then return -1 end
+  redis.call('DEL', KEYS[1])
+  for k, v in pairs(legacy) do redis.call('HSET', KEYS[1], k, cjson.encode(v)) end
+end
+"""
+
+MIGRATE_JOB = redis_client.register_script(LUA_MIGRATE_JOB + "return 1")
+
+# HSET atómico de los campos cambiados. Si cambia "status", en el mismo
+# script se mueve el job entre índices y se ajustan los contadores; al
+# completarse sube la generación del listado de /media del dueño. Cada
+# cambio se publica en el canal de eventos (lo reenvía la API por SSE). Al
+# arrancar deja de contar como "sacado" de la cola justa y al terminar
+# avisa a los workers (el dueño pudo quedar por debajo de su límite). Al
+# salir de "pending" su costo estimado deja de contar como trabajo en cola.
+# KEYS: job, índice "all", contadores globales, totales workers, lista de
+#       avisos, costo pendiente.
+# ARGV: prefijo índices, prefijo contadores, job_id, prefijo generación de
+#       listados, canal de eventos, prefijo sacados, largo máximo de avisos,
+#       campo, valor, ...
+# Solo Redis de un nodo: los índices, contadores, generación y sacados por
+# dueño o por estado dependen de lo que hay en el hash, así que se arman
+# dentro del script a partir de prefijos y no pueden ir en KEYS (no sirve con
+# Redis Cluster ni con ACL por patrón de claves).
+SET_JOB_FIELDS = redis_client.register_script(LUA_MIGRATE_JOB + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local all, global, totals, signal, pending_cost = KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6]
+local idx, cnt, job_id, gen, channel = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5]
+local dispatching, signal_max = ARGV[6], tonumber(ARGV[7])
+local old = redis.call('HGET', KEYS[1], 'status') or '"pending"'
+local fields, changed = {}, {}
+for i = 8, #ARGV, 2 do
+  fields[#fields + 1] = ARGV[i]
+  fields[#fields + 1] = ARGV[i + 1]
+  changed[ARGV[i]] = cjson.decode(ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], unpack(fields))
+-- Los sub-jobs de segmentos no aparecen en índices, contadores ni eventos
+if redis.call('HEXISTS', KEYS[1], 'parent_id') == 1 then return 1 end
+local new = redis.call('HGET', KEYS[1], 'status') or '"pending"'
+local owner = redis.call('HGET', KEYS[1], 'owner')
+if owner then owner = cjson.decode(owner) end
+redis.call('PUBLISH', channel, cjson.encode({
+  job_id = job_id, owner = owner, status = cjson.decode(new), fields = changed,
+}))
+if old == new then return 1 end
+
+old, new = cjson.decode(old), cjson.decode(new)
+local score = redis.call('ZSCORE', all, job_id) or 0
+redis.call('ZREM', idx .. 'status:' .. old, job_id)
+redis.call('ZADD', idx .. 'status:' .. new, score, job_id)
+redis.call('HINCRBY', global, old, -1)
+redis.call('HINCRBY', global, new, 1)
+if old == 'pending' then
+  local cost = tonumber(redis.call('HGET', KEYS[1], 'estimated_cost_seconds') or '0')
+  if cost and cost > 0 then redis.call('INCRBYFLOAT', pending_cost, -cost) end
+end
+
+if type(owner) == 'string' and owner ~= '' then
+  redis.call('ZREM', idx .. 'owner:' .. owner .. ':status:' .. old, job_id)
+  redis.call('ZADD', idx .. 'owner:' .. owner .. ':status:' .. new, score, job_id)
+  redis.call('HINCRBY', cnt .. 'user:' .. owner, old, -1)
+  redis.call('HINCRBY', cnt .. 'user:' .. owner, new, 1)
+  if new == 'completed' then redis.call('INCR', gen .. owner) end
+  if old == 'pending' then redis.call('ZREM', dispatching .. owner, job_id) end
+  if old == 'processing' then
+    redis.call('RPUSH', signal, '1')
+    redis.call('LTRIM', signal, -signal_max, -1)
+  end
+end
+
+if new == 'completed' then
+  redis.call('HINCRBY', totals, 'conversions_success', 1)
+elseif new == 'failed' then
+  redis.call('HINCRBY', totals, 'conversions_failed', 1)
+end
+return 1
+""")
+
+# EWMA de segundos/MB por (tipo de entrada, formato de salida)
+RECORD_COST_SAMPLE = redis_client.register_script("""
+local rate = tonumber(redis.call('HGET', KEYS[1], 'sec_per_mb'))
+local sample, alpha = tonumber(ARGV[1]), tonumber(ARGV[2])
+if rate then rate = rate + alpha * (sample - rate) else rate = sample end
+redis.call('HSET', KEYS[1], 'sec_per_mb', tostring(rate))
+redis.call('HINCRBY', KEYS[1], 'samples', 1)
+return tostring(rate)
+""")
+
+# Saca el próximo job justo: recorre los flujos por etiqueta y toma la cabeza
+# del primero cuyo dueño está bajo su límite (en curso + sacados sin arrancar).
+# El flujo avanza a la etiqueta de su siguiente job o sale del ZSET. Con
+# streams el job se mueve en el mismo script al stream privado del worker.
+# ARGV: prefijo colas, prefijo sacados, prefijo contadores, límite, ahora,
+#       segundos de caducidad de sacados, flujos a revisar, stream destino ('' = devolver)
+FAIR_POP = redis_client.register_script("""
+local flows = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[7]) - 1, 'WITHSCORES')
+local limit, now = tonumber(ARGV[4]), tonumber(ARGV[5])
+local blocked = {}
+for i = 1, #flows, 2 do
+  local flow, tag = flows[i], tonumber(flows[i + 1])
+  local owner = string.match(flow, '^[^:]+:(.*)$') or flow
+  if limit > 0 and blocked[owner] == nil then
+    local dkey = ARGV[2] .. owner
+    redis.call('ZREMRANGEBYSCORE', dkey, '-inf', now - tonumber(ARGV[6]))
+    local running = tonumber(redis.call('HGET', ARGV[3] .. 'user:' .. owner, 'processing') or '0')
+    blocked[owner] = running + redis.call('ZCARD', dkey) >= limit
+  end
+  if not blocked[owner] then
+    local qkey = ARGV[1] .. flow
+    local head = redis.call('LPOP', qkey)
+    if head then
+      local job_id = string.sub(head, 1, string.find(head, '|', 1, true) - 1)
+      if tag > tonumber(redis.call('GET', KEYS[3]) or '0') then redis.call('SET', KEYS[3], tag) end
+      redis.call('HSET', KEYS[2], flow, tag)
+      local nxt = redis.call('LINDEX', qkey, 0)
+      if nxt then
+        redis.call('ZADD', KEYS[1], tag + tonumber(string.sub(nxt, string.find(nxt, '|', 1, true) + 1)), flow)
+      else
+        redis.call('ZREM', KEYS[1], flow)
+      end
+      if limit > 0 then redis.call('ZADD', ARGV[2] .. owner, now, job_id) end
+      if ARGV[8] ~= '' then redis.call('XADD', ARGV[8], '*', 'job_id', job_id) end
+      return job_id
+    end
+    redis.call('ZREM', KEYS[1], flow)
+  end
+end
+return false
+""")
+
+def fair_pop(target_stream=""):
+    """Próximo job de las colas justas (o None si no hay o todos están en su límite)"""
+    return FAIR_POP(
+        keys=[FAIR_FLOWS_KEY, FAIR_FINISH_KEY, FAIR_VCLOCK_KEY],
+        args=[FAIR_QUEUE_PREFIX, FAIR_DISPATCH_PREFIX, JOBS_COUNTERS_PREFIX, USER_MAX_CONCURRENT,
+              time.time(), FAIR_DISPATCH_STALE, FAIR_SCAN_FLOWS, target_stream],
+    )
+
+def media_kind(filename):
+    return "video" if get_file_extension(filename) in VIDEO_FORMATS else "audio"
+
+def record_cost_sample(input_kind, output_format, duration, input_size):
+    """Alimentar el modelo de costo del planificador con un job terminado"""
+    size_mb = input_size / (1024 * 1024)
+    if size_mb < 0.01:
+        return
+    sample = max(0.0, duration - JOB_OVERHEAD_SECONDS) / size_mb
+    RECORD_COST_SAMPLE(keys=[f"{SCHED_COST_PREFIX}{input_kind}:{output_format}"],
+                       args=[sample, COST_EWMA_ALPHA])
+
+def release_backlog(job):
+    """Descontar el costo estimado del job del backlog del worker que lo tenía asignado"""
+    worker_id = job.get("backlog_worker")
+    cost = float(job.get("estimated_cost_seconds") or 0)
+    if worker_id and cost:
+        redis_client.hincrbyfloat(SCHED_BACKLOG_KEY, worker_id, -cost)
+
+def release_segmented_backlog(job):
+    """El backlog de un job segmentado se descuenta al cerrarlo (una sola vez aunque se reentregue)"""
+    if redis_client.hsetnx(f"{JOBS_STATUS_PREFIX}{job['job_id']}", "backlog_released", "true"):
+        release_backlog(job)
+
+def transfer_backlog(job_id, victim):
+    """Tras robar un job: mover su costo de la víctima a este worker"""
+    job = load_job(job_id)
+    if not job:
+        return
+    cost = float(job.get("estimated_cost_seconds") or 0)
+    previous = job.get("backlog_worker")
+    pipe = redis_client.pipeline()
+    if previous and cost:
+        pipe.hincrbyfloat(SCHED_BACKLOG_KEY, previous, -cost)
+    if cost:
+        pipe.hincrbyfloat(SCHED_BACKLOG_KEY, WORKER_ID, cost)
+    pipe.execute()
+    update_job_status(job_id, {"assigned_worker": WORKER_ID, "backlog_worker": WORKER_ID, "stolen_from": victim})
+
+def steal_victims():
+    """
+    Workers a los que robar, en orden: primero los caídos (nadie más vaciará
+    su cola privada), luego los vivos con más backlog que nosotros.
+    """
+    now = time.time()
+    registry = redis_client.zrange(WORKERS_REGISTRY_KEY, 0, -1, withscores=True)
+    backlog = {k: float(v) for k, v in redis_client.hgetall(SCHED_BACKLOG_KEY).items()}
+    mine = max(0.0, backlog.get(WORKER_ID, 0.0))
+    dead, overloaded = [], []
+    for worker_id, last_seen in registry:
+        if worker_id == WORKER_ID:
+            continue
+        if last_seen < now - WORKER_STATUS_TTL:
+            dead.append(worker_id)
+        elif backlog.get(worker_id, 0.0) - mine >= STEAL_MIN_GAP_SECONDS:
+            overloaded.append(worker_id)
+    overloaded.sort(key=lambda w: backlog.get(w, 0.0), reverse=True)
+    return dead + overloaded
+
+def decode_job_hash(raw):
+    """HASH de campos JSON -> dict"""
+    job = {}
+    for k, v in raw.items():
+        try:
+            job[k] = json.loads(v)
+        except ValueError:
+            job[k] = v
+    return job
+
+def load_job(job_id):
+    """Leer el job completo (HGETALL), migrando al vuelo registros legados"""
     job_key = f"{JOBS_STATUS_PREFIX}{job_id}"
-    job_data = redis_client.get(job_key)
-    if job_data:
-        job = json.loads(job_data)
-        job.update(updates)
-        redis_client.set(job_key, json.dumps(job))
-        return job
-    return None
+    try:
+        raw = redis_client.hgetall(job_key)
+    except redis.ResponseError:
+        MIGRATE_JOB(keys=[job_key])
+        raw = redis_client.hgetall(job_key)
+    if not raw:
+        return None
+    job = decode_job_hash(raw)
+    job.setdefault("job_id", job_id)
+    return job
+
+def update_job_status(job_id, updates):
+    """Actualizar estado del job en Redis (un solo EVALSHA, atómico)"""
+    keys = [f"{JOBS_STATUS_PREFIX}{job_id}", f"{JOBS_INDEX_PREFIX}all",
+            f"{JOBS_COUNTERS_PREFIX}global", WORKERS_COUNTERS_KEY, FAIR_SIGNAL_KEY,
+            SCHED_PENDING_COST_KEY]
+    args = [JOBS_INDEX_PREFIX, JOBS_COUNTERS_PREFIX, job_id, MEDIA_LIST_GEN_PREFIX,
+            EVENTS_JOBS_CHANNEL, FAIR_DISPATCH_PREFIX, FAIR_SIGNAL_MAX]
+    for field, value in updates.items():
+        args.extend([field, json.dumps(value)])
+    return bool(SET_JOB_FIELDS(keys=keys, args=args))
+
+def update_job_progress(job_id, fields):
+    """Actualizar campos que no cambian el estado (progreso, ETA...)"""
+    PROGRESS_WRITES.inc()
+    return update_job_status(job_id, fields)
 
 def publish_worker_status(cpu_percent: float, memory_mb: float):
+    slots = SLOTS.snapshot()
     payload = {
         "worker_id": WORKER_ID,
-        "status": "busy" if CURRENT_JOBS > 0 else "available",
+        "status": "available" if slots["slots_free"] > 0 else "busy",
         "cpu_load": round(cpu_percent / 100.0, 4),
         "memory_mb": round(memory_mb, 2),
-        "jobs_in_progress": CURRENT_JOBS,
+        "jobs_in_progress": slots["slots_busy"],
         "load_score": min(100, round(cpu_percent)),
         "conversions_success": SUCCESS_COUNT,
         "conversions_failed": FAILED_COUNT,
-        "updated_at": datetime.utcnow().isoformat()
+        "encoder_profile": pressure_profile(),
+        # Disco libre para temporales (la API no admite jobs si ningún worker tiene sitio)
+        "scratch_free_bytes": psutil.disk_usage(tempfile.gettempdir()).free,
+        "updated_at": datetime.utcnow().isoformat(),
+        **slots,
     }
-    redis_client.set(WORKER_STATUS_KEY, json.dumps(payload), ex=15)
+    pipe = redis_client.pipeline(transaction=False)
+    encoded = json.dumps(payload)
+    pipe.set(WORKER_STATUS_KEY, encoded, ex=WORKER_STATUS_TTL)
+    pipe.zadd(WORKERS_REGISTRY_KEY, {WORKER_ID: time.time()})
+    pipe.publish(EVENTS_WORKERS_CHANNEL, encoded)
+    pipe.execute()
 
 def get_file_extension(filename):
     """Obtener extensión del archivo"""
     return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
 
-def convert_audio(input_path, output_path, output_format, options=None):
-    """Convertir archivo de audio con FFmpeg"""
+def audio_codec_args(output_format, options=None):
+    """Argumentos de códec de FFmpeg para salidas de audio"""
     options = options or {}
-    
-    # Comandos base para cada formato
-    cmd = ["ffmpeg", "-i", input_path, "-y"]
+    args = []
     
     if output_format == "mp3":
         bitrate = options.get("bitrate", "192k")
-        cmd.extend(["-codec:a", "libmp3lame", "-b:a", bitrate])
+        args.extend(["-codec:a", "libmp3lame", "-b:a", bitrate])
     elif output_format == "flac":
         compression = options.get("compression", "5")
-        cmd.extend(["-codec:a", "flac", "-compression_level", str(compression)])
+        args.extend(["-codec:a", "flac", "-compression_level", str(compression)])
     elif output_format == "wav":
-        cmd.extend(["-codec:a", "pcm_s16le"])
+        args.extend(["-codec:a", "pcm_s16le"])
     elif output_format == "aac":
         bitrate = options.get("bitrate", "192k")
-        cmd.extend(["-codec:a", "aac", "-b:a", bitrate])
+        args.extend(["-codec:a", "aac", "-b:a", bitrate])
     elif output_format == "ogg":
         quality = options.get("quality", "5")
-        cmd.extend(["-codec:a", "libvorbis", "-q:a", str(quality)])
-    
-    cmd.append(output_path)
-    
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg error: {result.stderr}")
+        args.extend(["-codec:a", "libvorbis", "-q:a", str(quality)])
     
-    return True
+    return args
 
-def convert_video(input_path, output_path, output_format, options=None):
-    """Convertir archivo de video con FFmpeg"""
+def video_codec_args(output_format, options=None):
+    """Argumentos de códec de FFmpeg para salidas de video"""
     options = options or {}
-    
-    cmd = ["ffmpeg", "-i", input_path, "-y"]
+    args = []
     
     # Configuración común
     video_codec = options.get("video_codec", "libx264")
     crf = options.get("crf", "23")  # Calidad (0-51, menor = mejor)
     preset = options.get("preset", "medium")  # ultrafast, fast, medium, slow
     
+    audio_bitrate = options.get("audio_bitrate", "128k")
+    
     if output_format == "mp4":
-        cmd.extend([
+        args.extend([
             "-codec:v", video_codec,
             "-crf", str(crf),
             "-preset", preset,
             "-codec:a", "aac",
-            "-b:a", "128k"
+            "-b:a", audio_bitrate
         ])
     elif output_format == "avi":
-        cmd.extend([
+        args.extend([
             "-codec:v", "mpeg4",
             "-q:v", "5",
             "-codec:a", "libmp3lame",
-            "-b:a", "128k"
+            "-b:a", audio_bitrate
         ])
     elif output_format == "mkv":
-        cmd.extend([
+        args.extend([
             "-codec:v", video_codec,
             "-crf", str(crf),
             "-preset", preset,
             "-codec:a", "aac"
         ])
     elif output_format == "webm":
-        cmd.extend([
+        args.extend([
             "-codec:v", "libvpx-vp9",
             "-crf", str(crf),
             "-b:v", "0",
             "-codec:a", "libopus"
         ])
+        if options.get("cpu_used"):
+            args.extend(["-cpu-used", str(options["cpu_used"]), "-row-mt", "1"])
     elif output_format == "mov":
-        cmd.extend([
+        args.extend([
             "-codec:v", video_codec,
             "-crf", str(crf),
             "-preset", preset,
             "-codec:a", "aac"
         ])
     
-    cmd.append(output_path)
+    return args
+
+def ffmpeg_command(input_spec, output_spec, output_format, options=None, threads=0):
+    """Construir el comando FFmpeg; input/output pueden ser rutas o pipe:0 / pipe:1"""
+    # -progress pipe:2 -> bloques clave=valor en stderr para el progreso real
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:2", "-i", input_spec, "-y"]
+    if threads:
+        cmd.extend(["-threads", str(threads)])
+    cmd.extend(output_args(output_spec, output_format, options))
+    return cmd
+
+def output_args(output_spec, output_format, options=None):
+    """Códec y destino de una salida; un mismo FFmpeg puede llevar varias seguidas"""
+    if output_format in AUDIO_FORMATS:
+        args = audio_codec_args(output_format, options)
+    elif output_format in VIDEO_FORMATS:
+        args = video_codec_args(output_format, options)
+    else:
+        raise Exception(f"Formato no soportado: {output_format}")
     
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg error: {result.stderr}")
+    if output_spec.startswith("pipe:"):
+        # Sin extensión FFmpeg no sabe qué muxer usar
+        args.extend(["-f", STREAMABLE_OUTPUTS[output_format]])
+    args.append(output_spec)
+    return args
+
+def content_type_for(output_format):
+    return f"video/{output_format}" if output_format in VIDEO_FORMATS else f"audio/{output_format}"
+
+class CountingReader:
+    """
+    Envuelve un stream y cuenta los bytes leídos (para put_object con length=-1).
+    Con <proc>, al llegar al EOF espera a FFmpeg y si salió con error lanza:
+    put_object aborta el multipart en vez de completar una salida truncada.
+    """
+
+    def __init__(self, raw, proc=None):
+        self.raw = raw
+        self.proc = proc
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.count += len(data)
+        if not data and self.proc is not None and self.proc.wait() != 0:
+            raise Exception(f"FFmpeg terminó con código {self.proc.returncode}")
+        return data
+
+def promote_object(bucket, source, target, size):
+    """Copiar <source> a <target> en el servidor y borrar <source>"""
+    if size > MAX_COPY_SIZE:
+        minio.compose_object(bucket, target, [ComposeSource(bucket, source)])
+    else:
+        minio.copy_object(bucket, target, CopySource(bucket, source))
+    minio.remove_object(bucket, source)
+
+def feed_ffmpeg_stdin(proc, bucket, input_object, result, fill=None):
+    """
+    Hilo: copiar el objeto de MinIO al stdin de FFmpeg. Con <fill> (miss de
+    la caché de fuentes) cada trozo se escribe también en su archivo, y si
+    FFmpeg deja de leer antes se termina de bajar para el próximo job.
+    """
+    resp = None
+    sink = None
+    complete = False
+    try:
+        if fill:
+            sink = open(fill["path"], "wb")
+        resp = minio.get_object(bucket, input_object)
+        piping = True
+        while True:
+            chunk = resp.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            if sink:
+                sink.write(chunk)
+            if piping:
+                try:
+                    proc.stdin.write(chunk)
+                    result["bytes"] += len(chunk)
+                except BrokenPipeError:
+                    # FFmpeg terminó antes (error o no necesita más datos); lo reporta su returncode
+                    if not sink:
+                        break
+                    piping = False
+        complete = True
+    except Exception as e:
+        result["error"] = e
+        proc.kill()
+    finally:
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+        if resp is not None:
+            resp.close()
+            resp.release_conn()
+        if sink:
+            sink.close()
+            SOURCE_CACHE.finish_fill(fill, complete)
+
+def probe_duration(input_spec):
+    """Duración del medio en segundos con ffprobe (None si no se puede saber)"""
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        input_spec,
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        duration = float(result.stdout.strip())
+        return duration if duration > 0 else None
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+class ProgressReporter:
+    """Traduce los bloques de -progress de FFmpeg a %, ETA y velocidad, con escrituras limitadas"""
+
+    def __init__(self, job_id, duration, interval=PROGRESS_INTERVAL, parent_id=None):
+        self.job_id = job_id
+        self.parent_id = parent_id
+        self.duration = duration
+        self.interval = interval
+        self.last_write = 0.0
+
+    def __call__(self, block):
+        now = time.monotonic()
+        if block.get("progress") != "end" and now - self.last_write < self.interval:
+            return
+        self.last_write = now
+
+        try:
+            # out_time_ms también viene en microsegundos (bug histórico de FFmpeg)
+            out_seconds = int(block.get("out_time_us") or block.get("out_time_ms") or 0) / 1_000_000
+        except ValueError:
+            out_seconds = 0.0
+        try:
+            speed = float(block.get("speed", "0").rstrip("x") or 0)
+        except ValueError:
+            speed = 0.0
+
+        fields = {"encoded_seconds": round(max(0.0, out_seconds), 2), "speed": round(speed, 3)}
+        if self.duration:
+            ratio = min(1.0, max(0.0, out_seconds / self.duration))
+            fields["progress"] = min(99, int(ratio * 100))
+            if speed > 0:
+                fields["eta_seconds"] = int(max(0.0, self.duration - out_seconds) / speed)
+
+        ENCODE_SPEED.set(speed)
+        try:
+            update_job_progress(self.job_id, fields)
+            if self.parent_id:
+                refresh_parent_progress(self.parent_id)
+        except redis.RedisError as e:
+            print(f"[{WORKER_ID}] No se pudo reportar progreso de {self.job_id}: {e}")
+
+def read_ffmpeg_stderr(proc, sink, on_progress=None):
+    """
+    Hilo: vaciar stderr para que FFmpeg no se bloquee. Las líneas clave=valor
+    de -progress se agrupan en bloques (terminan en progress=...) y se pasan a
+    <on_progress>; del resto solo se conserva la cola para mensajes de error.
+    """
+    block = {}
+    for raw in iter(proc.stderr.readline, b""):
+        line = raw.decode(errors="replace").strip()
+        key, sep, value = line.partition("=")
+        if sep and (key in FFMPEG_PROGRESS_KEYS or key.startswith("stream_")):
+            block[key] = value
+            if key == "progress":
+                if on_progress:
+                    on_progress(block)
+                block = {}
+            continue
+        sink.append(raw)
+        if len(sink) > 200:
+            del sink[:-200]
+
+def transcode(job_id, input_object, input_ext, output_file, target_object, output_format, options, threads,
+              bucket=BUCKET, parent_id=None):
+    """
+    Convertir <input_object> y dejar el resultado en <target_object>.
+    Si el contenedor lo permite, la entrada llega por stdin directamente desde
+    MinIO y la salida se sube como multipart a medida que FFmpeg la produce;
+    si no (p. ej. mp4 con moov al final o salida que requiere seek), se usa
+    un archivo temporal para ese extremo. Los segmentos usan <bucket> de
+    scratch y reportan también el progreso agregado de <parent_id>.
+    Devuelve (input_size, output_size).
+    """
+    pipe_in = STREAMING_MODE == "auto" and input_ext in STREAMABLE_INPUTS
+    pipe_out = STREAMING_MODE == "auto" and output_format in STREAMABLE_OUTPUTS
+    input_path = None
+    output_path = None
+    input_size = 0
+    cached = None
+    fill = {}
     
-    return True
+    try:
+        # Caché local: si la fuente ya está en disco se usa aunque se pudiera leer por pipe
+        if bucket == BUCKET:
+            cached = SOURCE_CACHE.acquire(bucket, input_object, input_ext, fetch=not pipe_in, fill=fill)
+        if cached:
+            pipe_in = False
+            input_path = SOURCE_CACHE.path(cached)
+            input_size = os.path.getsize(input_path)
+        elif not pipe_in:
+            fd, input_path = tempfile.mkstemp(suffix=f".{input_ext}" if input_ext else "")
+            os.close(fd)
+            print(f"[{WORKER_ID}] Descargando {input_object}")
+            minio.fget_object(bucket, input_object, input_path)
+            input_size = os.path.getsize(input_path)
+        if not pipe_out:
+            output_path = f"{tempfile.gettempdir()}/{job_id}_{output_file}"
+        
+        # Con entrada por pipe, ffprobe lee el objeto vía URL prefirmada (solo cabeceras/rangos)
+        probe_spec = input_path or minio.presigned_get_object(bucket, input_object, expires=timedelta(minutes=10))
+        media_duration = probe_duration(probe_spec)
+        update_job_progress(job_id, {
+            "pipeline": f"{'stream' if pipe_in else 'file'}->{'stream' if pipe_out else 'file'}",
+            "media_duration_seconds": round(media_duration, 2) if media_duration else None,
+        })
+        
+        cmd = ffmpeg_command(
+            "pipe:0" if pipe_in else input_path,
+            "pipe:1" if pipe_out else output_path,
+            output_format, options, threads,
+        )
+        print(f"[{WORKER_ID}] Convirtiendo a {output_format} (entrada {'pipe' if pipe_in else 'archivo'}, salida {'pipe' if pipe_out else 'archivo'})")
+        
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if pipe_in else subprocess.DEVNULL,
+            stdout=subprocess.PIPE if pipe_out else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        stderr_tail = []
+        reporter = ProgressReporter(job_id, media_duration, parent_id=parent_id)
+        stderr_thread = threading.Thread(target=read_ffmpeg_stderr, args=(proc, stderr_tail, reporter), daemon=True)
+        stderr_thread.start()
+        
+        feed_result = {"bytes": 0, "error": None}
+        feeder = None
+        if pipe_in:
+            feeder = threading.Thread(target=feed_ffmpeg_stdin, args=(proc, bucket, input_object, feed_result, fill), daemon=True)
+            feeder.start()
+        
+        output_size = 0
+        upload_error = None
+        if pipe_out:
+            # put_object con length=-1 hace multipart leyendo stdout a medida que llega,
+            # a una clave temporal: una salida anterior buena no se toca si algo falla
+            staging_object = f"{STAGING_PREFIX}{job_id}/{output_file}"
+            reader = CountingReader(proc.stdout, proc)
+            try:
+                minio.put_object(
+                    bucket, staging_object, reader,
+                    length=-1, part_size=UPLOAD_PART_SIZE,
+                    content_type=content_type_for(output_format),
+                )
+            except Exception as e:
+                upload_error = e
+                proc.kill()
+            output_size = reader.count
+        
+        proc.wait()
+        if feeder:
+            feeder.join()
+            input_size = feed_result["bytes"]
+        stderr_thread.join()
+        
+        error = None
+        if feed_result["error"]:
+            error = Exception(f"Error leyendo {input_object}: {feed_result['error']}")
+        elif proc.returncode != 0:
+            error = Exception(f"FFmpeg error: {b''.join(stderr_tail).decode(errors='replace')}")
+        elif upload_error:
+            error = upload_error
+        if error:
+            if pipe_out:
+                # Normalmente el multipart ya se abortó; por si llegó a completarse
+                try:
+                    minio.remove_object(bucket, staging_object)
+                except Exception:
+                    pass
+            raise error
+        
+        if pipe_out:
+            promote_object(bucket, staging_object, target_object, output_size)
+        else:
+            print(f"[{WORKER_ID}] Subiendo {target_object}")
+            output_size = os.path.getsize(output_path)
+            with open(output_path, "rb") as f:
+                minio.put_object(
+                    bucket, target_object, f,
+                    length=output_size,
+                    content_type=content_type_for(output_format)
+                )
+        
+        return input_size, output_size
+    
+    finally:
+        # Limpiar archivos temporales (la copia en caché queda para el próximo job)
+        if fill:
+            SOURCE_CACHE.finish_fill(fill, False)  # no-op si el feeder ya lo cerró
+        if cached:
+            SOURCE_CACHE.release(cached)
+            input_path = None
+        for path in (input_path, output_path):
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+def probe_video_stream(input_spec):
+    """(alto del primer stream de video, hay audio) con ffprobe"""
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "stream=codec_type,height", "-of", "json", input_spec]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        streams = json.loads(result.stdout or "{}").get("streams", [])
+    except (subprocess.SubprocessError, ValueError):
+        return None, True
+    height = next((s.get("height") for s in streams if s.get("codec_type") == "video" and s.get("height")), None)
+    return height, any(s.get("codec_type") == "audio" for s in streams)
+
+def hls_renditions(source_height):
+    """Renditions de HLS_LADDER que no agrandan la fuente (al menos la más baja)"""
+    if not source_height:
+        return HLS_LADDER
+    return [r for r in HLS_LADDER if r[0] <= source_height] or HLS_LADDER[-1:]
+
+def hls_command(input_spec, output_dir, renditions, has_audio, tag, options=None, threads=0):
+    """
+    Un solo FFmpeg: decodifica una vez, escala a cada rendition y escribe
+    playlists por variante + maestra. Los keyframes se fuerzan cada
+    HLS_SEGMENT_SECONDS para que los segmentos de todas las variantes queden alineados.
+    """
+    options = options or {}
+    preset = options.get("preset", "medium")
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:2", "-i", input_spec, "-y"]
+    if threads:
+        cmd.extend(["-threads", str(threads)])
+    
+    count = len(renditions)
+    splits = "".join(f"[v{i}]" for i in range(count))
+    scales = ";".join(f"[v{i}]scale=-2:{h}[v{i}o]" for i, (h, _, _) in enumerate(renditions))
+    cmd.extend(["-filter_complex", f"[0:v]split={count}{splits};{scales}"])
+    
+    stream_map = []
+    for i, (height, v_bitrate, a_bitrate) in enumerate(renditions):
+        kbps = int(v_bitrate.rstrip("k"))
+        cmd.extend([
+            "-map", f"[v{i}o]",
+            f"-c:v:{i}", "libx264", f"-preset:v:{i}", preset,
+            f"-b:v:{i}", v_bitrate, f"-maxrate:v:{i}", f"{int(kbps * 1.07)}k", f"-bufsize:v:{i}", f"{kbps * 2}k",
+        ])
+        entry = f"v:{i}"
+        if has_audio:
+            cmd.extend(["-map", "0:a:0", f"-c:a:{i}", "aac", f"-b:a:{i}", a_bitrate])
+            entry += f",a:{i}"
+        stream_map.append(f"{entry},name:{height}p")
+    
+    cmd.extend([
+        "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_playlist_type", "vod",
+        "-hls_flags", "independent_segments",
+        "-hls_segment_filename", f"{output_dir}/%v/{tag}_%05d.ts",
+        "-master_pl_name", HLS_MASTER,
+        "-var_stream_map", " ".join(stream_map),
+        f"{output_dir}/%v/index.m3u8",
+    ])
+    return cmd
+
+def transcode_hls(job_id, input_object, target_object, options, threads):
+    """
+    Generar la escalera HLS de <input_object> y subirla junto a <target_object>
+    (la maestra). Los segmentos llevan el id del job en el nombre, así pueden
+    cachearse como inmutables; los de conversiones anteriores se borran al final.
+    Devuelve (input_size, output_size).
+    """
+    prefix = target_object.rsplit("/", 1)[0] + "/"
+    source = minio.presigned_get_object(BUCKET, input_object, expires=timedelta(hours=6))
+    input_size = minio.stat_object(BUCKET, input_object).size
+    source_height, has_audio = probe_video_stream(source)
+    media_duration = probe_duration(source)
+    renditions = hls_renditions(source_height)
+    update_job_progress(job_id, {
+        "pipeline": "hls",
+        "renditions": [f"{h}p" for h, _, _ in renditions],
+        "media_duration_seconds": round(media_duration, 2) if media_duration else None,
+    })
+    
+    with tempfile.TemporaryDirectory(prefix=f"{job_id}_hls_") as workdir:
+        cmd = hls_command(source, workdir, renditions, has_audio, job_id[:8], options, threads)
+        print(f"[{WORKER_ID}] Generando HLS ({', '.join(f'{h}p' for h, _, _ in renditions)})")
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr_tail = []
+        stderr_thread = threading.Thread(
+            target=read_ffmpeg_stderr, args=(proc, stderr_tail, ProgressReporter(job_id, media_duration)), daemon=True,
+        )
+        stderr_thread.start()
+        proc.wait()
+        stderr_thread.join()
+        if proc.returncode != 0:
+            raise Exception(f"FFmpeg error: {b''.join(stderr_tail).decode(errors='replace')}")
+        
+        # Segmentos primero y la maestra al final: nunca se publica una playlist con huecos
+        files = sorted(Path(workdir).rglob("*"), key=lambda p: (p.suffix != ".ts", p.name == HLS_MASTER))
+        uploaded = set()
+        output_size = 0
+        for path in files:
+            if not path.is_file():
+                continue
+            object_name = f"{prefix}{path.relative_to(workdir).as_posix()}"
+            minio.fput_object(BUCKET, object_name, str(path), content_type=HLS_MIME.get(path.suffix.lstrip("."), "application/octet-stream"))
+            uploaded.add(object_name)
+            output_size += path.stat().st_size
+    
+    stale = [o.object_name for o in minio.list_objects(BUCKET, prefix=prefix, recursive=True) if o.object_name not in uploaded]
+    if stale:
+        for err in minio.remove_objects(BUCKET, (DeleteObject(name) for name in stale)):
+            print(f"[{WORKER_ID}] No se pudo borrar {err.name}: {err}")
+    return input_size, output_size
+
+def transcode_multi(job_id, input_object, input_ext, outputs, threads):
+    """
+    Una sola invocación de FFmpeg con varias salidas: la entrada se descarga
+    (o se lee por stdin) y se decodifica una vez. Las salidas van a archivos
+    temporales y se suben una por una. Devuelve (input_size, {output_object:
+    tamaño o excepción de subida}); un error de FFmpeg hace fallar todas.
+    """
+    pipe_in = STREAMING_MODE == "auto" and input_ext in STREAMABLE_INPUTS
+    input_path = None
+    output_paths = {out["output_object"]: f"{tempfile.gettempdir()}/{job_id}_{out['output_file']}" for out in outputs}
+    input_size = 0
+    cached = None
+    fill = {}
+    
+    try:
+        cached = SOURCE_CACHE.acquire(BUCKET, input_object, input_ext, fetch=not pipe_in, fill=fill)
+        if cached:
+            pipe_in = False
+            input_path = SOURCE_CACHE.path(cached)
+            input_size = os.path.getsize(input_path)
+        elif not pipe_in:
+            fd, input_path = tempfile.mkstemp(suffix=f".{input_ext}" if input_ext else "")
+            os.close(fd)
+            print(f"[{WORKER_ID}] Descargando {input_object}")
+            minio.fget_object(BUCKET, input_object, input_path)
+            input_size = os.path.getsize(input_path)
+        
+        probe_spec = input_path or minio.presigned_get_object(BUCKET, input_object, expires=timedelta(minutes=10))
+        media_duration = probe_duration(probe_spec)
+        update_job_progress(job_id, {
+            "pipeline": f"{'stream' if pipe_in else 'file'}->multi",
+            "media_duration_seconds": round(media_duration, 2) if media_duration else None,
+        })
+        
+        cmd = ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:2",
+               "-i", "pipe:0" if pipe_in else input_path, "-y"]
+        if threads:
+            cmd.extend(["-threads", str(threads)])
+        for out in outputs:
+            cmd.extend(output_args(output_paths[out["output_object"]], out["format"], out["options"]))
+        print(f"[{WORKER_ID}] Convirtiendo a {', '.join(out['format'] for out in outputs)} en un solo FFmpeg")
+        
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if pipe_in else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        stderr_tail = []
+        stderr_thread = threading.Thread(
+            target=read_ffmpeg_stderr, args=(proc, stderr_tail, ProgressReporter(job_id, media_duration)), daemon=True,
+        )
+        stderr_thread.start()
+        feed_result = {"bytes": 0, "error": None}
+        feeder = None
+        if pipe_in:
+            feeder = threading.Thread(target=feed_ffmpeg_stdin, args=(proc, BUCKET, input_object, feed_result, fill), daemon=True)
+            feeder.start()
+        
+        proc.wait()
+        if feeder:
+            feeder.join()
+            input_size = feed_result["bytes"]
+        stderr_thread.join()
+        if feed_result["error"]:
+            raise Exception(f"Error leyendo {input_object}: {feed_result['error']}")
+        if proc.returncode != 0:
+            raise Exception(f"FFmpeg error: {b''.join(stderr_tail).decode(errors='replace')}")
+        
+        results = {}
+        for out in outputs:
+            target_object, path = out["output_object"], output_paths[out["output_object"]]
+            try:
+                print(f"[{WORKER_ID}] Subiendo {target_object}")
+                size = os.path.getsize(path)
+                with open(path, "rb") as f:
+                    minio.put_object(BUCKET, target_object, f, length=size,
+                                     content_type=content_type_for(out["format"]))
+                results[target_object] = size
+            except Exception as e:
+                results[target_object] = e
+        return input_size, results
+    
+    finally:
+        if fill:
+            SOURCE_CACHE.finish_fill(fill, False)  # no-op si el feeder ya lo cerró
+        if cached:
+            SOURCE_CACHE.release(cached)
+            input_path = None
+        for path in [input_path, *output_paths.values()]:
+            if path and os.path.exists(path):
+                os.unlink(path)
 
-def process_job(job_id):
+def convert_outputs(job, input_object, input_ext, threads, profile="quality"):
+    """
+    Job con varias salidas: las que ya están en la caché se copian y el resto
+    sale de un único FFmpeg. Devuelve (input_size, outputs) con estado,
+    objeto y tamaño de cada salida.
+    """
+    job_id = job["job_id"]
+    etag = minio.stat_object(BUCKET, input_object).etag if CONVERSION_CACHE_ENABLED else None
+    outputs, pending = [], []
+    for spec in job["outputs"]:
+        output_file, target_object = output_names({**job, "output_format": spec["format"]})
+        out = {
+            "format": spec["format"],
+            "options": spec.get("options") or {},
+            "status": "processing",
+            "output_file": output_file,
+            "output_object": target_object,
+            "cache_hit": False,
+        }
+        cache_key = conversion_cache_key(etag, out["format"], out["options"])
+        size = conversion_cache_fetch(cache_key, target_object) if cache_key else None
+        if cache_key:
+            CONV_CACHE.labels(result="hit" if size is not None else "miss").inc()
+        if size is not None:
+            out.update({"status": "completed", "output_size_bytes": size, "cache_hit": True})
+        else:
+            pending.append((out, cache_key))
+        outputs.append(out)
+    update_job_progress(job_id, {"outputs": outputs})
+    
+    input_size = int(job.get("input_size_bytes") or 0)
+    if pending:
+        encodes = [{**out, "options": profile_options(profile, out["options"])} for out, _ in pending]
+        input_size, results = transcode_multi(job_id, input_object, input_ext, encodes, threads)
+        for out, cache_key in pending:
+            result = results[out["output_object"]]
+            if isinstance(result, Exception):
+                out.update({"status": "failed", "error": str(result)})
+                continue
+            out.update({"status": "completed", "output_size_bytes": result})
+            if cache_key and profile == "quality":
+                try:
+                    conversion_cache_store(cache_key, out["output_object"], out["format"], result)
+                except Exception as e:
+                    print(f"[{WORKER_ID}] No se pudo guardar en la caché: {e}")
+    return input_size, outputs
+
+def detect_encoder_version():
+    """Versión de caché + primera línea de `ffmpeg -version` (forma parte de la clave de caché)"""
+    try:
+        result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True, timeout=10)
+        ffmpeg_version = (result.stdout.splitlines() or ["ffmpeg"])[0].strip()
+    except (OSError, subprocess.SubprocessError):
+        ffmpeg_version = "ffmpeg"
+    return f"{CONVERSION_CACHE_VERSION}:{ffmpeg_version}"
+
+ENCODER_VERSION = detect_encoder_version()
+
+def conversion_cache_key(etag, output_format, options):
+    """Misma clave que calcula la API en /convert"""
+    if not CONVERSION_CACHE_ENABLED or not etag:
+        return None
+    normalized = json.dumps(
+        {str(k).lower(): str(v).strip().lower() for k, v in (options or {}).items() if v is not None},
+        sort_keys=True,
+    )
+    return hashlib.sha256(f"{etag}|{output_format}|{normalized}|{ENCODER_VERSION}".encode()).hexdigest()
+
+def conversion_cache_fetch(cache_key, target_object):
+    """Copiar (server-side) el resultado cacheado a <target_object>; devuelve su tamaño o None"""
+    entry = redis_client.hgetall(f"{CONV_CACHE_ENTRY_PREFIX}{cache_key}")
+    if not entry:
+        return None
+    try:
+        minio.copy_object(BUCKET, target_object, CopySource(CACHE_BUCKET, entry["object"]))
+    except Exception:
+        return None  # desalojada entre la consulta y la copia
+    redis_client.zadd(CONV_CACHE_LRU_KEY, {cache_key: time.time()})
+    return int(entry.get("size", 0))
+
+def conversion_cache_store(cache_key, target_object, output_format, size):
+    """Guardar una copia del resultado en la caché y desalojar por LRU si se excede el presupuesto"""
+    if size > CONVERSION_CACHE_MAX_BYTES:
+        return
+    entry_key = f"{CONV_CACHE_ENTRY_PREFIX}{cache_key}"
+    cached_object = f"{cache_key}.{output_format}"
+    minio.copy_object(CACHE_BUCKET, cached_object, CopySource(BUCKET, target_object))
+    # HSETNX: si otro worker ya la guardó no se cuenta dos veces
+    if not redis_client.hsetnx(entry_key, "object", cached_object):
+        return
+    pipe = redis_client.pipeline()
+    pipe.hset(entry_key, "size", size)
+    pipe.zadd(CONV_CACHE_LRU_KEY, {cache_key: time.time()})
+    pipe.incrby(CONV_CACHE_BYTES_KEY, size)
+    pipe.execute()
+    evict_conversion_cache()
+
+def evict_conversion_cache():
+    """Desalojar las entradas menos usadas hasta volver al presupuesto de bytes"""
+    while int(redis_client.get(CONV_CACHE_BYTES_KEY) or 0) > CONVERSION_CACHE_MAX_BYTES:
+        oldest = redis_client.zpopmin(CONV_CACHE_LRU_KEY, 1)
+        if not oldest:
+            break
+        cache_key = oldest[0][0]
+        entry_key = f"{CONV_CACHE_ENTRY_PREFIX}{cache_key}"
+        entry = redis_client.hgetall(entry_key)
+        size = int(entry.get("size", 0))
+        pipe = redis_client.pipeline()
+        pipe.delete(entry_key)
+        pipe.decrby(CONV_CACHE_BYTES_KEY, size)
+        pipe.execute()
+        CONV_CACHE_EVICTED_BYTES.inc(size)
+        if entry.get("object"):
+            try:
+                minio.remove_object(CACHE_BUCKET, entry["object"])
+            except Exception as e:
+                print(f"[{WORKER_ID}] No se pudo borrar {entry['object']} de la caché: {e}")
+
+def output_names(job):
+    """(output_file, target_object) de un job: <stem>_converted.<fmt> (o la maestra HLS) bajo el prefijo del dueño"""
+    owner = job.get("owner")
+    input_object = job.get("input_object") or job.get("input_file")
+    display_name = job.get("input_file") or os.path.basename(input_object)
+    stem = Path(display_name).stem or "output"
+    if job["output_format"] in ADAPTIVE_FORMATS:
+        output_file = f"{stem}{HLS_DIR_SUFFIX}/{HLS_MASTER}"
+    else:
+        output_file = f"{stem}_converted.{job['output_format']}"
+    return output_file, (f"{owner}/{output_file}" if owner else output_file)
+
+def enqueue_job_ids(job_ids, front=False, pipe=None):
+    """Encolar jobs internos (segmentos, concatenación) en la cola general"""
+    client = pipe if pipe is not None else redis_client
+    if QUEUE_BACKEND == "streams":
+        for job_id in job_ids:
+            client.xadd(JOBS_STREAM, {"job_id": job_id})
+        if FAIR_SCHEDULING:
+            # En modo justo los workers ociosos esperan en la lista de avisos, no en XREADGROUP
+            client.rpush(FAIR_SIGNAL_KEY, *["1"] * len(job_ids))
+            client.ltrim(FAIR_SIGNAL_KEY, -FAIR_SIGNAL_MAX, -1)
+    elif front:
+        client.lpush(JOBS_QUEUE, *job_ids)
+    else:
+        client.rpush(JOBS_QUEUE, *job_ids)
+
+def cluster_video_slots():
+    """Jobs de video que el cluster puede correr a la vez (workers con heartbeat vigente)"""
+    worker_ids = redis_client.zrangebyscore(WORKERS_REGISTRY_KEY, time.time() - WORKER_STATUS_TTL, "+inf")
+    if not worker_ids:
+        return 1
+    total = 0
+    for raw in redis_client.mget([f"worker:status:{w}" for w in worker_ids]):
+        if not raw:
+            continue
+        status = json.loads(raw)
+        by_threads = int(status.get("threads_budget", 1)) // max(1, VIDEO_JOB_THREADS)
+        total += max(1, min(int(status.get("slots_total", 1)), by_threads))
+    return max(1, total)
+
+def plan_segments(job, display_name, input_object):
+    """(número de trozos, duración del medio); 0 trozos = conversión normal"""
+    if SEGMENTED_MODE == "off" or job["output_format"] not in VIDEO_FORMATS:
+        return 0, None
+    if media_kind(display_name) != "video" or str(job.get("options", {}).get("segmented", "")).lower() in ("false", "0", "off"):
+        return 0, None
+    slots = cluster_video_slots()
+    if slots < 2:
+        return 0, None
+    duration = probe_duration(minio.presigned_get_object(BUCKET, input_object, expires=timedelta(minutes=10)))
+    if not duration or duration < SEGMENT_MIN_DURATION:
+        return 0, duration
+    count = min(slots, SEGMENT_MAX_COUNT, int(duration // SEGMENT_MIN_SECONDS))
+    return (count if count >= 2 else 0), duration
+
+def split_source(job_id, input_object, count, duration):
+    """
+    Cortar el video de la fuente en ~<count> trozos con copia de streams: el
+    muxer segment solo corta en keyframes, así cada trozo decodifica solo y la
+    concatenación posterior no duplica ni pierde frames. El audio no va en los
+    trozos: se codifica una sola vez al unir (sin priming de AAC ni deriva
+    A/V en cada corte). Sube los trozos al bucket de scratch.
+    """
+    prefix = f"{SEGMENTS_PREFIX}{job_id}/"
+    source = minio.presigned_get_object(BUCKET, input_object, expires=timedelta(hours=6))
+    with tempfile.TemporaryDirectory(prefix=f"{job_id}_split_") as workdir:
+        cmd = [
+            "ffmpeg", "-hide_banner", "-nostats", "-i", source,
+            "-map", "0:v:0", "-c", "copy",
+            "-f", "segment", "-segment_time", f"{duration / count:.3f}",
+            "-reset_timestamps", "1", "-segment_format", "matroska",
+            f"{workdir}/src_%04d.mkv",
+        ]
+        print(f"[{WORKER_ID}] Partiendo {input_object} en ~{count} trozos")
+        result = subprocess.run(cmd, capture_output=True)
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg error al partir: {result.stderr.decode(errors='replace')[-2000:]}")
+        
+        sources = []
+        for path in sorted(Path(workdir).glob("src_*.mkv")):
+            object_name = f"{prefix}{path.name}"
+            minio.fput_object(SCRATCH_BUCKET, object_name, str(path), content_type="video/x-matroska")
+            path.unlink()
+            sources.append(object_name)
+    return sources
+
+def start_segmented_job(job, input_object, count, duration):
+    """Partir la fuente y repartir los trozos como sub-jobs en la cola general"""
+    job_id = job["job_id"]
+    output_format = job["output_format"]
+    try:
+        sources = split_source(job_id, input_object, count, duration)
+    except Exception:
+        cleanup_segments(job_id)
+        raise
+    
+    children = []
+    now = datetime.utcnow().isoformat()
+    pipe = redis_client.pipeline()
+    for index, source in enumerate(sources):
+        child_id = f"{job_id}-seg{index:04d}"
+        child = {
+            "job_id": child_id,
+            "parent_id": job_id,
+            "segment_index": index,
+            "input_object": source,
+            "output_object": f"{SEGMENTS_PREFIX}{job_id}/out_{index:04d}.{output_format}",
+            "output_format": output_format,
+            "options": job.get("options", {}),
+            # Todos los trozos con el perfil del padre: concatenables con -c copy
+            "encoder_profile": job.get("encoder_profile", "quality"),
+            "status": "pending",
+            "progress": 0,
+            "created_at": now,
+        }
+        pipe.hset(f"{JOBS_STATUS_PREFIX}{child_id}", mapping={k: json.dumps(v) for k, v in child.items()})
+        children.append(child_id)
+    pipe.hset(f"{JOBS_STATUS_PREFIX}{job_id}", mapping={
+        "stage": json.dumps("segments"),
+        "segments": json.dumps(children),
+        "segments_total": len(children),
+        "segments_pending": len(children),
+        "segments_done": 0,
+        "media_duration_seconds": json.dumps(round(duration, 2)),
+        "pipeline": json.dumps("segmented"),
+    })
+    enqueue_job_ids(children, pipe=pipe)
+    pipe.execute()
+    print(f"[{WORKER_ID}] Job {job_id} repartido en {len(children)} segmentos")
+
+def refresh_parent_progress(parent_id):
+    """Progreso del padre = media del progreso de sus segmentos"""
+    children = json.loads(redis_client.hget(f"{JOBS_STATUS_PREFIX}{parent_id}", "segments") or "[]")
+    if not children:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for child_id in children:
+        pipe.hget(f"{JOBS_STATUS_PREFIX}{child_id}", "progress")
+    values = [int(json.loads(v)) if v else 0 for v in pipe.execute()]
+    update_job_progress(parent_id, {"progress": min(99, sum(values) // len(values))})
+
+def segment_finished(parent_id, child_id):
+    """Descontar un segmento terminado (una sola vez aunque se reentregue); el último encola la concatenación"""
+    if not redis_client.hsetnx(f"{JOBS_STATUS_PREFIX}{child_id}", "accounted", "true"):
+        return
+    parent_key = f"{JOBS_STATUS_PREFIX}{parent_id}"
+    pending = redis_client.hincrby(parent_key, "segments_pending", -1)
+    total = int(redis_client.hget(parent_key, "segments_total") or 1)
+    update_job_progress(parent_id, {"segments_done": total - pending})
+    refresh_parent_progress(parent_id)
+    if pending <= 0:
+        pipe = redis_client.pipeline()
+        pipe.hset(parent_key, "stage", json.dumps("concat"))
+        enqueue_job_ids([parent_id], front=True, pipe=pipe)
+        pipe.execute()
+
+def segment_failed(job, error):
+    """Un segmento fallido hace fallar al padre; el resto se descarta sin procesar"""
+    SEGMENTS_DONE.labels(status="failed").inc()
+    update_job_status(job["job_id"], {"status": "failed", "error": error})
+    parent = load_job(job["parent_id"])
+    if parent and parent.get("status") == "processing":
+        update_job_status(job["parent_id"], {
+            "status": "failed",
+            "error": f"Segmento {job.get('segment_index')}: {error}",
+            "completed_at": datetime.utcnow().isoformat(),
+        })
+    segment_finished(job["parent_id"], job["job_id"])
+
+def process_segment_job(job, threads, profile="quality"):
+    """Convertir un trozo de un job segmentado (scratch -> scratch)"""
+    job_id, parent_id = job["job_id"], job["parent_id"]
+    parent = load_job(parent_id)
+    if not parent or parent.get("status") != "processing":
+        print(f"[{WORKER_ID}] Segmento {job_id} descartado: el job padre ya no está en curso")
+        segment_finished(parent_id, job_id)
+        return
+    
+    JOBS_IN_PROGRESS.inc()
+    try:
+        update_job_status(job_id, {"status": "processing", "worker_id": WORKER_ID, "started_at": datetime.utcnow().isoformat()})
+        start_time = time.time()
+        output_object = job["output_object"]
+        input_size, output_size = transcode(
+            job_id, job["input_object"], "mkv", os.path.basename(output_object), output_object,
+            job["output_format"], profile_options(profile, job.get("options", {})), threads,
+            bucket=SCRATCH_BUCKET, parent_id=parent_id,
+        )
+        update_job_status(job_id, {
+            "status": "completed",
+            "progress": 100,
+            "worker_id": WORKER_ID,
+            "duration_seconds": round(time.time() - start_time, 2),
+            "input_size_bytes": input_size,
+            "output_size_bytes": output_size,
+        })
+        SEGMENTS_DONE.labels(status="success").inc()
+        print(f"[{WORKER_ID}] Segmento {job_id} completado en {time.time() - start_time:.2f}s")
+        segment_finished(parent_id, job_id)
+    except Exception as e:
+        print(f"[{WORKER_ID}] Error en segmento {job_id}: {e}")
+        segment_failed(job, str(e))
+    finally:
+        JOBS_IN_PROGRESS.dec()
+
+def cleanup_segments(job_id, children=()):
+    """Borrar trozos de scratch y registros de sub-jobs de un job segmentado"""
+    try:
+        objects = minio.list_objects(SCRATCH_BUCKET, prefix=f"{SEGMENTS_PREFIX}{job_id}/", recursive=True)
+        for err in minio.remove_objects(SCRATCH_BUCKET, (DeleteObject(o.object_name) for o in objects)):
+            print(f"[{WORKER_ID}] No se pudo borrar {err.name} de scratch: {err}")
+    except Exception as e:
+        print(f"[{WORKER_ID}] Error limpiando scratch de {job_id}: {e}")
+    if children:
+        redis_client.delete(*[f"{JOBS_STATUS_PREFIX}{c}" for c in children])
+
+def segment_audio_args(output_format, options):
+    """Solo los argumentos de audio de video_codec_args (la pista que se codifica al unir)"""
+    args = video_codec_args(output_format, options)
+    return [v for i in range(0, len(args), 2) if args[i] in ("-codec:a", "-b:a") for v in args[i:i + 2]]
+
+def concat_segments(job):
+    """
+    Unir los segmentos de video con el demuxer concat (copia de streams),
+    codificar el audio de la fuente entera en la misma pasada y cerrar el job padre
+    """
+    global SUCCESS_COUNT, FAILED_COUNT
+    job_id = job["job_id"]
+    children = job.get("segments", [])
+    if job.get("status") != "processing":
+        print(f"[{WORKER_ID}] Job {job_id} ya no está en curso, limpiando segmentos")
+        cleanup_segments(job_id, children)
+        release_segmented_backlog(job)
+        return
+    
+    output_format = job["output_format"]
+    output_file, target_object = output_names(job)
+    JOBS_IN_PROGRESS.inc()
+    list_path = output_path = None
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for child_id in children:
+            pipe.hget(f"{JOBS_STATUS_PREFIX}{child_id}", "output_object")
+        outputs = [json.loads(v) for v in pipe.execute() if v]
+        if len(outputs) != len(children):
+            raise Exception("Faltan segmentos convertidos")
+        
+        # FFmpeg lee cada trozo desde MinIO por URL prefirmada
+        fd, list_path = tempfile.mkstemp(suffix=".ffconcat", text=True)
+        with os.fdopen(fd, "w") as f:
+            f.write("ffconcat version 1.0\n")
+            for object_name in outputs:
+                f.write(f"file '{minio.presigned_get_object(SCRATCH_BUCKET, object_name, expires=timedelta(hours=1))}'\n")
+        output_path = f"{tempfile.gettempdir()}/{job_id}_{output_file}"
+        source = minio.presigned_get_object(BUCKET, job.get("input_object") or job["input_file"],
+                                            expires=timedelta(hours=6))
+        options = profile_options(job.get("encoder_profile", "quality"), job.get("options", {}))
+        cmd = [
+            "ffmpeg", "-hide_banner", "-nostats",
+            "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,http,https,tcp,tls,crypto",
+            "-i", list_path, "-i", source,
+            "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy",
+            *segment_audio_args(output_format, options), "-y",
+        ]
+        if output_format in ("mp4", "mov"):
+            cmd.extend(["-movflags", "+faststart"])
+        cmd.append(output_path)
+        print(f"[{WORKER_ID}] Uniendo {len(outputs)} segmentos de {job_id}")
+        result = subprocess.run(cmd, capture_output=True)
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg error al unir: {result.stderr.decode(errors='replace')[-2000:]}")
+        
+        output_size = os.path.getsize(output_path)
+        with open(output_path, "rb") as f:
+            minio.put_object(BUCKET, target_object, f, length=output_size,
+                             content_type=content_type_for(output_format))
+        if job.get("cache_key") and job.get("encoder_profile", "quality") == "quality":
+            try:
+                conversion_cache_store(job["cache_key"], target_object, output_format, output_size)
+            except Exception as e:
+                print(f"[{WORKER_ID}] No se pudo guardar en la caché: {e}")
+        
+        input_size = int(job.get("input_size_bytes") or 0)
+        try:
+            duration = (datetime.utcnow() - datetime.fromisoformat(job["started_at"])).total_seconds()
+        except (KeyError, ValueError):
+            duration = 0.0
+        size_reduction = ((input_size - output_size) / input_size) * 100 if input_size > 0 else 0
+        CONV_DURATION.observe(duration)
+        FILE_SIZE_REDUCTION.observe(size_reduction)
+        CONV_DONE.labels(status="success").inc()
+        with STATE_LOCK:
+            SUCCESS_COUNT += 1
+        
+        update_job_status(job_id, {
+            "status": "completed",
+            "stage": "done",
+            "output_file": output_file,
+            "output_object": target_object,
+            "completed_at": datetime.utcnow().isoformat(),
+            "progress": 100,
+            "duration_seconds": round(duration, 2),
+            "output_size_bytes": output_size,
+            "size_reduction_percent": round(size_reduction, 2),
+            "cache_hit": False
+        })
+        print(f"[{WORKER_ID}] Job {job_id} completado en {duration:.2f}s ({len(outputs)} segmentos)")
+    
+    except Exception as e:
+        print(f"[{WORKER_ID}] Error en job {job_id}: {e}")
+        CONV_DONE.labels(status="failed").inc()
+        with STATE_LOCK:
+            FAILED_COUNT += 1
+        update_job_status(job_id, {
+            "status": "failed",
+            "error": str(e),
+            "completed_at": datetime.utcnow().isoformat()
+        })
+    
+    finally:
+        JOBS_IN_PROGRESS.dec()
+        for path in (list_path, output_path):
+            if path and os.path.exists(path):
+                os.unlink(path)
+        cleanup_segments(job_id, children)
+        try:
+            release_segmented_backlog(job)
+        except redis.RedisError as e:
+            print(f"[{WORKER_ID}] No se pudo actualizar backlog: {e}")
+
+def process_job(job_id, threads=0, profile="quality"):
     """Procesar un trabajo de conversión"""
     global CURRENT_JOBS, SUCCESS_COUNT, FAILED_COUNT
     print(f"[{WORKER_ID}] Procesando job {job_id}")
 
     # Obtener detalles del job
-    job_data = redis_client.get(f"{JOBS_STATUS_PREFIX}{job_id}")
-    if not job_data:
+    job = load_job(job_id)
+    if not job:
         print(f"[{WORKER_ID}] Job {job_id} no encontrado")
         return
+    if job.get("status") in ("completed", "failed"):
+        # Reentrega (reclamo o robo) de un job que ya terminó: solo se confirma
+        print(f"[{WORKER_ID}] Job {job_id} ya está {job['status']}, se descarta la reentrega")
+        return
 
-    job = json.loads(job_data)
-    owner = job.get("owner")
     input_object = job.get("input_object") or job.get("input_file")
     display_name = job.get("input_file") or (os.path.basename(input_object) if input_object else None)
     output_format = job["output_format"]
     options = job.get("options", {})
 
+    if job.get("parent_id"):
+        return process_segment_job(job, threads, profile)
+    if job.get("stage") == "concat":
+        return concat_segments(job)
+    if job.get("stage") == "segments":
+        print(f"[{WORKER_ID}] Job {job_id} ya está repartido en segmentos")
+        return
+
     if not input_object or not display_name:
         print(f"[{WORKER_ID}] Job {job_id} no tiene archivo válido")
         return
 
     JOBS_IN_PROGRESS.inc()
-    CURRENT_JOBS += 1
+    with STATE_LOCK:
+        CURRENT_JOBS += 1
+    segmented = False
     
     try:
         # Actualizar estado
@@ -189,91 +1802,100 @@ def process_job(job_id):
             "status": "processing",
             "worker_id": WORKER_ID,
             "started_at": datetime.utcnow().isoformat(),
-            "progress": 10
+            "progress": 0,
+            "encoder_profile": profile,
         })
+        job["encoder_profile"] = profile
+        encode_options = profile_options(profile, options)
         
         start_time = time.time()
         
-        # Crear archivos temporales
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{get_file_extension(display_name)}") as tmp_input:
-            input_path = tmp_input.name
-            
-            # Descargar de MinIO
-            print(f"[{WORKER_ID}] Descargando {input_object}")
-            minio.fget_object(BUCKET, input_object, input_path)
-            input_size = os.path.getsize(input_path)
-            
-            update_job_status(job_id, {"progress": 30})
-            
-            # Determinar nombre de salida
-            base_name = Path(display_name).stem or "output"
-            output_file = f"{base_name}_converted.{output_format}"
-            target_object = f"{owner}/{output_file}" if owner else output_file
-            output_path = f"{tempfile.gettempdir()}/{output_file}"
-            
-            # Convertir
-            print(f"[{WORKER_ID}] Convirtiendo a {output_format}")
-            update_job_status(job_id, {"progress": 50})
-            
-            # Detectar tipo de archivo
-            input_ext = get_file_extension(display_name)
-            audio_formats = ["mp3", "flac", "wav", "aac", "ogg", "m4a"]
-            video_formats = ["mp4", "avi", "mkv", "webm", "mov", "flv"]
-            
-            if output_format in audio_formats:
-                convert_audio(input_path, output_path, output_format, options)
-            elif output_format in video_formats:
-                convert_video(input_path, output_path, output_format, options)
+        # Determinar nombre de salida
+        output_file, target_object = output_names(job)
+        input_ext = get_file_extension(display_name)
+        
+        outputs = None
+        if job.get("outputs"):
+            # Varias salidas: una descarga y una decodificación para todas
+            input_size, outputs = convert_outputs(job, input_object, input_ext, threads, profile)
+            done = [o for o in outputs if o["status"] == "completed"]
+            if not done:
+                raise Exception("; ".join(f"{o['format']}: {o.get('error')}" for o in outputs))
+            output_file, target_object = done[0]["output_file"], done[0]["output_object"]
+            output_size = sum(o["output_size_bytes"] for o in done)
+            cache_hit = all(o["cache_hit"] for o in done)
+        else:
+            # Caché de conversiones: la API ya calculó la clave; si no, se usa el ETag actual
+            cache_key = job.get("cache_key")
+            if output_format in ADAPTIVE_FORMATS:
+                cache_key = None  # salida de muchos objetos, fuera de la caché
+            elif not cache_key and CONVERSION_CACHE_ENABLED:
+                cache_key = conversion_cache_key(minio.stat_object(BUCKET, input_object).etag, output_format, options)
+            output_size = conversion_cache_fetch(cache_key, target_object) if cache_key else None
+            cache_hit = output_size is not None
+            if cache_key:
+                CONV_CACHE.labels(result="hit" if cache_hit else "miss").inc()
+        
+            if cache_hit:
+                print(f"[{WORKER_ID}] Job {job_id} resuelto desde la caché de conversiones")
+                input_size = int(job.get("input_size_bytes") or 0)
             else:
-                raise Exception(f"Formato no soportado: {output_format}")
-            
-            update_job_status(job_id, {"progress": 80})
-            
-            # Subir resultado a MinIO
-            print(f"[{WORKER_ID}] Subiendo {target_object}")
-            output_size = os.path.getsize(output_path)
-            
-            with open(output_path, "rb") as f:
-                minio.put_object(
-                    BUCKET, target_object, f,
-                    length=output_size,
-                    content_type=f"video/{output_format}" if output_format in video_formats else f"audio/{output_format}"
-                )
-            
-            # Calcular métricas
-            duration = time.time() - start_time
-            size_reduction = ((input_size - output_size) / input_size) * 100 if input_size > 0 else 0
-            
-            CONV_DURATION.observe(duration)
-            FILE_SIZE_REDUCTION.observe(size_reduction)
-            CONV_DONE.labels(status="success").inc()
+                segments, media_duration = plan_segments(job, display_name, input_object)
+                if segments:
+                    # El padre queda en "processing"; lo cierra quien haga la concatenación
+                    start_segmented_job(job, input_object, segments, media_duration)
+                    segmented = True  # su backlog sigue hasta la concatenación
+                    return
+                if output_format in ADAPTIVE_FORMATS:
+                    input_size, output_size = transcode_hls(job_id, input_object, target_object, encode_options, threads)
+                else:
+                    input_size, output_size = transcode(
+                        job_id, input_object, input_ext, output_file, target_object,
+                        output_format, encode_options, threads,
+                    )
+                # Solo la salida de calidad por defecto es la que la clave de caché describe
+                if cache_key and profile == "quality":
+                    try:
+                        conversion_cache_store(cache_key, target_object, output_format, output_size)
+                    except Exception as e:
+                        print(f"[{WORKER_ID}] No se pudo guardar en la caché: {e}")
+        
+        # Calcular métricas
+        duration = time.time() - start_time
+        size_reduction = ((input_size - output_size) / input_size) * 100 if input_size > 0 else 0
+        
+        CONV_DURATION.observe(duration)
+        FILE_SIZE_REDUCTION.observe(size_reduction)
+        if not cache_hit and not outputs and profile == "quality":
+            record_cost_sample(job.get("input_kind") or media_kind(display_name), output_format, duration, input_size)
+        CONV_DONE.labels(status="success").inc()
+        with STATE_LOCK:
             SUCCESS_COUNT += 1
-            
-            # Actualizar estado final
-            update_job_status(job_id, {
-                "status": "completed",
-                "output_file": output_file,
-                "output_object": target_object,
-                "completed_at": datetime.utcnow().isoformat(),
-                "progress": 100,
-                "duration_seconds": round(duration, 2),
-                "input_size_bytes": input_size,
-                "output_size_bytes": output_size,
-                "size_reduction_percent": round(size_reduction, 2)
-            })
-            
-            print(f"[{WORKER_ID}] Job {job_id} completado en {duration:.2f}s")
-            
-            # Limpiar archivos temporales
-            os.unlink(input_path)
-            os.unlink(output_path)
+        
+        # Actualizar estado final
+        update_job_status(job_id, {
+            "status": "completed",
+            "output_file": output_file,
+            "output_object": target_object,
+            "completed_at": datetime.utcnow().isoformat(),
+            "progress": 100,
+            "duration_seconds": round(duration, 2),
+            "input_size_bytes": input_size,
+            "output_size_bytes": output_size,
+            "size_reduction_percent": round(size_reduction, 2),
+            "cache_hit": cache_hit,
+            **({"outputs": outputs} if outputs else {}),
+        })
+        
+        print(f"[{WORKER_ID}] Job {job_id} completado en {duration:.2f}s")
             
     except Exception as e:
         error_msg = str(e)
         print(f"[{WORKER_ID}] Error en job {job_id}: {error_msg}")
         
         CONV_DONE.labels(status="failed").inc()
-        FAILED_COUNT += 1
+        with STATE_LOCK:
+            FAILED_COUNT += 1
         
         update_job_status(job_id, {
             "status": "failed",
@@ -283,55 +1905,379 @@ def process_job(job_id):
     
     finally:
         JOBS_IN_PROGRESS.dec()
-        CURRENT_JOBS = max(0, CURRENT_JOBS - 1)
+        with STATE_LOCK:
+            CURRENT_JOBS = max(0, CURRENT_JOBS - 1)
+        try:
+            if not segmented:
+                release_backlog(job)
+        except redis.RedisError as e:
+            print(f"[{WORKER_ID}] No se pudo actualizar backlog: {e}")
+
+def release_orphaned_jobs(include_self=False):
+    """
+    Cola de listas: un job en "processing" cuyo worker dejó de latir no lo
+    retoma nadie y seguiría contando para USER_MAX_CONCURRENT de su dueño.
+    Se marca fallido (SET_JOB_FIELDS descuenta y avisa a la cola justa).
+    Con <include_self>, también los de este WORKER_ID (reinicio con el mismo id).
+    """
+    job_ids = redis_client.zrange(f"{JOBS_INDEX_PREFIX}status:processing", 0, -1)
+    if not job_ids:
+        return
+    alive = set(redis_client.zrangebyscore(WORKERS_REGISTRY_KEY, time.time() - ORPHAN_AFTER_SECONDS, "+inf"))
+    if include_self:
+        alive.discard(WORKER_ID)
+    pipe = redis_client.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hmget(f"{JOBS_STATUS_PREFIX}{job_id}", "worker_id", "stage")
+    for job_id, (worker_id, stage) in zip(job_ids, pipe.execute()):
+        worker_id = json.loads(worker_id) if worker_id else None
+        # Los segmentados siguen vivos en sus sub-jobs aunque caiga quien los partió
+        if not worker_id or worker_id in alive or (stage and json.loads(stage) in ("segments", "concat")):
+            continue
+        print(f"[{WORKER_ID}] 🪦 Job {job_id} huérfano de {worker_id}, se marca fallido")
+        update_job_status(job_id, {
+            "status": "failed",
+            "error": f"El worker {worker_id} dejó de responder durante la conversión",
+            "completed_at": datetime.utcnow().isoformat(),
+        })
+
+class ListQueue:
+    """
+    Cola sobre listas de Redis (BLPOP): si el worker cae, el job se pierde;
+    los workers vivos lo marcan fallido cada RECLAIM_INTERVAL.
+    """
+
+    def __init__(self):
+        self.last_orphan_scan = 0.0
+
+    def setup(self):
+        release_orphaned_jobs(include_self=True)
+
+    def fetch(self):
+        """Devolver [(job_id, ticket, origen)]; prioridad a la cola privada"""
+        if FAIR_SCHEDULING:
+            jobs = self.fetch_fair()
+            if jobs is not None:
+                return jobs
+        # Un solo BLPOP sobre ambas colas: Redis revisa las claves en orden,
+        # así que los trabajos asignados ganan y la espera no se encadena.
+        keys = [WORKER_QUEUE, JOBS_QUEUE] + ([FAIR_SIGNAL_KEY] if FAIR_SCHEDULING else [])
+        result = redis_client.blpop(keys, timeout=FETCH_BLOCK_SECONDS)
+        if not result:
+            return self.steal()
+        queue_key, job_id = result
+        if queue_key == FAIR_SIGNAL_KEY:
+            job_id = fair_pop()
+            return [(job_id, None, "JUSTO")] if job_id else []
+        return [(job_id, None, "ASIGNADO" if queue_key == WORKER_QUEUE else "GENERAL")]
+
+    def fetch_fair(self):
+        """Sin esperar: colas directas (segmentos, concatenaciones) y luego la justa"""
+        for queue_key, origin in ((WORKER_QUEUE, "ASIGNADO"), (JOBS_QUEUE, "GENERAL")):
+            job_id = redis_client.lpop(queue_key)
+            if job_id:
+                return [(job_id, None, origin)]
+        job_id = fair_pop()
+        return [(job_id, None, "JUSTO")] if job_id else None
+
+    def steal(self):
+        """Ocioso: tomar el último job (el que más esperaría) de la cola de otro worker"""
+        for victim in steal_victims():
+            job_id = redis_client.rpop(f"{JOBS_QUEUE}:{victim}")
+            if job_id:
+                JOBS_STOLEN.inc()
+                transfer_backlog(job_id, victim)
+                return [(job_id, None, f"ROBADO a {victim}")]
+        return []
+
+    def ack(self, ticket):
+        pass
+
+    def heartbeat(self):
+        now = time.time()
+        if now - self.last_orphan_scan < RECLAIM_INTERVAL:
+            return
+        self.last_orphan_scan = now
+        release_orphaned_jobs()
+
+class StreamQueue:
+    """
+    Cola sobre Redis Streams con consumer group: el job queda pendiente (PEL)
+    hasta el XACK. Mientras el worker vive renueva el idle de sus entradas;
+    si deja de hacerlo, otro worker las reclama con XAUTOCLAIM pasado
+    VISIBILITY_TIMEOUT, hasta MAX_DELIVERIES entregas antes del dead-letter.
+    Se reclaman y leen como mucho tantas entradas como slots libres (el
+    reclamo sigue el cursor de XAUTOCLAIM entre pasadas).
+    """
+
+    def __init__(self):
+        self.inflight = {}  # entry_id -> stream
+        self.lock = threading.Lock()
+        self.last_reclaim = 0.0
+        self.reclaim_cursors = {}  # stream -> start_id de la próxima pasada
+        self.held = []  # leídas de más (dos streams en un XREADGROUP): van primero en el próximo fetch
+
+    def ensure_group(self, stream):
+        try:
+            redis_client.xgroup_create(stream, STREAM_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def setup(self):
+        self.ensure_group(JOBS_STREAM)
+        self.ensure_group(WORKER_STREAM)
+
+    def track(self, stream, entry_id):
+        with self.lock:
+            self.inflight[entry_id] = stream
+        return (stream, entry_id)
+
+    def fetch(self):
+        jobs = self.reclaim()
+        if jobs:
+            return jobs
+        budget = max(1, SLOTS.snapshot()["slots_free"])
+        if self.held:
+            jobs, self.held = self.held[:budget], self.held[budget:]
+            return jobs
+        if FAIR_SCHEDULING:
+            return self.fetch_fair(budget)
+        return self.read_new(budget, block=FETCH_BLOCK_SECONDS) or self.steal()
+
+    def read_new(self, budget, block=None):
+        """
+        Hasta <budget> entradas no entregadas, la cola privada primero. El
+        COUNT es por stream: lo que sobra queda en self.held (sigue en el PEL
+        y el heartbeat lo renueva) en vez de bloquear el bucle en acquire().
+        """
+        resp = redis_client.xreadgroup(
+            STREAM_GROUP, WORKER_ID, {WORKER_STREAM: ">", JOBS_STREAM: ">"},
+            count=budget, block=block * 1000 if block else None,
+        )
+        jobs = []
+        for stream, entries in resp or []:
+            origin = "ASIGNADO" if stream == WORKER_STREAM else "GENERAL"
+            for entry_id, fields in entries:
+                jobs.append((fields.get("job_id"), self.track(stream, entry_id), origin))
+        self.held.extend(jobs[budget:])
+        return jobs[:budget]
+
+    def fetch_fair(self, budget):
+        """
+        Modo justo: XREADGROUP no puede esperar también la lista de avisos,
+        así que los streams se leen sin bloquear y el job justo se saca solo
+        aquí, cuando el bucle ya tiene slot para despacharlo (pasa al stream
+        privado en el mismo script y queda en el PEL como los demás). Sin
+        nada que hacer se espera el aviso: lo dan la API al encolar en la cola
+        justa, los workers al encolar jobs internos y al liberar un límite.
+        """
+        jobs = self.read_new(budget)
+        if jobs:
+            return jobs
+        if fair_pop(WORKER_STREAM):
+            return self.read_new(1)
+        if redis_client.blpop([FAIR_SIGNAL_KEY], timeout=FETCH_BLOCK_SECONDS):
+            return []  # el próximo fetch lo saca (el bucle vuelve enseguida)
+        return self.steal()
+
+    def steal(self):
+        """Ocioso: leer la siguiente entrada no entregada del stream privado de otro worker"""
+        for victim in steal_victims():
+            stream = f"{JOBS_STREAM}:{victim}"
+            try:
+                resp = redis_client.xreadgroup(STREAM_GROUP, WORKER_ID, {stream: ">"}, count=1)
+            except redis.ResponseError:
+                continue
+            for _, entries in resp or []:
+                for entry_id, fields in entries:
+                    job_id = fields.get("job_id")
+                    JOBS_STOLEN.inc()
+                    if job_id:
+                        transfer_backlog(job_id, victim)
+                    return [(job_id, self.track(stream, entry_id), f"ROBADO a {victim}")]
+        return []
+
+    def reclaim(self):
+        """Reclamar entradas sin heartbeat de la cola general y de las privadas"""
+        now = time.time()
+        if now - self.last_reclaim < RECLAIM_INTERVAL:
+            return []
+        budget = SLOTS.snapshot()["slots_free"]
+        if budget <= 0:
+            return []
+
+        streams = [JOBS_STREAM] + [f"{JOBS_STREAM}:{w}" for w in redis_client.zrange(WORKERS_REGISTRY_KEY, 0, -1)]
+        jobs = []
+        for stream in streams:
+            if len(jobs) >= budget:
+                break
+            try:
+                cursor, claimed, *_ = redis_client.xautoclaim(
+                    stream, STREAM_GROUP, WORKER_ID,
+                    min_idle_time=VISIBILITY_TIMEOUT * 1000,
+                    start_id=self.reclaim_cursors.get(stream, "0-0"), count=budget - len(jobs),
+                )
+            except redis.ResponseError:
+                continue  # stream o grupo inexistente (worker que nunca usó streams)
+            # "0-0" = pasada completa; la siguiente empieza de nuevo por el principio
+            self.reclaim_cursors[stream] = cursor
+            for entry_id, fields in claimed:
+                if not fields:
+                    continue  # entrada borrada mientras estaba pendiente
+                job_id = fields.get("job_id")
+                pending = redis_client.xpending_range(stream, STREAM_GROUP, min=entry_id, max=entry_id, count=1)
+                deliveries = pending[0]["times_delivered"] if pending else 1
+                if deliveries > MAX_DELIVERIES:
+                    self.dead_letter(stream, entry_id, job_id, deliveries)
+                    continue
+                JOBS_RECLAIMED.inc()
+                print(f"[{WORKER_ID}] ♻️  Job {job_id} reclamado de {stream} (entrega {deliveries})")
+                if job_id:
+                    update_job_progress(job_id, {"attempts": deliveries})
+                jobs.append((job_id, self.track(stream, entry_id), "RECLAMADO"))
+        # Con el cupo lleno puede quedar más atrasado: se vuelve a mirar en el próximo fetch
+        if len(jobs) < budget:
+            self.last_reclaim = now
+        return jobs
+
+    def dead_letter(self, stream, entry_id, job_id, deliveries):
+        JOBS_DEAD_LETTERED.inc()
+        print(f"[{WORKER_ID}] ☠️  Job {job_id} agotó {deliveries - 1} entregas, a {DEAD_LETTER_STREAM}")
+        pipe = redis_client.pipeline()
+        pipe.xadd(DEAD_LETTER_STREAM, {
+            "job_id": job_id or "", "stream": stream, "entry_id": entry_id,
+            "deliveries": deliveries, "failed_at": datetime.utcnow().isoformat(),
+        })
+        pipe.xack(stream, STREAM_GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.execute()
+        if job_id:
+            error = f"El job se interrumpió {deliveries - 1} veces (worker caído o reiniciado)"
+            job = load_job(job_id)
+            if job and job.get("parent_id"):
+                segment_failed(job, error)
+                return
+            update_job_status(job_id, {
+                "status": "failed",
+                "error": error,
+                "completed_at": datetime.utcnow().isoformat(),
+            })
+
+    def ack(self, ticket):
+        if not ticket:
+            return
+        stream, entry_id = ticket
+        pipe = redis_client.pipeline()
+        pipe.xack(stream, STREAM_GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.execute()
+        with self.lock:
+            self.inflight.pop(entry_id, None)
+
+    def heartbeat(self):
+        """Renovar el idle de las entradas en curso (XCLAIM JUSTID a uno mismo)"""
+        with self.lock:
+            inflight = list(self.inflight.items())
+        for entry_id, stream in inflight:
+            redis_client.xclaim(stream, STREAM_GROUP, WORKER_ID, min_idle_time=0,
+                                message_ids=[entry_id], justid=True)
+
+QUEUE = StreamQueue() if QUEUE_BACKEND == "streams" else ListQueue()
+
+def run_in_slot(job_id, threads, reserved, ticket=None, profile="quality"):
+    """Ejecutar un job dentro de un slot y liberarlo al terminar"""
+    try:
+        process_job(job_id, threads, profile)
+    except Exception as e:
+        print(f"[{WORKER_ID}] Error inesperado en slot para job {job_id}: {e}")
+    finally:
+        # El job terminó (bien o con fallo definitivo): ya no debe reintentarse
+        try:
+            QUEUE.ack(ticket)
+        except redis.RedisError as e:
+            print(f"[{WORKER_ID}] No se pudo confirmar job {job_id}: {e}")
+        SLOTS.release(reserved)
+
+def dispatch_job(job_id, ticket=None):
+    """Reservar slot según el tipo de job y lanzarlo en el pool"""
+    job = load_job(job_id) or {}
+    formats = [o.get("format", "") for o in job.get("outputs") or []] or [job.get("output_format", "")]
+    profile = choose_profile(job)
+    threads = profile_threads(profile, max(job_threads(f) for f in formats))
+    ENCODER_PROFILE_JOBS.labels(profile=profile).inc()
+    reserved = threads or THREAD_BUDGET
+    SLOTS.acquire(reserved, timeout=None)
+    EXECUTOR.submit(run_in_slot, job_id, threads, reserved, ticket, profile)
 
 def update_system_metrics():
     """Actualizar métricas del sistema"""
     try:
-        cpu_percent = psutil.cpu_percent(interval=1)
+        # interval=None: CPU desde la llamada anterior, sin bloquear
+        cpu_percent = psutil.cpu_percent(interval=None)
         memory_info = psutil.virtual_memory()
         memory_mb = memory_info.used / 1024 / 1024
 
         CPU_LOAD.set(cpu_percent / 100)
         MEMORY_USAGE.set(memory_mb)  # MB
+        update_encoder_pressure(cpu_percent)
         publish_worker_status(cpu_percent, memory_mb)
+        QUEUE.heartbeat()
     except Exception as e:
         print(f"Error actualizando métricas: {e}")
 
+def heartbeat_loop(stop_event):
+    """Hilo: métricas + heartbeat cada HEARTBEAT_INTERVAL, aunque haya transcodes largos"""
+    psutil.cpu_percent(interval=None)  # primera lectura de referencia
+    while not stop_event.is_set():
+        update_system_metrics()
+        stop_event.wait(HEARTBEAT_INTERVAL)
+
 def main():
     print(f"[{WORKER_ID}] Iniciando worker...")
     print(f"[{WORKER_ID}] Métricas en puerto {METRICS_PORT}")
     print(f"[{WORKER_ID}] Cola específica: {WORKER_QUEUE}")
+    print(f"[{WORKER_ID}] Slots: {WORKER_SLOTS} (presupuesto de hilos: {THREAD_BUDGET})")
+    print(f"[{WORKER_ID}] Backend de cola: {QUEUE_BACKEND}")
     
     # Iniciar servidor de métricas
     start_http_server(METRICS_PORT)
+    SLOTS_TOTAL.set(WORKER_SLOTS)
+    QUEUE.setup()
+    SOURCE_CACHE.setup()
+    if CONVERSION_CACHE_ENABLED:
+        try:
+            if not minio.bucket_exists(CACHE_BUCKET):
+                minio.make_bucket(CACHE_BUCKET)
+        except Exception as e:
+            print(f"[{WORKER_ID}] Bucket de caché {CACHE_BUCKET}: {e}")
+        redis_client.set(CONV_CACHE_ENCODER_KEY, ENCODER_VERSION)
+    if SEGMENTED_MODE != "off":
+        try:
+            if not minio.bucket_exists(SCRATCH_BUCKET):
+                minio.make_bucket(SCRATCH_BUCKET)
+        except Exception as e:
+            print(f"[{WORKER_ID}] Bucket de scratch {SCRATCH_BUCKET}: {e}")
+    
+    stop_event = threading.Event()
+    threading.Thread(target=heartbeat_loop, args=(stop_event,), name="heartbeat", daemon=True).start()
     
     print(f"[{WORKER_ID}] Esperando trabajos en cola...")
     
     while True:
         try:
-            # Actualizar métricas del sistema
-            update_system_metrics()
-            
-            # Prioridad 1: Verificar cola específica del worker (trabajos asignados)
-            result = redis_client.blpop(WORKER_QUEUE, timeout=1)
-            
-            if result:
-                _, job_id = result
-                print(f"[{WORKER_ID}] ⭐ Trabajo ASIGNADO recibido: {job_id}")
-                process_job(job_id)
+            # Solo se toman trabajos si queda algún slot libre
+            if not SLOTS.wait_free_slot(timeout=1):
                 continue
             
-            # Prioridad 2: Verificar cola general (si no hay trabajos asignados)
-            result = redis_client.blpop(JOBS_QUEUE, timeout=5)
-            
-            if result:
-                _, job_id = result
-                print(f"[{WORKER_ID}] 📋 Trabajo de cola GENERAL recibido: {job_id}")
-                process_job(job_id)
+            for job_id, ticket, origin in QUEUE.fetch():
+                print(f"[{WORKER_ID}] {'⭐' if origin == 'ASIGNADO' else '📋'} Trabajo {origin} recibido: {job_id}")
+                dispatch_job(job_id, ticket)
             
         except KeyboardInterrupt:
             print(f"[{WORKER_ID}] Deteniendo worker...")
+            EXECUTOR.shutdown(wait=True)
+            stop_event.set()
             break
         except Exception as e:
             print(f"[{WORKER_ID}] Error en loop principal: {e}")